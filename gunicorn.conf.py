@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration, read from the working directory at startup
+
+The change feed holds requests open: a long-poll for up to
+CHANGE_FEED_MAX_WAIT seconds and an event stream for
+CHANGE_FEED_STREAM_DURATION. A sync worker serves one request at a time and
+is restarted once a request runs past the timeout, so the workers serve
+requests from a pool of threads and the timeout outlasts the longest stream.
+"""
+
+# gunicorn settings are lower case module names
+# pylint: disable=invalid-name
+import os
+
+from service import config
+
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout = int(max(config.CHANGE_FEED_STREAM_DURATION, config.CHANGE_FEED_MAX_WAIT)) + 30
+graceful_timeout = timeout
@@ -40,16 +40,26 @@ def create_app():
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, clock
 
     db.init_app(app)
+    clock.init_app(app)
 
     with app.app_context():
         # Dependencies require we import the routes AFTER the Flask app is created
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import
-        from service import routes  # noqa: F401 E402
+        import service.routes  # noqa: F401 E402
+        import service.cache_routes  # noqa: F401 E402
+        import service.change_feed_routes  # noqa: F401 E402
+        import service.replication_routes  # noqa: F401 E402
+        import service.stats_routes  # noqa: F401 E402
         from service.models import Order, Item, OrderStatus
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common.anti_entropy import anti_entropy
+        from service.common.dispatcher import dispatcher
+        from service.common.known_orders import known_orders
+        from service.common.order_cache import order_cache
+        from service.common.peers import manager
 
         try:
             db.create_all()
@@ -58,6 +68,21 @@ def create_app():
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
 
+        # Serve hot orders from memory, and unknown ones without a query
+        order_cache.init_app(app)
+        known_orders.init_app(app)
+
+        # Deliver replicated changes to the peers in the background
+        manager.init_app(app)
+        dispatcher.init_app(app)
+        if app.config["PEER_NODES"] and app.config["OUTBOX_DISPATCHER"]:
+            dispatcher.start()
+
+        # Repair whatever the peers missed anyway
+        anti_entropy.init_app(app)
+        if app.config["PEER_NODES"] and app.config["ANTI_ENTROPY_INTERVAL"] > 0:
+            anti_entropy.start()
+
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
@@ -0,0 +1,79 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cache Endpoints
+
+Reports how well the order cache and the filter of known orders work
+"""
+
+from flask import current_app as app  # Import Flask application
+from flask_restx import Resource, fields
+from service.common import status  # HTTP Status Codes
+from service.common.known_orders import known_orders
+from service.common.order_cache import order_cache
+from service.routes import api
+
+
+cache_metrics_model = api.model(
+    "CacheMetrics",
+    {
+        "backend": fields.String(
+            readOnly=True, enum=["memory", "mmap", "redis"], description="Where Orders are kept"
+        ),
+        "entries": fields.Integer(
+            readOnly=True, description="Orders in the cache, null when the backend cannot tell"
+        ),
+        "capacity": fields.Integer(readOnly=True, description="The most Orders it keeps"),
+        "ttl": fields.Float(readOnly=True, description="Seconds an Order is served from it"),
+        "hits": fields.Integer(readOnly=True, description="Reads answered from the cache"),
+        "misses": fields.Integer(readOnly=True, description="Reads that went to the database"),
+        "hit_rate": fields.Float(readOnly=True, description="Share of the reads that hit"),
+        "missing_hits": fields.Integer(
+            readOnly=True, description="Hits that were answered with 404 since the Order does not exist"
+        ),
+        "evictions": fields.Integer(
+            readOnly=True, description="Orders dropped to make room for others"
+        ),
+        "invalidations": fields.Integer(
+            readOnly=True, description="Orders dropped because they changed"
+        ),
+        "oversize": fields.Integer(
+            readOnly=True, description="Orders not cached because they were larger than a cache entry"
+        ),
+        "filter_ids": fields.Integer(
+            readOnly=True, description="Order ids in the filter of known ids, null until it is filled"
+        ),
+        "filter_rejections": fields.Integer(
+            readOnly=True, description="Reads of unknown ids the filter answered without a query"
+        ),
+    },
+)
+
+
+######################################################################
+#  PATH: /cache/metrics
+######################################################################
+@api.route("/cache/metrics")
+class CacheMetricsResource(Resource):
+    """Effectiveness of the order cache"""
+
+    @api.doc("get_cache_metrics")
+    @api.marshal_with(cache_metrics_model)
+    def get(self):
+        """Returns the size and hit rate of the order cache"""
+        app.logger.info("Request for cache metrics")
+        return {**order_cache.metrics(), **known_orders.metrics()}, status.HTTP_200_OK
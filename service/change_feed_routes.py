@@ -0,0 +1,167 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Feed Endpoint
+
+Lets clients follow the changes to the orders in commit order, by polling
+or over a Server-Sent Events stream
+"""
+
+from flask import Response, request, stream_with_context
+from flask import current_app as app  # Import Flask application
+from flask_restx import Resource, fields, reqparse
+from service.models import Change, ChangeHorizon
+from service.common import status  # HTTP Status Codes
+from service.common.change_feed import read_changes, stream_changes
+from service.routes import abort, api
+
+
+change_model = api.model(
+    "Change",
+    {
+        "cursor": fields.Integer(
+            readOnly=True, description="Position of the change in commit order"
+        ),
+        "op": fields.String(
+            readOnly=True,
+            enum=["create", "update", "patch", "delete"],
+            description="The kind of change",
+        ),
+        "entity": fields.String(
+            readOnly=True, enum=["order", "item"], description="The kind of record"
+        ),
+        "id": fields.Integer(
+            readOnly=True, description="The id of the order the change belongs to"
+        ),
+        "data": fields.Raw(readOnly=True, description="The record or the changed fields"),
+        "created_at": fields.String(readOnly=True),
+    },
+)
+
+change_page_model = api.model(
+    "ChangePage",
+    {
+        "changes": fields.List(fields.Nested(change_model)),
+        "cursor": fields.Integer(
+            readOnly=True, description="Pass this as since to read the next changes"
+        ),
+    },
+)
+
+# query string arguments for reading the change feed
+change_args = reqparse.RequestParser()
+change_args.add_argument(
+    "since",
+    type=int,
+    location="args",
+    required=False,
+    default=0,
+    help="The cursor of the last change already seen",
+)
+change_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    default=100,
+    help="The most changes to return",
+)
+change_args.add_argument(
+    "wait",
+    type=float,
+    location="args",
+    required=False,
+    default=0.0,
+    help="Seconds to wait for a change when there is none yet",
+)
+
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+@api.route("/orders/changes")
+class OrderChangeFeed(Resource):
+    """Changes to the orders in commit order"""
+
+    @api.doc("list_order_changes")
+    @api.expect(change_args, validate=True)
+    @api.response(200, "The changes after the cursor", change_page_model)
+    @api.response(400, "The query was not valid")
+    @api.response(410, "Changes after the cursor were pruned")
+    def get(self):
+        """
+        Returns the changes committed after a cursor
+
+        Sending Accept: text/event-stream opens a Server-Sent Events stream
+        instead, which resumes from the Last-Event-ID header if it is set.
+
+        A cursor older than the retained log is answered with 410 Gone and
+        the cursor to follow from after reading the orders again.
+        """
+        args = change_args.parse_args()
+        config = app.config
+        limit = args["limit"]
+        if not 1 <= limit <= config["CHANGE_FEED_MAX_LIMIT"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Limit must be from 1 to {config['CHANGE_FEED_MAX_LIMIT']}",
+            )
+        since = args["since"]
+        poll_interval = config["CHANGE_FEED_POLL_INTERVAL"]
+
+        if request.accept_mimetypes.best == "text/event-stream":
+            last_event_id = request.headers.get("Last-Event-ID", "")
+            if last_event_id.isdigit():
+                since = int(last_event_id)
+            check_change_horizon(since)
+            app.logger.info("Request to stream order changes after %s", since)
+            stream = stream_changes(
+                since, limit, config["CHANGE_FEED_STREAM_DURATION"], poll_interval
+            )
+            return Response(
+                stream_with_context(stream),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        check_change_horizon(since)
+        wait = min(max(args["wait"], 0.0), config["CHANGE_FEED_MAX_WAIT"])
+        app.logger.info("Request for order changes after %s", since)
+        changes = read_changes(since, limit, wait, poll_interval)
+        return {
+            "changes": [change.serialize() for change in changes],
+            "cursor": changes[-1].id if changes else since,
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def check_change_horizon(since):
+    """Aborts with 410 Gone if changes after a cursor were pruned from the log
+
+    The reader has to read the orders again and follow the changes from the
+    cursor it is given, which is the newest one before it starts reading.
+    """
+    horizon = ChangeHorizon.current()
+    if since < horizon:
+        abort(
+            status.HTTP_410_GONE,
+            f"Changes after cursor {since} were pruned; read the orders again "
+            "and follow the changes from the cursor given",
+            cursor=max(Change.newest(), horizon),
+        )
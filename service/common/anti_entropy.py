@@ -0,0 +1,531 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Anti-Entropy Repair
+
+Finds and repairs orders that differ between this node and a peer.
+
+Orders are grouped into buckets of ANTI_ENTROPY_BUCKET_SIZE consecutive ids.
+Bucket hashes are the leaves of a hash tree in which every node covers a
+fixed id range and has ANTI_ENTROPY_FANOUT children, so node (level, index)
+means the same range on every peer. Two nodes compare their roots, descend
+only into subtrees whose hashes differ, then compare the per-order digests
+of the differing buckets and copy over just the orders that differ. The
+cost of a repair grows with the number of differences, not the table size.
+
+Only one process per node runs the repair. It rebuilds the leaves from the
+database at the start of every pass and stores them in MerkleLeaf, and every
+worker answers peers from those stored leaves. The same pass prunes the
+tombstones and the change log entries that are past their time.
+"""
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
+
+from service.common import peers
+from service.common.replication import apply_mutation
+from service.models import (
+    db,
+    Change,
+    DataValidationError,
+    Item,
+    JobLease,
+    MerkleLeaf,
+    Order,
+    Tombstone,
+)
+from service.models.outbox import to_json
+
+logger = logging.getLogger("flask.app")
+
+TREE_PATH = "/api/replication/tree"
+BUCKET_PATH = "/api/replication/buckets"
+LEASE = "anti-entropy"
+
+# The most tree nodes or order ids asked for in one request. An id takes up
+# to 14 bytes of a query string with its encoded comma, so a request stays
+# well within the 4094 byte request line gunicorn accepts and the 4096
+# nodes the tree endpoint answers for at once.
+CHUNK_SIZE = 200
+
+# Order ids are 32 bit signed integers. They are shifted to start at zero so
+# every bucket index is positive and a single root covers every possible id.
+ID_OFFSET = 2**31
+KEY_SPACE = 2**32
+
+_tree_cache = {}
+_tree_lock = threading.Lock()
+
+
+def order_digest(order_id, customer_name, status, items):
+    """Returns a digest of the replicated content of an order
+
+    Only the fields peers copy from each other are hashed, so local ids and
+    timestamps of items do not make equal orders look different.
+    """
+    parts = [str(order_id), customer_name, getattr(status, "value", status)]
+    for product_name, quantity, price in sorted(
+        (name, qty, f"{Decimal(str(price)):.2f}") for name, qty, price in items
+    ):
+        parts.append(f"{product_name}:{quantity}:{price}")
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def _combine(hashes):
+    """Returns the hash of a tree node from the hashes of its children"""
+    if not any(hashes):
+        return ""
+    return hashlib.sha1("|".join(hashes).encode("utf-8")).hexdigest()
+
+
+def bucket_of(order_id, bucket_size):
+    """Returns the index of the bucket an order id falls in"""
+    return (order_id + ID_OFFSET) // bucket_size
+
+
+def bucket_bounds(bucket, bucket_size):
+    """Returns the (lowest, one past the highest) order id of a bucket"""
+    low = bucket * bucket_size - ID_OFFSET
+    return low, low + bucket_size
+
+
+def _order_rows(low=None, high=None):
+    """Yields (id, customer_name, status, updated_at, version, items) in id order
+
+    Orders and items are streamed side by side so memory use stays flat
+    """
+    orders = db.session.query(
+        Order.id, Order.customer_name, Order.status, Order.updated_at, Order.version
+    )
+    items = db.session.query(Item.order_id, Item.product_name, Item.quantity, Item.price)
+    if low is not None:
+        orders = orders.filter(Order.id >= low, Order.id < high)
+        items = items.filter(Item.order_id >= low, Item.order_id < high)
+    orders = orders.order_by(Order.id).yield_per(1000)
+    items = iter(items.order_by(Item.order_id).yield_per(1000))
+
+    item = next(items, None)
+    for order_id, customer_name, status, updated_at, version in orders:
+        order_items = []
+        while item is not None and item[0] <= order_id:
+            if item[0] == order_id:
+                order_items.append(item[1:])
+            item = next(items, None)
+        yield order_id, customer_name, status, updated_at, version, order_items
+
+
+class MerkleTree:
+    """A hash tree over the order table
+
+    Every level is computed up front, so a built tree is never changed and
+    can be read from several threads at once.
+    """
+
+    def __init__(self, bucket_size, fanout, leaves=None):
+        self.bucket_size = bucket_size
+        self.fanout = fanout
+        self.top_level = 0
+        while self.span(self.top_level) < KEY_SPACE:
+            self.top_level += 1
+        self.levels = [dict(leaves or {})]
+        for _ in range(self.top_level):
+            below = self.levels[-1]
+            self.levels.append(
+                {
+                    parent: _combine(
+                        [below.get(parent * fanout + child, "") for child in range(fanout)]
+                    )
+                    for parent in {index // fanout for index in below}
+                }
+            )
+
+    @classmethod
+    def scan(cls, bucket_size, fanout):
+        """Builds the tree from the order table in one pass"""
+        leaves = {}
+        bucket, digests = None, []
+        for order_id, customer_name, status, _, _, items in _order_rows():
+            this_bucket = bucket_of(order_id, bucket_size)
+            if this_bucket != bucket and digests:
+                leaves[bucket] = _combine(digests)
+                digests = []
+            bucket = this_bucket
+            digests.append(order_digest(order_id, customer_name, status, items))
+        if digests:
+            leaves[bucket] = _combine(digests)
+        return cls(bucket_size, fanout, leaves)
+
+    @classmethod
+    def load(cls, bucket_size, fanout):
+        """Builds the tree from the leaves stored by the last scan"""
+        return cls(bucket_size, fanout, MerkleLeaf.load())
+
+    @property
+    def leaves(self):
+        """Returns {bucket: hash} for every non-empty bucket"""
+        return self.levels[0]
+
+    def node_hash(self, level, index):
+        """Returns the hash of a node or "" if it covers no orders"""
+        return self.levels[level].get(index, "")
+
+    def span(self, level):
+        """Returns how many ids a node at the given level covers"""
+        return self.bucket_size * self.fanout**level
+
+    def root(self, low, high):
+        """Returns (level, index) of the lowest node covering both buckets"""
+        level = 0
+        while level < self.top_level and low // self.fanout**level != high // self.fanout**level:
+            level += 1
+        return level, low // self.fanout**level
+
+    def children(self, index):
+        """Returns the indexes of the children of a node"""
+        return range(index * self.fanout, (index + 1) * self.fanout)
+
+    def info(self):
+        """Returns the shape of the tree as a dictionary"""
+        return {
+            "bucket_size": self.bucket_size,
+            "fanout": self.fanout,
+            "top_level": self.top_level,
+            "min_bucket": min(self.leaves, default=None),
+            "max_bucket": max(self.leaves, default=None),
+        }
+
+
+def current_tree(app):
+    """Returns the tree this node answers peers from
+
+    The stored leaves are reloaded at most once every ANTI_ENTROPY_TREE_TTL
+    seconds. Returns None if the repairer has not built a tree yet.
+    """
+    with _tree_lock:
+        loaded_at, tree = _tree_cache.get("tree", (0, None))
+        if tree is None or time.monotonic() - loaded_at > app.config["ANTI_ENTROPY_TREE_TTL"]:
+            if JobLease.completed_at_of(LEASE) is None:
+                return None
+            tree = MerkleTree.load(
+                app.config["ANTI_ENTROPY_BUCKET_SIZE"], app.config["ANTI_ENTROPY_FANOUT"]
+            )
+            _tree_cache["tree"] = (time.monotonic(), tree)
+        return tree
+
+
+def clear_tree():
+    """Forgets the tree loaded by this process"""
+    with _tree_lock:
+        _tree_cache.clear()
+
+
+def bucket_rows(bucket, bucket_size):
+    """Returns the orders and deleted orders in a bucket
+
+    Returns:
+        {"orders": {id: {digest, updated_at, version}}, "deleted": {id: deleted_at}}
+    """
+    low, high = bucket_bounds(bucket, bucket_size)
+    return {
+        "orders": {
+            str(order_id): {
+                "digest": order_digest(order_id, customer_name, status, items),
+                "updated_at": updated_at.isoformat(),
+                "version": version,
+            }
+            for order_id, customer_name, status, updated_at, version, items in _order_rows(
+                low, high
+            )
+        },
+        "deleted": {
+            str(order_id): deleted_at.isoformat()
+            for order_id, deleted_at in Tombstone.in_range("order", low, high)
+        },
+    }
+
+
+def bucket_records(bucket, bucket_size, ids):
+    """Returns {id: serialized order} for the given ids in a bucket"""
+    low, high = bucket_bounds(bucket, bucket_size)
+    wanted = [order_id for order_id in ids if low <= order_id < high]
+    if not wanted:
+        return {}
+    return {
+        str(order.id): _record(order)
+        for order in Order.query.options(selectinload(Order.items)).filter(
+            Order.id.in_(wanted)
+        )
+    }
+
+
+def _record(order):
+    """Returns an order as it is copied to a peer, with the versions of its fields"""
+    record = to_json(order.serialize())
+    record["field_versions"] = order.field_versions or {}
+    for item_data, item in zip(record["items"], order.items):
+        item_data["field_versions"] = item.field_versions or {}
+    return record
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    """Splits a list into lists of at most size values"""
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def _as_utc(timestamp):
+    """Parses an ISO timestamp, treating one without a zone as UTC"""
+    when = datetime.fromisoformat(timestamp)
+    return when if when.tzinfo else when.replace(tzinfo=timezone.utc)
+
+
+def plan_repair(local, remote):
+    """Decides which orders of a bucket to copy from a peer
+
+    The copy with the higher version wins, the same rule replication uses.
+    Versions of different nodes never tie, but copies with equal versions
+    are still ordered by digest so both nodes would pick the same one.
+    Deletes are compared by time since tombstones have no version.
+
+    Returns:
+        a list of order ids to pull and {order id: deleted_at} to delete
+    """
+    pull = []
+    for order_id, row in remote["orders"].items():
+        mine = local["orders"].get(order_id)
+        deleted_at = local["deleted"].get(order_id)
+        if mine is not None:
+            if mine["digest"] != row["digest"] and (row["version"], row["digest"]) > (
+                mine["version"],
+                mine["digest"],
+            ):
+                pull.append(order_id)
+        elif deleted_at is None or _as_utc(row["updated_at"]) > _as_utc(deleted_at):
+            pull.append(order_id)
+
+    delete = {
+        order_id: deleted_at
+        for order_id, deleted_at in remote["deleted"].items()
+        if order_id in local["orders"]
+        and _as_utc(deleted_at) >= _as_utc(local["orders"][order_id]["updated_at"])
+    }
+    return pull, delete
+
+
+class AntiEntropy:
+    """Repairs differences between this node and its peers"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Binds the repair process to a Flask app"""
+        self.app = app
+        app.extensions["anti_entropy"] = self
+
+    @property
+    def holder(self):
+        """Returns the name this process holds the repair lease under"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """Starts the background thread that repairs every interval"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="anti-entropy", daemon=True
+        )
+        self._thread.start()
+        logger.info("Anti-entropy repair started")
+
+    def _run(self):
+        """Repairs against every peer, then sleeps for the interval"""
+        while True:
+            with self.app.app_context():
+                try:
+                    self.repair_all()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Anti-entropy pass failed")
+                finally:
+                    db.session.remove()
+            time.sleep(self.app.config["ANTI_ENTROPY_INTERVAL"])
+
+    def rebuild_tree(self):
+        """Scans the order table and stores the leaves for every worker"""
+        config = self.app.config
+        tree = MerkleTree.scan(
+            config["ANTI_ENTROPY_BUCKET_SIZE"], config["ANTI_ENTROPY_FANOUT"]
+        )
+        MerkleLeaf.replace(tree.leaves)
+        JobLease.complete(LEASE, self.holder)
+        clear_tree()
+        return tree
+
+    def repair_all(self):
+        """Rebuilds the tree and repairs against every peer in turn
+
+        Nothing is done unless this process holds the repair lease.
+
+        Returns:
+            a dictionary of peer to the number of orders repaired
+        """
+        config = self.app.config
+        ttl = max(2 * config["ANTI_ENTROPY_INTERVAL"], 60)
+        if not JobLease.acquire(LEASE, self.holder, ttl):
+            logger.debug("Anti-entropy is running in another process")
+            return {}
+
+        tree = self.rebuild_tree()
+        repaired = {}
+        for peer in config.get("PEER_NODES", []):
+            try:
+                repaired[peer] = self.repair_peer(peer, tree)
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                logger.error("Anti-entropy with %s failed: %s", peer, error)
+                repaired[peer] = 0
+        Tombstone.prune(
+            datetime.now(timezone.utc)
+            - timedelta(seconds=config["ANTI_ENTROPY_TOMBSTONE_TTL"])
+        )
+        Change.prune(
+            datetime.now(timezone.utc)
+            - timedelta(seconds=config["CHANGE_LOG_RETENTION"])
+        )
+        return repaired
+
+    def repair_peer(self, peer, tree=None):
+        """Copies the orders and deletes that are newer on a peer to this node
+
+        Every node runs its own repair, so differences are fixed in both
+        directions without either side pushing.
+
+        Returns:
+            the number of orders repaired
+        """
+        config = self.app.config
+        remote = peers.fetch_from_peer(peer, TREE_PATH, timeout=config["PEER_TIMEOUT"])
+        if remote is None:
+            return 0
+        if tree is None:
+            tree = MerkleTree.scan(
+                config["ANTI_ENTROPY_BUCKET_SIZE"], config["ANTI_ENTROPY_FANOUT"]
+            )
+        if (remote["bucket_size"], remote["fanout"]) != (tree.bucket_size, tree.fanout):
+            logger.error("Peer %s uses a different tree shape, skipping", peer)
+            return 0
+        mine = tree.info()
+        ends = [
+            bucket
+            for bucket in (
+                mine["min_bucket"],
+                mine["max_bucket"],
+                remote["min_bucket"],
+                remote["max_bucket"],
+            )
+            if bucket is not None
+        ]
+        if not ends:
+            return 0
+
+        repaired = 0
+        for bucket in self._differing_buckets(peer, tree, min(ends), max(ends)):
+            repaired += self._repair_bucket(peer, bucket, tree.bucket_size)
+        if repaired:
+            logger.info("Repaired %d order(s) from peer %s", repaired, peer)
+        return repaired
+
+    def _differing_buckets(self, peer, tree, low, high):
+        """Walks down the tree and returns the buckets whose hashes differ
+
+        The nodes of a level are asked for CHUNK_SIZE at a time
+        """
+        level, index = tree.root(low, high)
+        frontier = [index]
+        while frontier:
+            differing = []
+            for chunk in _chunks(frontier):
+                remote = peers.fetch_from_peer(
+                    peer,
+                    TREE_PATH,
+                    params={"level": level, "index": ",".join(map(str, chunk))},
+                    timeout=self.app.config["PEER_TIMEOUT"],
+                )
+                if remote is None:
+                    return []
+                differing += [
+                    i
+                    for i in chunk
+                    if remote["hashes"].get(str(i), "") != tree.node_hash(level, i)
+                ]
+            if level == 0:
+                return differing
+            frontier = [child for i in differing for child in tree.children(i)]
+            level -= 1
+        return []
+
+    def _repair_bucket(self, peer, bucket, bucket_size):
+        """Pulls the orders of one bucket that are missing or older here and
+        deletes the ones the peer deleted after they last changed here
+
+        The orders are pulled CHUNK_SIZE at a time
+        """
+        timeout = self.app.config["PEER_TIMEOUT"]
+        path = f"{BUCKET_PATH}/{bucket}"
+        remote = peers.fetch_from_peer(peer, path, timeout=timeout)
+        if remote is None:
+            return 0
+        pull, delete = plan_repair(bucket_rows(bucket, bucket_size), remote)
+
+        mutations = [
+            {"op": "delete", "entity": "order", "id": order_id, "data": {"deleted_at": deleted_at}}
+            for order_id, deleted_at in delete.items()
+        ]
+        for chunk in _chunks(pull):
+            records = peers.fetch_from_peer(
+                peer, path, params={"ids": ",".join(chunk)}, timeout=timeout
+            )
+            if records is not None:
+                mutations += [
+                    {"op": "update", "entity": "order", "id": order_id, "data": data}
+                    for order_id, data in records["records"].items()
+                ]
+
+        repaired = 0
+        for mutation in mutations:
+            try:
+                with db.session.begin_nested():
+                    apply_mutation(mutation)
+            except DataValidationError as error:
+                logger.error("Could not repair order %s: %s", mutation["id"], error)
+                continue
+            repaired += 1
+        db.session.commit()
+        return repaired
+
+
+anti_entropy = AntiEntropy()
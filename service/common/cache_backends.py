@@ -0,0 +1,477 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cache Backends
+
+Where the order cache keeps rendered Orders. ORDER_CACHE_URL picks one:
+
+    memory://                   a dictionary in each worker process
+    mmap:///dev/shm/orders      a file mapped into every worker on the host
+    redis://host:6379/0         a server speaking the Redis protocol
+
+A worker of a shared backend sees what the others cache, and an order one
+worker invalidates is gone for all of them, so the cache is held once
+however many workers there are.
+
+Every backend keeps an epoch that each invalidation moves on. A reader
+takes the epoch before it reads an order from the database and the order
+is only stored if the epoch has not moved since, so an order read before
+a change was committed is never cached after the change dropped it.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger("flask.app")
+
+
+class CacheError(Exception):
+    """Used when a cache backend cannot be reached"""
+
+
+def encode(data):
+    """Returns a rendered Order as JSON bytes"""
+    return json.dumps(data, default=str, separators=(",", ":")).encode("utf-8")
+
+
+class CacheBackend:
+    """Base class of the places rendered Orders are kept, by order id"""
+
+    name = None
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # counted by this process only
+        self.evictions = 0
+        self.invalidations = 0
+        self.oversize = 0
+
+    def epoch(self):
+        """Returns the epoch to pass to put() for what is read from now on"""
+        raise NotImplementedError
+
+    def get(self, order_id):
+        """Returns a rendered Order or None if it is not cached"""
+        raise NotImplementedError
+
+    def put(self, order_id, data, epoch, ttl=None):
+        """Caches a rendered Order unless it changed since the epoch it was read in
+
+        It is kept for ttl seconds, or the ttl of the backend if not given
+        """
+        raise NotImplementedError
+
+    def invalidate(self, order_ids=None):
+        """Drops some Orders from the cache, or all of them if none are given"""
+        raise NotImplementedError
+
+    def entries(self):
+        """Returns how many Orders are cached, or None if it cannot tell"""
+        return None
+
+    def close(self):
+        """Lets go of what the backend holds open"""
+
+
+######################################################################
+#  I N - P R O C E S S
+######################################################################
+class MemoryBackend(CacheBackend):
+    """A least recently used dictionary in this process"""
+
+    name = "memory"
+
+    def __init__(self, size=10000, ttl=5.0, clock=time.monotonic):
+        super().__init__(size, ttl)
+        self._clock = clock
+        self._entries = OrderedDict()  # order id -> (expiry time, rendered order)
+        self._lock = threading.Lock()
+        self._epoch = 0
+
+    def epoch(self):
+        with self._lock:
+            return self._epoch
+
+    def get(self, order_id):
+        with self._lock:
+            entry = self._entries.get(order_id)
+            if entry is None:
+                return None
+            if entry[0] <= self._clock():
+                del self._entries[order_id]
+                return None
+            self._entries.move_to_end(order_id)
+            return entry[1]
+
+    def put(self, order_id, data, epoch, ttl=None):
+        with self._lock:
+            if self.size <= 0 or epoch != self._epoch:
+                return
+            self._entries[order_id] = (self._clock() + (ttl or self.ttl), data)
+            self._entries.move_to_end(order_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, order_ids=None):
+        with self._lock:
+            self._epoch += 1
+            if order_ids is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                return
+            for order_id in order_ids:
+                if self._entries.pop(order_id, None) is not None:
+                    self.invalidations += 1
+
+    def entries(self):
+        with self._lock:
+            return len(self._entries)
+
+
+######################################################################
+#  S H A R E D   M E M O R Y
+######################################################################
+MAGIC = b"ORDCACHE"
+HEADER = struct.Struct("<8sQII")  # magic, epoch, slots, bytes per slot
+SLOT = struct.Struct("<qdI")  # order id, expiry (seconds since 1970), length of the JSON
+WAYS = 4  # slots an order may be kept in
+
+
+class SharedMemoryBackend(CacheBackend):
+    """A file mapped into the memory of every worker on the host
+
+    The file holds a fixed number of slots of ORDER_CACHE_ENTRY_SIZE bytes,
+    so its size never grows. An order goes in one of WAYS slots picked by
+    its id; when all of them are taken the one closest to expiring makes
+    room. An order too large for a slot is not cached, and counted as
+    oversize. Workers take a
+    shared lock on the file to read and an exclusive one to write.
+    """
+
+    name = "mmap"
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, path, size=10000, ttl=5.0, entry_size=2048, clock=time.time):
+        super().__init__(size, ttl)
+        self.path = path
+        self.entry_size = entry_size
+        self.slots = max(1, -(-size // WAYS)) * WAYS
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def _open(self):
+        """Maps the file, making it if this is the first worker
+
+        A forked worker maps it again, since locks on a file it inherited
+        would be shared with its parent.
+        """
+        if self._pid == os.getpid():
+            return
+        length = HEADER.size + self.slots * self.entry_size
+        # pylint: disable=consider-using-with
+        file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            header = file.read(HEADER.size)
+            layout = None
+            if len(header) == HEADER.size:
+                magic, _, slots, entry_size = HEADER.unpack(header)
+                layout = (magic, slots, entry_size)
+            if layout != (MAGIC, self.slots, self.entry_size):
+                logger.info("Formatting the order cache in %s", self.path)
+                file.truncate(0)
+                file.truncate(length)
+                file.seek(0)
+                file.write(HEADER.pack(MAGIC, 0, self.slots, self.entry_size))
+                file.flush()
+            self._map = mmap.mmap(file.fileno(), length)
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+        self._file = file
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, operation):
+        """Holds a lock on the file and yields its memory"""
+        with self._lock:
+            try:
+                self._open()
+                fcntl.flock(self._file, operation)
+                try:
+                    yield self._map
+                finally:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+            except OSError as error:
+                raise CacheError(f"Cannot use the order cache in {self.path}: {error}") from error
+
+    def _offsets(self, order_id):
+        """Returns where the slots an order may be kept in start"""
+        first = order_id % (self.slots // WAYS) * WAYS
+        return [HEADER.size + index * self.entry_size for index in range(first, first + WAYS)]
+
+    def epoch(self):
+        with self._locked(fcntl.LOCK_SH) as memory:
+            return HEADER.unpack_from(memory)[1]
+
+    def get(self, order_id):
+        payload = None
+        with self._locked(fcntl.LOCK_SH) as memory:
+            now = self._clock()
+            for offset in self._offsets(order_id):
+                key, expires, length = SLOT.unpack_from(memory, offset)
+                if length and key == order_id and expires > now:
+                    start = offset + SLOT.size
+                    payload = memory[start:start + length]
+                    break
+        return json.loads(payload) if payload is not None else None
+
+    def put(self, order_id, data, epoch, ttl=None):
+        payload = encode(data)
+        if self.size <= 0:
+            return
+        if len(payload) > self.entry_size - SLOT.size:
+            self.oversize += 1
+            logger.debug("Order %s takes %d bytes, too many to cache", order_id, len(payload))
+            return
+        with self._locked(fcntl.LOCK_EX) as memory:
+            if HEADER.unpack_from(memory)[1] != epoch:
+                return
+            now = self._clock()
+            victim, oldest = None, None
+            for offset in self._offsets(order_id):
+                key, expires, length = SLOT.unpack_from(memory, offset)
+                if not length or key == order_id or expires <= now:
+                    victim, oldest = offset, None
+                    break
+                if oldest is None or expires < oldest:
+                    victim, oldest = offset, expires
+            if oldest is not None:
+                self.evictions += 1
+            SLOT.pack_into(memory, victim, order_id, now + (ttl or self.ttl), len(payload))
+            start = victim + SLOT.size
+            memory[start:start + len(payload)] = payload
+
+    def invalidate(self, order_ids=None):
+        with self._locked(fcntl.LOCK_EX) as memory:
+            magic, epoch, slots, entry_size = HEADER.unpack_from(memory)
+            HEADER.pack_into(memory, 0, magic, epoch + 1, slots, entry_size)
+            if order_ids is None:
+                offsets = [HEADER.size + index * self.entry_size for index in range(self.slots)]
+            else:
+                offsets = [offset for order_id in order_ids for offset in self._offsets(order_id)]
+            wanted = None if order_ids is None else set(order_ids)
+            for offset in offsets:
+                key, _, length = SLOT.unpack_from(memory, offset)
+                if length and (wanted is None or key in wanted):
+                    SLOT.pack_into(memory, offset, 0, 0.0, 0)
+                    self.invalidations += 1
+
+    def entries(self):
+        with self._locked(fcntl.LOCK_SH) as memory:
+            now = self._clock()
+            count = 0
+            for index in range(self.slots):
+                _, expires, length = SLOT.unpack_from(memory, HEADER.size + index * self.entry_size)
+                count += bool(length and expires > now)
+            return count
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+            self._pid = self._file = self._map = None
+
+
+######################################################################
+#  R E D I S
+######################################################################
+class RespConnection:
+    """A connection to a server that speaks the Redis protocol"""
+
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout)
+        self.reader = self.sock.makefile("rb")
+
+    @staticmethod
+    def _command(args):
+        """Returns a command as a RESP array of bulk strings"""
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            value = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        return b"".join(parts)
+
+    def _reply(self):
+        """Reads one reply"""
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("The cache server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise CacheError(f"The cache server refused a command: {rest.decode()}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            return None if length < 0 else self.reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self._reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected reply from the cache server: {line!r}")
+
+    def execute(self, *commands):
+        """Sends commands in one write and returns their replies"""
+        self.sock.sendall(b"".join(self._command(args) for args in commands))
+        return [self._reply() for _ in commands]
+
+    def close(self):
+        """Closes the connection"""
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisBackend(CacheBackend):
+    """Keys with a time to live on a Redis server shared by every worker
+
+    The server decides what to evict when it is full, so it should run
+    with a maxmemory limit and an LRU policy. Emptying the cache moves on a
+    generation that every value is stored with instead of deleting keys;
+    values of an old generation are ignored until they expire.
+    """
+
+    name = "redis"
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, url, size=10000, ttl=5.0, prefix="orders:cache", timeout=1.0):
+        super().__init__(size, ttl)
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = parsed.password
+        self.database = int(parsed.path.strip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
+
+    def _connection(self):
+        """Returns the connection of this thread, opening it if need be"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = RespConnection(self.address, self.timeout)
+            if self.password:
+                connection.execute(("AUTH", self.password))
+            if self.database:
+                connection.execute(("SELECT", self.database))
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def _execute(self, *commands):
+        """Runs commands and returns their replies, reconnecting next time on failure"""
+        try:
+            return self._connection().execute(*commands)
+        except (OSError, CacheError) as error:
+            connection = getattr(self._local, "connection", None)
+            self._local.connection = None
+            if connection is not None:
+                connection.close()
+            if isinstance(error, CacheError):
+                raise
+            raise CacheError(f"Cannot reach the cache server: {error}") from error
+
+    def epoch(self):
+        return int(self._execute(("GET", self._key("epoch")))[0] or 0)
+
+    def get(self, order_id):
+        generation, value = self._execute(
+            ("MGET", self._key("generation"), self._key(order_id))
+        )[0]
+        if value is None:
+            return None
+        stored, _, payload = value.partition(b":")
+        if stored != (generation or b"0"):
+            return None
+        return json.loads(payload)
+
+    def put(self, order_id, data, epoch, ttl=None):
+        if self.size <= 0:
+            return
+        epoch_key = self._key("epoch")
+        # the transaction fails if an invalidation moves the epoch meanwhile
+        _, (current, generation) = self._execute(
+            ("WATCH", epoch_key), ("MGET", epoch_key, self._key("generation"))
+        )
+        if int(current or 0) != epoch:
+            self._execute(("UNWATCH",))
+            return
+        value = (generation or b"0") + b":" + encode(data)
+        self._execute(
+            ("MULTI",),
+            ("SET", self._key(order_id), value, "PX", max(1, int((ttl or self.ttl) * 1000))),
+            ("EXEC",),
+        )
+
+    def invalidate(self, order_ids=None):
+        if order_ids is None:
+            self._execute(("INCR", self._key("epoch")), ("INCR", self._key("generation")))
+            return
+        order_ids = list(order_ids)
+        if not order_ids:
+            return
+        # the epoch moves first so a reader cannot store an order between the two
+        _, deleted = self._execute(
+            ("INCR", self._key("epoch")),
+            ("DEL", *[self._key(order_id) for order_id in order_ids]),
+        )
+        self.invalidations += deleted
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def make_backend(url, size, ttl, entry_size):
+    """Returns the cache backend a URL names"""
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBackend(size, ttl)
+    if parsed.scheme == "mmap":
+        return SharedMemoryBackend(parsed.path, size, ttl, entry_size)
+    if parsed.scheme == "redis":
+        return RedisBackend(url, size, ttl)
+    raise ValueError(f"Unknown order cache backend '{url}'")
@@ -0,0 +1,86 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Feed
+
+Reads the change log for consumers that follow the orders. A reader passes
+the cursor of the last change it has seen and gets the changes committed
+after it, in commit order.
+
+A long-poll read waits for the first new change instead of returning an
+empty page. A Server-Sent Events stream keeps sending changes as they are
+committed. Commits made by this process wake the waiting readers at once;
+commits made by other processes are picked up every
+CHANGE_FEED_POLL_INTERVAL seconds.
+"""
+import json
+import logging
+import time
+
+from service.models import Change, db
+
+logger = logging.getLogger("flask.app")
+
+
+def read_changes(since, limit, wait=0.0, poll_interval=1.0):
+    """Returns up to limit changes after a cursor
+
+    Args:
+        since (int): the cursor of the last change the reader has seen
+        limit (int): the most changes to return
+        wait (float): seconds to wait for a change if there is none yet
+        poll_interval (float): the most to wait before looking again
+
+    Returns:
+        a list of Change, empty if none was committed in time
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        changes = Change.since(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        # end the read so the next one sees what was committed since
+        db.session.rollback()
+        Change.wait(min(remaining, poll_interval))
+
+
+def stream_changes(since, limit, duration, poll_interval=1.0):
+    """Yields the changes after a cursor as Server-Sent Events
+
+    The stream ends after duration seconds and the client reconnects with
+    the Last-Event-ID header set to the last id it received. A comment is
+    sent whenever nothing changed for a poll interval to keep the
+    connection open.
+    """
+    deadline = time.monotonic() + duration
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            changes = read_changes(since, limit, min(remaining, poll_interval), poll_interval)
+            db.session.rollback()
+            if not changes:
+                yield ": keep-alive\n\n"
+                continue
+            for change in changes:
+                data = json.dumps(change.serialize(), default=str)
+                yield f"id: {change.id}\nevent: change\ndata: {data}\n\n"
+            since = changes[-1].id
+    finally:
+        db.session.remove()
@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime, timedelta, timezone
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, add_columns, create_indexes, Change, OrderStat
+from service.common.anti_entropy import anti_entropy
 
 
 ######################################################################
@@ -34,3 +37,88 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to repair differences with the peer nodes
+# Usage:
+#   flask anti-entropy
+######################################################################
+@app.cli.command("anti-entropy")
+def anti_entropy_repair():
+    """
+    Compares this node with every peer once and copies over the orders
+    that are missing or out of date here.
+    """
+    results = anti_entropy.repair_all()
+    if not results:
+        click.echo("Anti-entropy is already running in another process")
+    for peer, repaired in results.items():
+        click.echo(f"{peer}: {repaired} order(s) repaired")
+
+
+######################################################################
+# Command to add the columns a database is missing
+# Usage:
+#   flask db-upgrade
+######################################################################
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """
+    Adds every column the models define that the tables of the database
+    do not have yet, filling them in for the rows already there.
+    """
+    added = add_columns()
+    if not added:
+        click.echo("All columns are already there")
+    for name in added:
+        click.echo(f"Added column {name}")
+
+
+######################################################################
+# Command to build the indexes a database is missing
+# Usage:
+#   flask db-indexes
+######################################################################
+@app.cli.command("db-indexes")
+def db_indexes():
+    """
+    Builds every index the models define that the database does not have
+    yet, without blocking writes on PostgreSQL.
+    """
+    built = create_indexes()
+    if not built:
+        click.echo("All indexes are already built")
+    for name in built:
+        click.echo(f"Built index {name}")
+
+
+######################################################################
+# Command to count the order statistics again
+# Usage:
+#   flask stats-rebuild
+######################################################################
+@app.cli.command("stats-rebuild")
+def stats_rebuild():
+    """
+    Counts every order again for the order statistics, for a database
+    that had orders before the statistics were kept.
+    """
+    OrderStat.rebuild()
+    click.echo("Order statistics rebuilt")
+
+
+######################################################################
+# Command to prune the change log
+# Usage:
+#   flask changes-prune
+######################################################################
+@app.cli.command("changes-prune")
+def changes_prune():
+    """
+    Deletes the changes older than CHANGE_LOG_RETENTION seconds, for a
+    node without peers whose anti-entropy pass would do it.
+    """
+    older_than = datetime.now(timezone.utc) - timedelta(seconds=app.config["CHANGE_LOG_RETENTION"])
+    pruned = Change.prune(older_than)
+    click.echo(f"Pruned {pruned} change(s)")
@@ -0,0 +1,63 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Page Cursors
+
+A page of Orders links to the next one with a cursor that holds the values
+of the sort columns of its last Order, so the next page is read from just
+past it without counting the Orders before it.
+"""
+import base64
+import json
+import logging
+from datetime import datetime
+
+from service.models import DataValidationError
+
+logger = logging.getLogger("flask.app")
+
+# how the values of the sort columns are read back from a cursor
+CURSOR_TYPES = {
+    "id": int,
+    "created_at": datetime.fromisoformat,
+    "updated_at": datetime.fromisoformat,
+}
+
+
+def encode_cursor(order, columns):
+    """Returns an opaque cursor that points just past an order in a sort"""
+    values = [getattr(order, column) for column in columns]
+    position = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, columns):
+    """Returns the values of the sort columns a cursor points past
+
+    Raises:
+        DataValidationError: when the cursor was not made for this sort
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("the cursor is for another sort")
+        return tuple(
+            CURSOR_TYPES.get(column, str)(value) for column, value in zip(columns, values)
+        )
+    except (ValueError, TypeError, UnicodeError) as error:
+        logger.debug("Bad cursor %s: %s", cursor, error)
+        raise DataValidationError("The cursor is not valid") from error
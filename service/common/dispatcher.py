@@ -0,0 +1,245 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Outbox Dispatcher
+
+Drains the transactional outbox to the peer nodes from a background thread.
+Every peer is drained independently. Changes are grouped into batches of up
+to OUTBOX_BATCH_SIZE, gathered over OUTBOX_BATCH_WINDOW seconds, and each
+batch is sent to a peer in a single request. A peer that cannot take a batch
+is retried with exponential backoff, so delivery is at-least-once.
+
+Only a 2xx answer counts as delivered. Anything else, including a 404 from a
+peer that is still being deployed, leaves the batch to be sent again. The
+peer lists the changes it will never accept as "rejected", and those are
+logged and not sent again.
+
+Each peer is sent its undelivered events in id order. An event that commits
+after a later one was already sent is simply sent in the next batch.
+
+Every batch carries an Idempotency-Key made from this node's id and the
+events in it, so a peer answers a batch it already applied, whose answer
+was lost on the way back, from its key store.
+"""
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from service.common import peers, status
+from service.common.idempotency import HEADER
+from service.models import db, OutboxDelivery, OutboxEvent, PeerCursor
+
+logger = logging.getLogger("flask.app")
+
+BATCH_PATH = "/api/replication/batch"
+
+
+class OutboxDispatcher:
+    """Delivers outbox events to the peers"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._wake = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Binds the dispatcher to a Flask app"""
+        self.app = app
+        app.extensions["outbox_dispatcher"] = self
+
+    def start(self):
+        """Starts the background thread that drains the outbox"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="outbox-dispatcher", daemon=True
+        )
+        self._thread.start()
+        logger.info("Outbox dispatcher started")
+
+    def _run(self):
+        """Drains the outbox whenever woken up or the poll interval passes"""
+        while True:
+            if self._wake.wait(self.app.config["OUTBOX_POLL_INTERVAL"]):
+                # let a burst of writes build up into a single batch
+                time.sleep(self.app.config["OUTBOX_BATCH_WINDOW"])
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    self.drain_once(sync=True)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Outbox dispatcher pass failed")
+
+    def notify(self):
+        """Tells the dispatcher there is new work in the outbox
+
+        In synchronous mode the outbox is drained before returning so the
+        client response waits on the peers, otherwise the background thread
+        is woken up and this returns right away.
+        """
+        if self.app.config.get("PEER_SYNC_FORWARD"):
+            self.drain_once(sync=True)
+        else:
+            self._wake.set()
+
+    def drain_once(self, sync=True):
+        """Drains every peer once, at the same time, then prunes the outbox"""
+        futures = peers.fan_out(self.drain_peer, sync=sync)
+        if sync:
+            self.prune()
+        return futures
+
+    def drain_peer(self, peer):
+        """Delivers the pending events to one peer
+
+        Returns:
+            the number of events delivered
+        """
+        with self.app.app_context():
+            try:
+                return self._drain(peer)
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                logger.error("Could not drain outbox for peer %s: %s", peer, error)
+                return 0
+            finally:
+                db.session.remove()
+
+    def _drain(self, peer):
+        """Sends pending events to a peer one batch at a time until one fails"""
+        config = self.app.config
+        if peers.manager.get(peer).is_open():
+            # the circuit breaker already holds off this peer, so the outage
+            # is not counted against the backoff a second time
+            return 0
+        cursor = PeerCursor.lock(peer)
+        now = datetime.now(timezone.utc)
+        if cursor is None or cursor.is_backing_off(now):
+            db.session.rollback()
+            return 0
+
+        delivered = 0
+        while True:
+            events = OutboxEvent.pending(peer, config["OUTBOX_BATCH_SIZE"])
+            if not events:
+                break
+            if not self._send_batch(peer, cursor, events, now):
+                break
+            delivered += len(events)
+            if len(events) < config["OUTBOX_BATCH_SIZE"]:
+                break
+
+        db.session.commit()
+        return delivered
+
+    def _send_batch(self, peer, cursor, events, now):
+        """Sends one batch to a peer and records what it received
+
+        Returns:
+            True if the peer took the batch, False if it should be retried
+        """
+        config = self.app.config
+        seqs = ",".join(str(event.id) for event in events)
+        key = hashlib.sha1(f"{config['NODE_ID']}:{seqs}".encode("utf-8")).hexdigest()
+        response = peers.request_peer(
+            peer,
+            "POST",
+            BATCH_PATH,
+            json={"mutations": [event.serialize() for event in events]},
+            timeout=config["PEER_TIMEOUT"],
+            headers={HEADER: key},
+        )
+        code = response.status_code if response is not None else None
+        if code is None or not status.HTTP_200_OK <= code < status.HTTP_300_MULTIPLE_CHOICES:
+            cursor.attempts += 1
+            delay = min(
+                config["OUTBOX_BACKOFF_MAX"],
+                config["OUTBOX_BACKOFF_BASE"] * 2 ** (cursor.attempts - 1),
+            )
+            cursor.next_attempt_at = now + timedelta(seconds=delay)
+            cursor.last_error = f"batch of {len(events)} → {code}"
+            logger.warning(
+                "Peer %s failed a batch of %d events with %s, retrying in %.1f s",
+                peer,
+                len(events),
+                code,
+                delay,
+            )
+            return False
+
+        OutboxDelivery.delivered(peer, [event.id for event in events])
+        cursor.attempts = 0
+        cursor.next_attempt_at = None
+        cursor.last_error = None
+        rejected = self._rejected(response)
+        if rejected:
+            cursor.last_error = f"rejected events {rejected}"[:255]
+            logger.error("Peer %s rejected events %s, not sending them again", peer, rejected)
+        return True
+
+    @staticmethod
+    def _rejected(response):
+        """Returns the seq numbers a peer said it will never accept"""
+        try:
+            return response.json().get("rejected") or []
+        except (AttributeError, ValueError):
+            return []
+
+    def prune(self):
+        """Deletes the events that every configured peer has received
+
+        Deliveries to peers that are no longer configured are dropped first
+
+        Returns:
+            the number of events deleted
+        """
+        peer_nodes = self.app.config.get("PEER_NODES", [])
+        if not peer_nodes:
+            return 0
+        dropped = OutboxDelivery.forget_peers(peer_nodes)
+        if dropped:
+            logger.warning("Dropped %d delivery(s) to removed peers", dropped)
+        return OutboxEvent.prune()
+
+    @staticmethod
+    def metrics(peer_nodes):
+        """Returns how far behind every peer is along with its request metrics
+
+        The lag is the age of the oldest change a peer has not received yet
+        """
+        now = datetime.now(timezone.utc)
+        backlog = OutboxDelivery.backlog()
+        result = []
+        for peer_metrics in peers.manager.metrics(peer_nodes):
+            queued, oldest = backlog.get(peer_metrics["peer"], (0, None))
+            if oldest is not None and oldest.tzinfo is None:
+                oldest = oldest.replace(tzinfo=timezone.utc)
+            peer_metrics["queue_depth"] = queued
+            peer_metrics["lag_seconds"] = (
+                max(0.0, (now - oldest).total_seconds()) if oldest else 0.0
+            )
+            result.append(peer_metrics)
+        return result
+
+
+dispatcher = OutboxDispatcher()
@@ -0,0 +1,125 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotent Requests
+
+A request sent with an Idempotency-Key header has its successful response
+stored for IDEMPOTENCY_KEY_TTL seconds. Sending the same request with the
+same key again returns the stored response, marked with an
+Idempotent-Replayed header, without running the request a second time.
+Reusing a key for a different request is refused with 409 Conflict.
+
+Keys are scoped to the method and path they were used with. A request that
+failed is not stored, so it can be retried with the same key.
+
+The key is reserved before the request runs, so a retry sent while the
+first request is still running is refused with 409 Conflict as well,
+instead of running the request a second time. The reservation lapses after
+IDEMPOTENCY_KEY_PENDING_TTL seconds if the request never finishes.
+"""
+import hashlib
+import json
+import logging
+from functools import wraps
+
+from flask import current_app as app
+from flask import request
+from flask_restx import abort
+
+from service.common import status
+from service.models import IdempotencyKey
+from service.models.outbox import to_json
+
+logger = logging.getLogger("flask.app")
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def _digest(*parts):
+    """Returns a fixed size digest of some strings"""
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _fingerprint():
+    """Returns a digest of the body of the current request"""
+    body = request.get_json(silent=True)
+    return _digest(json.dumps(body, sort_keys=True, default=str))
+
+
+def _unpack(result):
+    """Splits what a resource returned into (body, status code, headers)"""
+    if not isinstance(result, tuple):
+        return result, status.HTTP_200_OK, {}
+    code = result[1] if len(result) > 1 else status.HTTP_200_OK
+    headers = result[2] if len(result) > 2 else {}
+    return result[0], code, headers or {}
+
+
+def idempotent(func):
+    """Makes a resource method answer retries sent with the same key from the store"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if not client_key:
+            return func(*args, **kwargs)
+
+        key = _digest(request.method, request.path, client_key)
+        fingerprint = _fingerprint()
+        stored = IdempotencyKey.find(key)
+        reserved = None
+        if stored is None:
+            reserved = IdempotencyKey.reserve(key, fingerprint, app.config["IDEMPOTENCY_KEY_PENDING_TTL"])
+            if reserved is None:
+                # another request reserved it first
+                stored = IdempotencyKey.find(key)
+        if reserved is None:
+            return _replay(stored, client_key, fingerprint)
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            reserved.release()
+            raise
+        body, code, headers = _unpack(result)
+        if status.HTTP_200_OK <= code < status.HTTP_300_MULTIPLE_CHOICES:
+            reserved.complete(code, to_json(body), headers.get("Location"), app.config["IDEMPOTENCY_KEY_TTL"])
+        else:
+            reserved.release()
+        return result
+
+    return wrapper
+
+
+def _replay(stored, client_key, fingerprint):
+    """Answers a request whose key is taken with the response stored for it"""
+    if stored is not None and stored.fingerprint != fingerprint:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"{HEADER} '{client_key}' was already used for a different request",
+        )
+    if stored is None or stored.processing:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"A request with {HEADER} '{client_key}' is still being processed",
+        )
+    logger.info("Replaying the response to %s %s", request.method, request.path)
+    headers = {REPLAYED_HEADER: "true"}
+    if stored.location:
+        headers["Location"] = stored.location
+    return stored.body, stored.status_code, headers
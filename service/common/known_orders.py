@@ -0,0 +1,204 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Known Orders
+
+A Bloom filter of the order ids that exist, so a request for an id that
+was never created is answered with 404 without reading the orders. The
+filter can only be wrong the safe way: ORDER_FILTER_ERROR_RATE of the
+unknown ids, and every deleted one, still go to the database.
+
+The filter is filled with every order id the first time it is used, and
+the orders this process creates are added when they are committed. Those
+created by other workers or replicated from peers are in the change log,
+so before an id the filter does not hold is called unknown the newest
+entry of the log is read, and the orders created since the filter last
+looked are added. That one lookup of the log's primary key is all an
+unknown id costs, and an order that exists is never answered with 404.
+If the entries it has not read yet were pruned from the log meanwhile, the
+filter is filled again.
+Once more ids were added than it was made for, the filter is filled again
+with room for twice as many.
+"""
+import hashlib
+import logging
+import math
+import threading
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import Change, ChangeHorizon, Order, db
+
+logger = logging.getLogger("flask.app")
+
+
+class BloomFilter:
+    """A compact set of integers that can only say for sure what is not in it"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.bits = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, value):
+        """Returns the bits of a value, by double hashing one digest"""
+        digest = hashlib.blake2b(value.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * second) % self.bits for index in range(self.hashes)]
+
+    def add(self, value):
+        """Adds a value"""
+        for position in self._positions(value):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(value)
+        )
+
+
+class KnownOrders:
+    """The order ids that may exist"""
+
+    def __init__(self):
+        self.capacity = 1000000
+        self.error_rate = 0.01
+        self._filter = None
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self.rejections = 0
+
+    def init_app(self, app):
+        """Reads the size of the filter from a Flask app"""
+        self.capacity = app.config["ORDER_FILTER_CAPACITY"]
+        self.error_rate = app.config["ORDER_FILTER_ERROR_RATE"]
+        self.reset()
+        app.extensions["known_orders"] = self
+
+    def reset(self):
+        """Forgets the filter so it is filled again on first use"""
+        with self._lock:
+            self._filter = None
+            self.rejections = 0
+
+    def may_exist(self, order_id):
+        """Says whether an Order may exist; False means it surely does not
+
+        Falls back to True when the filter cannot be filled
+        """
+        if self.capacity <= 0:
+            return True
+        with self._lock:
+            try:
+                if self._filter is None:
+                    self._fill(self.capacity)
+                if order_id in self._filter:
+                    return True
+                # another process may have created it since the filter looked
+                self._refresh()
+            except SQLAlchemyError as error:
+                logger.warning("Cannot read the known order ids: %s", error)
+                self._filter = None
+                return True
+            if order_id in self._filter:
+                return True
+            self.rejections += 1
+            return False
+
+    def add(self, order_ids):
+        """Adds the ids of Orders this process created"""
+        with self._lock:
+            if self._filter is not None:
+                for order_id in order_ids:
+                    self._filter.add(order_id)
+
+    def metrics(self):
+        """Returns how many ids the filter holds and how many requests it answered"""
+        with self._lock:
+            return {
+                "filter_ids": self._filter.count if self._filter is not None else None,
+                "filter_rejections": self.rejections,
+            }
+
+    def _fill(self, capacity):
+        """Makes a new filter with every order id"""
+        cursor = Change.newest()
+        count = Order.query.count()
+        bloom = BloomFilter(max(capacity, 2 * count), self.error_rate)
+        for order_id in db.session.scalars(select(Order.id).execution_options(yield_per=10000)):
+            bloom.add(order_id)
+        logger.info("Filled the known order ids with %d order(s)", bloom.count)
+        self._filter = bloom
+        self._cursor = max(self._cursor, cursor)
+
+    def _refresh(self):
+        """Adds the orders created since the change log was last read
+
+        Entries of the log become visible in the order of their cursors, so
+        none will appear below the last one read
+        """
+        top = Change.newest()
+        if top > self._cursor and ChangeHorizon.current() > self._cursor:
+            # entries it has not read were pruned from the log
+            self._fill(self._filter.capacity)
+            return
+        if top > self._cursor:
+            created = db.session.scalars(
+                select(Change.entity_id).where(
+                    Change.id > self._cursor,
+                    Change.id <= top,
+                    Change.entity == "order",
+                    Change.op == "create",
+                )
+            )
+            for order_id in created:
+                self._filter.add(order_id)
+            self._cursor = top
+        if self._filter.count > self._filter.capacity:
+            self._fill(2 * self._filter.capacity)
+
+
+known_orders = KnownOrders()
+
+
+######################################################################
+#  N E W   O R D E R S
+######################################################################
+@event.listens_for(db.session, "after_flush")
+def _collect_created_orders(session, flush_context):  # pylint: disable=unused-argument
+    """Remembers the orders a flush created until the transaction commits"""
+    created = session.info.setdefault("known_orders", set())
+    created.update(instance.id for instance in session.new if isinstance(instance, Order))
+
+
+@event.listens_for(db.session, "after_commit")
+def _add_created_orders(session):
+    """Adds the orders a transaction created once it is committed"""
+    created = session.info.pop("known_orders", None)
+    if created:
+        known_orders.add(created)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _forget_created_orders(session, previous_transaction):
+    """Forgets the orders of a transaction that was rolled back"""
+    if not previous_transaction.nested:
+        session.info.pop("known_orders", None)
@@ -0,0 +1,196 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Order Cache
+
+Keeps the latest Orders read by id, rendered as the JSON bodies the API
+sends, so that reading a hot order again neither queries the database nor
+serializes it. At most ORDER_CACHE_SIZE orders are
+kept and none for longer than ORDER_CACHE_TTL seconds, in the backend
+ORDER_CACHE_URL names (see cache_backends).
+
+An id that was found not to exist can be cached too, for a shorter time,
+so a client asking for it again is answered with 404 without a query.
+
+Every commit of this process that changes an order or its items, whether
+it came from a client or a peer, drops that order from the cache. A read
+that started before such a commit does not store what it read. With the
+in-process backend other workers do not hear of the change, so there a
+cached order can be up to ORDER_CACHE_TTL seconds old; the shared backends
+drop it for every worker at once.
+
+A backend that cannot be reached only costs reads from the database.
+"""
+import logging
+import threading
+from itertools import chain
+
+from sqlalchemy import event, inspect
+from service.common.cache_backends import CacheError, MemoryBackend, make_backend
+from service.models import db, Item, Order
+
+logger = logging.getLogger("flask.app")
+
+
+class OrderCache:
+    """A cache of rendered Orders by id that counts its hits and misses"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.missing_hits = 0
+
+    def init_app(self, app):
+        """Opens the backend a Flask app is configured with"""
+        self.backend.close()
+        self.backend = make_backend(
+            app.config["ORDER_CACHE_URL"],
+            app.config["ORDER_CACHE_SIZE"],
+            app.config["ORDER_CACHE_TTL"],
+            app.config["ORDER_CACHE_ENTRY_SIZE"],
+        )
+        self.hits = self.misses = self.missing_hits = 0
+        app.extensions["order_cache"] = self
+
+    def epoch(self):
+        """Returns the epoch to pass to put() for what is read from now on
+
+        None if the backend cannot be reached, and nothing is stored then
+        """
+        try:
+            return self.backend.epoch()
+        except CacheError as error:
+            logger.warning("Order cache unavailable: %s", error)
+            return None
+
+    def get(self, order_id):
+        """Returns a rendered Order or None if it is not cached
+
+        The dictionary may be shared with other readers and must not be changed
+        """
+        try:
+            data = self.backend.get(order_id)
+        except CacheError as error:
+            logger.warning("Order cache unavailable: %s", error)
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.missing_hits += bool(data.get("missing"))
+        return data
+
+    def put(self, order_id, data, epoch, ttl=None):
+        """Caches a rendered Order unless it changed since the epoch it was read in
+
+        It is kept for ttl seconds, or the ttl of the backend if not given
+        """
+        if epoch is None:
+            return
+        try:
+            self.backend.put(order_id, data, epoch, ttl)
+        except CacheError as error:
+            logger.warning("Order cache unavailable: %s", error)
+
+    def invalidate(self, order_ids=None):
+        """Drops some Orders from the cache, or all of them if none are given"""
+        try:
+            self.backend.invalidate(order_ids)
+        except CacheError as error:
+            logger.error("Order cache not invalidated, it may be stale for a while: %s", error)
+
+    def clear(self):
+        """Empties the cache and resets its counters"""
+        self.invalidate()
+        with self._lock:
+            self.hits = self.misses = self.missing_hits = 0
+        self.backend.evictions = self.backend.invalidations = self.backend.oversize = 0
+
+    def metrics(self):
+        """Returns the size and hit rate of the cache as this process saw them"""
+        try:
+            entries = self.backend.entries()
+        except CacheError:
+            entries = None
+        with self._lock:
+            reads = self.hits + self.misses
+            return {
+                "backend": self.backend.name,
+                "entries": entries,
+                "capacity": self.backend.size,
+                "ttl": self.backend.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / reads if reads else 0.0,
+                "missing_hits": self.missing_hits,
+                "evictions": self.backend.evictions,
+                "invalidations": self.backend.invalidations,
+                "oversize": self.backend.oversize,
+            }
+
+
+order_cache = OrderCache()
+
+
+######################################################################
+#  I N V A L I D A T I O N
+######################################################################
+@event.listens_for(db.session, "after_flush")
+def _collect_changed_orders(session, flush_context):  # pylint: disable=unused-argument
+    """Remembers the orders a flush changed until the transaction commits"""
+    order_ids = session.info.setdefault("cache_orders", set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Order):
+            order_ids.add(instance.id)
+        elif isinstance(instance, Item):
+            # the order it was moved from as well as the one it is in
+            order_ids.update(inspect(instance).attrs.order_id.history.sum())
+            order_ids.add(instance.order_id)
+    order_ids.discard(None)
+
+
+@event.listens_for(db.session, "after_bulk_update")
+@event.listens_for(db.session, "after_bulk_delete")
+def _collect_bulk_change(context):
+    """Remembers that a bulk statement changed orders the session cannot list"""
+    if context.mapper.class_ in (Order, Item):
+        context.session.info["cache_clear"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_changed_orders(session):
+    """Drops the orders a transaction changed once it is committed"""
+    order_ids = session.info.pop("cache_orders", set())
+    if session.info.pop("cache_clear", False):
+        order_cache.invalidate()
+    elif order_ids:
+        order_cache.invalidate(order_ids)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _forget_changed_orders(session, previous_transaction):
+    """Forgets the changes of a transaction that was rolled back
+
+    Rolling back to a savepoint keeps them, since dropping an order from the
+    cache that did not change only costs a read
+    """
+    if not previous_transaction.nested:
+        session.info.pop("cache_orders", None)
+        session.info.pop("cache_clear", None)
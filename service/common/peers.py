@@ -0,0 +1,356 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Peer Forwarding
+
+This module talks to the peer nodes listed in PEER_NODES. Work for every
+peer runs at the same time on a bounded worker pool so that a slow peer
+never holds up the others.
+
+Every peer gets its own keep-alive connection pool so connections (and TLS
+handshakes) are reused, and its own circuit breaker so that a peer which
+keeps failing is left alone for PEER_BREAKER_COOLDOWN seconds. A Session is
+not safe to share between threads, so each thread gets its own Session
+mounted on the peer's shared HTTPAdapter, whose pool is thread-safe.
+
+Each client also keeps the latency and outcome of its last
+PEER_METRICS_WINDOW requests for the peer metrics.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app as app
+
+logger = logging.getLogger("flask.app")
+
+_executor = None
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class PeerClient:
+    """A keep-alive connection pool to one peer guarded by a circuit breaker"""
+
+    def __init__(self, peer, threshold=3, cooldown=30.0, pool_size=8, window=1000):
+        self.peer = peer
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.total_successes = 0
+        self.total_failures = 0
+        self.opened_at = None
+        self.last_latency_ms = None
+        self.last_error = None
+        self.last_success_at = None
+        self.in_flight = 0
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    @property
+    def session(self):
+        """Returns the session of the calling thread, creating it on first use"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            session.headers["X-From-Peer"] = "true"
+            self._local.session = session
+        return session
+
+    def close(self):
+        """Closes every pooled connection to the peer"""
+        self.adapter.close()
+
+    def is_open(self):
+        """Returns True while the circuit is open and still cooling down"""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self):
+        """Returns True if a request may be sent to the peer right now
+
+        Once the cooldown has passed a single trial request is let through
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def started(self):
+        """Counts a request that was sent to the peer"""
+        with self._lock:
+            self.in_flight += 1
+
+    def _finished(self, latency_ms, ok):
+        """Records how a request that was sent to the peer went"""
+        self.in_flight = max(0, self.in_flight - 1)
+        if latency_ms is not None:
+            self.latencies.append(latency_ms)
+        self.outcomes.append(ok)
+
+    def record_success(self, latency_ms):
+        """Closes the circuit after a request went through"""
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Circuit to peer %s closed", self.peer)
+            self._finished(latency_ms, True)
+            self.state = CLOSED
+            self.failures = 0
+            self.total_successes += 1
+            self.last_latency_ms = latency_ms
+            self.last_success_at = datetime.now(timezone.utc)
+
+    def record_failure(self, error, latency_ms=None):
+        """Counts a failure and opens the circuit once there are too many"""
+        with self._lock:
+            self._finished(latency_ms, False)
+            self.failures += 1
+            self.total_failures += 1
+            self.last_error = str(error)
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    logger.warning(
+                        "Circuit to peer %s opened for %.1f s after %d failure(s)",
+                        self.peer,
+                        self.cooldown,
+                        self.failures,
+                    )
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def health(self):
+        """Returns the health of the peer as a dictionary"""
+        with self._lock:
+            return {
+                "peer": self.peer,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "total_successes": self.total_successes,
+                "total_failures": self.total_failures,
+                "last_latency_ms": self.last_latency_ms,
+                "last_error": self.last_error,
+                "last_success_at": (
+                    self.last_success_at.isoformat() if self.last_success_at else None
+                ),
+            }
+
+    def metrics(self):
+        """Returns the in-flight count, latency and error rate of recent requests"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            outcomes = list(self.outcomes)
+            return {
+                "peer": self.peer,
+                "state": self.state,
+                "in_flight": self.in_flight,
+                "requests": len(outcomes),
+                "error_rate": (
+                    outcomes.count(False) / len(outcomes) if outcomes else 0.0
+                ),
+                "latency_p50_ms": percentile(latencies, 50),
+                "latency_p99_ms": percentile(latencies, 99),
+            }
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of sorted values or None if empty"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+class PeerManager:
+    """Keeps one PeerClient per peer for the life of the process"""
+
+    def __init__(self, app=None):  # pylint: disable=redefined-outer-name
+        self.threshold = 3
+        self.cooldown = 30.0
+        self.pool_size = 8
+        self.window = 1000
+        self._clients = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):  # pylint: disable=redefined-outer-name
+        """Reads the circuit breaker settings from a Flask app"""
+        self.threshold = app.config["PEER_BREAKER_THRESHOLD"]
+        self.cooldown = app.config["PEER_BREAKER_COOLDOWN"]
+        self.pool_size = app.config["PEER_MAX_WORKERS"]
+        self.window = app.config["PEER_METRICS_WINDOW"]
+        app.extensions["peer_manager"] = self
+
+    def get(self, peer):
+        """Returns the client for a peer, creating it on first use"""
+        with self._lock:
+            client = self._clients.get(peer)
+            if client is None:
+                client = PeerClient(
+                    peer, self.threshold, self.cooldown, self.pool_size, self.window
+                )
+                self._clients[peer] = client
+            return client
+
+    def health(self, peers):
+        """Returns the health of every given peer"""
+        return [self.get(peer).health() for peer in peers]
+
+    def metrics(self, peers):
+        """Returns the request metrics of every given peer"""
+        return [self.get(peer).metrics() for peer in peers]
+
+    def reset(self):
+        """Closes every connection pool and forgets all peer health"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+manager = PeerManager()
+
+
+def get_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Returns the worker pool used to talk to peers, creating it on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="peer-forward"
+        )
+    return _executor
+
+
+def request_peer(
+    peer, method, path, json=None, params=None, deadline=None, timeout=2.0, headers=None
+):
+    """Sends a single request to a peer and logs how long it took
+
+    Args:
+        peer (string): the base URL of the peer
+        method (string): the HTTP method to use
+        path (string): the path of the resource on the peer
+        json (dict): the body of the request
+        params (dict): the query string of the request
+        deadline (float): time.monotonic() value after which we give up
+        timeout (float): the most to wait on this one peer in seconds
+        headers (dict): extra headers to send
+
+    Returns:
+        the response from the peer or None if it was not reached
+    """
+    url = f"{peer}{path}"
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            logger.warning("Skipped forward to %s: deadline exceeded", url)
+            return None
+
+    client = manager.get(peer)
+    if not client.allow():
+        logger.debug("Skipped forward to %s: circuit is open", url)
+        return None
+
+    client.started()
+    start = time.monotonic()
+    try:
+        response = client.session.request(
+            method, url, json=json, params=params, timeout=timeout, headers=headers
+        )
+    except requests.RequestException as error:
+        elapsed = (time.monotonic() - start) * 1000
+        client.record_failure(error, elapsed)
+        logger.error(
+            "Failed to sync with peer %s after %.1f ms: %s", peer, elapsed, error
+        )
+        return None
+
+    elapsed = (time.monotonic() - start) * 1000
+    if response.status_code >= 500:
+        client.record_failure(f"HTTP {response.status_code}", elapsed)
+    else:
+        client.record_success(elapsed)
+    logger.info(
+        "Forwarded %s %s → %s in %.1f ms", method, url, response.status_code, elapsed
+    )
+    return response
+
+
+def fetch_from_peer(peer, path, params=None, timeout=2.0):
+    """Reads a resource from a peer
+
+    Returns:
+        the decoded JSON body or None if the peer did not return it
+    """
+    response = request_peer(peer, "GET", path, params=params, timeout=timeout)
+    if response is None or response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError as error:
+        logger.error("Peer %s sent a bad body for %s: %s", peer, path, error)
+        return None
+
+
+def fan_out(task, *args, deadline=None, sync=None):
+    """Runs task(peer, *args) for every peer at the same time
+
+    Unless sync is set (it defaults to PEER_SYNC_FORWARD) this returns as
+    soon as the work is queued, otherwise it waits for every task to finish
+    or for the deadline to pass, whichever comes first.
+
+    Returns:
+        the list of futures, one per peer
+    """
+    peers = app.config.get("PEER_NODES", [])
+    if not peers:
+        return []
+
+    if deadline is None:
+        deadline = time.monotonic() + app.config["PEER_DEADLINE"]
+    executor = get_executor(app.config["PEER_MAX_WORKERS"])
+    futures = [executor.submit(task, peer, *args) for peer in peers]
+
+    if sync is None:
+        sync = app.config.get("PEER_SYNC_FORWARD")
+    if sync:
+        _, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        if not_done:
+            app.logger.warning(
+                "%d of %d peers did not answer before the deadline",
+                len(not_done),
+                len(peers),
+            )
+
+    return futures
@@ -0,0 +1,301 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Replication
+
+Applies batches of mutations sent by a peer. A mutation looks like:
+
+    {"seq": 12, "op": "patch", "entity": "order", "id": 5,
+     "data": {"fields": {"status": "SHIPPED"}, "field_versions": {"status": 7},
+              "updated_at": "..."}}
+
+"create" and "update" carry the whole record, "update" replacing the order
+and all of its items. "patch" carries only the changed fields. Item changes
+use the id of their order and name the item by its uid in the data.
+
+A batch is applied in order inside a single transaction. Each mutation runs
+in its own savepoint so one bad mutation is rejected without losing the rest.
+If the database itself fails nothing is applied and the sender retries the
+whole batch later.
+
+Replicated orders keep the created_at and updated_at of the node where the
+change was made, and a replicated delete keeps its deleted_at, so timestamps
+mean the same thing on every node when anti-entropy compares them.
+
+Records also keep the version the origin's hybrid logical clock gave the
+change, and each replicated field the version of its own last change. When
+two nodes change the same field at the same time the change with the higher
+version wins on both of them, and when they change different fields both
+changes are kept: a patch only sets the fields it changed later than the
+copy already here. A whole record older than the copy here is skipped.
+"""
+import logging
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.attributes import flag_modified
+
+from service.models import db, DataValidationError, Item, Order, OrderStatus, Tombstone
+
+logger = logging.getLogger("flask.app")
+
+
+def _keep_timestamps(record, data):
+    """Copies the timestamps and version of the origin node onto a record"""
+    for field in ("created_at", "updated_at"):
+        if data.get(field):
+            setattr(record, field, datetime.fromisoformat(data[field]))
+    if data.get("version"):
+        record.version = int(data["version"])
+        # marked even when equal so the record is not given a new version
+        flag_modified(record, "version")
+
+
+def _is_stale(record, data, redelivered=False):
+    """Returns True if a change is older than the copy of a record here
+
+    A patch with the same version as the record is a redelivery of the change
+    that made it; a whole record with the same version is a copy of it. A
+    change without a version comes from a node that does not keep them and
+    is applied as before.
+    """
+    if not data.get("version"):
+        return False
+    version, local = int(data["version"]), record.version or 0
+    return version <= local if redelivered else version < local
+
+
+# The fields a patch may set and how to read each of them
+ORDER_FIELDS = {"customer_name": str, "status": OrderStatus}
+ITEM_FIELDS = {"product_name": str, "quantity": int, "price": Decimal}
+
+
+def _field_versions(data, fields):
+    """Returns the version of each field of a change, that of the change if not given"""
+    version = int(data.get("version") or 0)
+    versions = data.get("field_versions") or {}
+    return {name: int(versions.get(name, version)) for name in fields}
+
+
+def _keep_field_versions(record, data, fields):
+    """Gives the fields of a whole replicated record the versions of the origin"""
+    record.field_versions = {
+        name: version for name, version in _field_versions(data, fields).items() if version
+    }
+
+
+def _patch_fields(record, data, allowed):
+    """Sets the fields of a patch that changed later than the copy here
+
+    A field whose version here is the same as the patch's is a redelivery
+    and one with a higher version a later change, and both are left alone.
+    The record keeps the higher of the two versions and its update time.
+
+    Returns:
+        True if any field was set
+    """
+    unknown = [name for name in data["fields"] if name not in allowed]
+    if unknown:
+        raise DataValidationError(f"Invalid patch: unknown field '{unknown[0]}'")
+    versions = _field_versions(data, data["fields"])
+    kept = dict(record.field_versions or {})
+    newer = [
+        name for name, version in versions.items() if not version or version > kept.get(name, 0)
+    ]
+    if not newer:
+        return False
+    for name in newer:
+        setattr(record, name, allowed[name](data["fields"][name]))
+        if versions[name]:
+            kept[name] = versions[name]
+    record.field_versions = kept
+    if _is_stale(record, data, redelivered=True):
+        # marked so the record is neither given a new version nor touched
+        flag_modified(record, "version")
+        flag_modified(record, "updated_at")
+    else:
+        _keep_timestamps(record, data)
+    return True
+
+
+def _keep_item_uids(order, data):
+    """Gives the items of a replicated order the uids, timestamps and versions of the origin"""
+    for item, item_data in zip(order.items, data.get("items", [])):
+        if item_data.get("uid"):
+            item.uid = item_data["uid"]
+        _keep_timestamps(item, item_data)
+        _keep_field_versions(item, item_data, ITEM_FIELDS)
+
+
+def _find_order(order_id):
+    """Returns an order that a change refers to"""
+    order = Order.find(order_id)
+    if order is None:
+        raise DataValidationError(f"Order {order_id} does not exist here")
+    return order
+
+
+def _find_item(order_id, data):
+    """Returns the item of an order with the uid named in a change, or None"""
+    return Item.query.filter_by(order_id=order_id, uid=data["uid"]).first()
+
+
+def _create_order(order_id, data):
+    """Creates an order unless it was already delivered"""
+    if Order.find(order_id) is not None:
+        return
+    order = Order()
+    order.deserialize(data)
+    order.id = order_id
+    _keep_item_uids(order, data)
+    _keep_timestamps(order, data)
+    _keep_field_versions(order, data, ORDER_FIELDS)
+    db.session.add(order)
+
+
+def _update_order(order_id, data):
+    """Replaces an order and its items with the replicated copy"""
+    order = Order.find(order_id)
+    if order is None:
+        _create_order(order_id, data)
+        return
+    if _is_stale(order, data):
+        return
+    for item in list(order.items):
+        db.session.delete(item)
+    order.items = []
+    db.session.flush()  # the new items may reuse the uids of the old ones
+    order.deserialize(data)
+    order.id = order_id
+    _keep_item_uids(order, data)
+    _keep_timestamps(order, data)
+    _keep_field_versions(order, data, ORDER_FIELDS)
+
+
+def _patch_order(order_id, data):
+    """Sets the changed fields of an order"""
+    _patch_fields(_find_order(order_id), data, ORDER_FIELDS)
+
+
+def _delete_order(order_id, data):
+    """Deletes an order if it is still there"""
+    order = Order.find(order_id)
+    if order is None:
+        return
+    db.session.delete(order)
+    if data and data.get("deleted_at"):
+        db.session.flush()  # writes the tombstone
+        tombstone = db.session.get(Tombstone, ("order", order_id))
+        tombstone.deleted_at = datetime.fromisoformat(data["deleted_at"])
+
+
+def _touch_order(order, data):
+    """Copies the updated_at and version the origin gave the order of a changed item
+
+    An order changed here since keeps its own and is touched as usual
+    """
+    order_data = {
+        "updated_at": data.get("order_updated_at"),
+        "version": data.get("order_version"),
+    }
+    if not _is_stale(order, order_data, redelivered=True):
+        _keep_timestamps(order, order_data)
+
+
+def _create_item(order_id, data):
+    """Adds an item to an order unless it was already delivered"""
+    order = _find_order(order_id)
+    if _find_item(order_id, data) is not None:
+        return
+    item = Item()
+    item.deserialize(data)
+    item.uid = data["uid"]
+    _keep_timestamps(item, data)
+    _keep_field_versions(item, data, ITEM_FIELDS)
+    order.items.append(item)
+    _touch_order(order, data)
+
+
+def _patch_item(order_id, data):
+    """Sets the changed fields of an item"""
+    item = _find_item(order_id, data)
+    if item is None:
+        raise DataValidationError(f"Item {data['uid']} of order {order_id} does not exist here")
+    if _patch_fields(item, data, ITEM_FIELDS):
+        _touch_order(item.order, data)
+
+
+def _delete_item(order_id, data):
+    """Deletes an item if it is still there"""
+    item = _find_item(order_id, data)
+    if item is not None:
+        _touch_order(item.order, data)
+        db.session.delete(item)
+
+
+APPLIERS = {
+    ("order", "create"): _create_order,
+    ("order", "update"): _update_order,
+    ("order", "patch"): _patch_order,
+    ("order", "delete"): _delete_order,
+    ("item", "create"): _create_item,
+    ("item", "patch"): _patch_item,
+    ("item", "delete"): _delete_item,
+}
+
+
+def apply_mutation(mutation):
+    """Applies a single mutation to the session without committing"""
+    try:
+        applier = APPLIERS[(mutation["entity"], mutation["op"])]
+        applier(int(mutation["id"]), mutation.get("data"))
+    except KeyError as error:
+        raise DataValidationError(
+            "Invalid mutation: unknown or missing " + str(error)
+        ) from error
+    except (TypeError, ValueError) as error:
+        raise DataValidationError("Invalid mutation: " + str(error)) from error
+
+
+def apply_mutations(mutations):
+    """Applies an ordered list of mutations in one transaction
+
+    Returns:
+        a tuple of (number applied, list of rejected mutation seq numbers)
+
+    Raises:
+        SQLAlchemyError: if the database failed and nothing was applied
+    """
+    applied = 0
+    rejected = []
+    try:
+        for mutation in mutations:
+            try:
+                with db.session.begin_nested():
+                    apply_mutation(mutation)
+                applied += 1
+            except (DataValidationError, DataError, IntegrityError, AttributeError) as error:
+                seq = mutation.get("seq") if isinstance(mutation, dict) else None
+                logger.error("Rejected replicated mutation %s: %s", seq, error)
+                rejected.append(seq)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    logger.info("Applied %d replicated mutation(s)", applied)
+    return applied, rejected
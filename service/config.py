@@ -4,6 +4,8 @@ Global Configuration for Application
 
 import os
 import logging
+import socket
+import zlib
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -26,4 +28,96 @@ API_KEY = os.getenv("API_KEY")
 ERROR_404_HELP = False
 
 # Peer nodes
-PEER_NODES = os.getenv("PEER_NODES", "").split(",")  # Comma-separated peer URLs
+PEER_NODES = [  # Comma-separated peer URLs
+    peer.strip() for peer in os.getenv("PEER_NODES", "").split(",") if peer.strip()
+]
+
+# Id of this node (0 to 1023) in the versions it gives to changes. Every node
+# needs a different one; by default it is derived from the host name
+NODE_ID = int(
+    os.getenv("NODE_ID", str(zlib.crc32(socket.gethostname().encode("utf-8")) % 1024))
+)
+
+# How long (seconds) the response to a request sent with an Idempotency-Key
+# is kept to answer retries of it, and how long its key stays reserved for a
+# request that is still running
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_KEY_PENDING_TTL = float(os.getenv("IDEMPOTENCY_KEY_PENDING_TTL", "60"))
+
+# Orders returned by one page of GET /api/orders unless the client asks for
+# fewer or more, and the most a client may ask for
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "100"))
+ORDERS_MAX_PAGE_SIZE = int(os.getenv("ORDERS_MAX_PAGE_SIZE", "1000"))
+# Orders read from the database at a time when streaming them
+ORDERS_STREAM_BATCH_SIZE = int(os.getenv("ORDERS_STREAM_BATCH_SIZE", "500"))
+# The most Orders one POST /api/orders:batchGet may ask for
+ORDERS_BATCH_GET_MAX_IDS = int(os.getenv("ORDERS_BATCH_GET_MAX_IDS", "1000"))
+
+# Order cache: where it is kept (memory://, mmap:///dev/shm/<file> shared by
+# the workers on a host, or redis://host:port/db shared by every worker), the
+# most Orders kept for reads by id (0 turns it off), how long (seconds) one is
+# served before it is read again, which is also how stale a change made by
+# another process can be with memory://, and the bytes an Order may take up
+# with mmap://. An Order takes about 250 bytes and 140 more per item, so
+# 2048 holds one with up to 13 items; /api/cache/metrics counts the larger
+# ones that were not cached as oversize
+ORDER_CACHE_URL = os.getenv("ORDER_CACHE_URL", "memory://")
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "10000"))
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "5"))
+ORDER_CACHE_ENTRY_SIZE = int(os.getenv("ORDER_CACHE_ENTRY_SIZE", "2048"))
+
+# Unknown order ids: how long (seconds) an id found missing is answered with
+# 404 from the order cache, and the Bloom filter of the ids that exist: how
+# many ids it is made for at first (0 turns it off) and the share of unknown
+# ids it lets through to the database
+ORDER_MISSING_TTL = float(os.getenv("ORDER_MISSING_TTL", "1"))
+ORDER_FILTER_CAPACITY = int(os.getenv("ORDER_FILTER_CAPACITY", "1000000"))
+ORDER_FILTER_ERROR_RATE = float(os.getenv("ORDER_FILTER_ERROR_RATE", "0.01"))
+
+# Change feed: the most changes in one page, the longest a long-poll may wait,
+# how often (seconds) to look for changes committed by other processes and
+# how long an event stream stays open before the client has to reconnect
+CHANGE_FEED_MAX_LIMIT = int(os.getenv("CHANGE_FEED_MAX_LIMIT", "1000"))
+CHANGE_FEED_MAX_WAIT = float(os.getenv("CHANGE_FEED_MAX_WAIT", "30"))
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "1"))
+CHANGE_FEED_STREAM_DURATION = float(os.getenv("CHANGE_FEED_STREAM_DURATION", "300"))
+
+# Change log: how long (seconds) to keep a change before it is pruned. A
+# reader further behind has to read the orders again
+CHANGE_LOG_RETENTION = float(os.getenv("CHANGE_LOG_RETENTION", "604800"))
+
+# Peer forwarding: per-peer timeout and overall deadline (seconds), the size
+# of the worker pool used to fan out, and whether the client response waits
+# for the peers to acknowledge
+PEER_TIMEOUT = float(os.getenv("PEER_TIMEOUT", "2"))
+PEER_DEADLINE = float(os.getenv("PEER_DEADLINE", "3"))
+PEER_MAX_WORKERS = int(os.getenv("PEER_MAX_WORKERS", "8"))
+PEER_SYNC_FORWARD = os.getenv("PEER_SYNC_FORWARD", "false").lower() == "true"
+
+# Outbox dispatcher: events per batch, how long to gather a burst of writes
+# into one batch, how often to look for work when idle and the exponential
+# backoff (seconds) applied to a failing peer
+OUTBOX_DISPATCHER = os.getenv("OUTBOX_DISPATCHER", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_BATCH_WINDOW = float(os.getenv("OUTBOX_BATCH_WINDOW", "0.2"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "60"))
+
+# Peer circuit breaker: consecutive failures before a peer is left alone and
+# how long (seconds) to wait before trying it again
+PEER_BREAKER_THRESHOLD = int(os.getenv("PEER_BREAKER_THRESHOLD", "3"))
+PEER_BREAKER_COOLDOWN = float(os.getenv("PEER_BREAKER_COOLDOWN", "30"))
+
+# Peer metrics: how many of the latest requests to each peer the latency
+# percentiles and error rate are taken over
+PEER_METRICS_WINDOW = int(os.getenv("PEER_METRICS_WINDOW", "1000"))
+
+# Anti-entropy repair: seconds between passes (0 turns it off), ids per leaf
+# bucket and children per node of the hash tree, how long a worker reuses the
+# stored tree while a peer walks it and how long to remember deleted orders
+ANTI_ENTROPY_INTERVAL = float(os.getenv("ANTI_ENTROPY_INTERVAL", "300"))
+ANTI_ENTROPY_BUCKET_SIZE = int(os.getenv("ANTI_ENTROPY_BUCKET_SIZE", "1024"))
+ANTI_ENTROPY_FANOUT = int(os.getenv("ANTI_ENTROPY_FANOUT", "16"))
+ANTI_ENTROPY_TREE_TTL = float(os.getenv("ANTI_ENTROPY_TREE_TTL", "30"))
+ANTI_ENTROPY_TOMBSTONE_TTL = float(os.getenv("ANTI_ENTROPY_TOMBSTONE_TTL", "604800"))
@@ -3,5 +3,16 @@ Defined model information
 """
 
 from .persistent_base import db, DataValidationError, PersistentBase
+from .clock import clock
 from .item import Item
 from .order import Order, OrderStatus
+from .order_filter import OrderFilter
+from .change_log import Change, ChangeHorizon
+from .outbox import OutboxDelivery, OutboxEvent, PeerCursor
+from .tombstone import Tombstone
+from .merkle import MerkleLeaf
+from .lease import JobLease
+from .idempotency import IdempotencyKey
+from .stats import OrderStat
+from .indexes import create_indexes, missing_indexes
+from .columns import add_columns, missing_columns
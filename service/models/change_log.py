@@ -0,0 +1,138 @@
+"""
+Change log
+
+An append-only log of every change committed to the orders and items on
+this node, whether it was made here or replicated from a peer. Entries are
+numbered in commit order: the transaction that writes them holds a lock from
+the moment their numbers are taken until it commits, so a reader that has
+seen entry N will never later find a new entry below N.
+
+The payload of an entry has the same shape as a replicated change.
+
+Old entries are pruned after CHANGE_LOG_RETENTION seconds. The cursor of
+the newest entry pruned is kept as the horizon of the log: a reader whose
+cursor is below it has missed changes and has to read the orders again.
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import event, func, select, text
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+# Key of the transaction-level advisory lock that orders the log
+LOCK_KEY = 0x636C6F67
+
+_written = threading.Condition()
+
+
+class ChangeRecord:  # pylint: disable=too-few-public-methods
+    """Columns of a change to an order or item, shared by the log and the outbox"""
+
+    op = db.Column(db.String(8), nullable=False)
+    entity = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False
+    )
+
+
+class Change(db.Model, ChangeRecord):
+    """Class that represents one committed change"""
+
+    __tablename__ = "change_log"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+
+    def __repr__(self):
+        return f"<Change id={self.id} {self.op} {self.entity} {self.entity_id}>"
+
+    def serialize(self):
+        """Converts a Change into a dictionary"""
+        return {
+            "cursor": self.id,
+            "op": self.op,
+            "entity": self.entity,
+            "id": self.entity_id,
+            "data": self.payload,
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @staticmethod
+    def lock(session):
+        """Holds back other writers of the log until this transaction ends"""
+        if session.get_bind().dialect.name == "postgresql":
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+
+    @classmethod
+    def since(cls, cursor, limit):
+        """Returns up to limit changes committed after the given cursor"""
+        return cls.query.filter(cls.id > cursor).order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def newest(cls):
+        """Returns the cursor of the newest change, 0 if there is none"""
+        return db.session.scalar(select(func.max(cls.id))) or 0
+
+    @classmethod
+    def prune(cls, older_than):
+        """Deletes the changes committed before the given time
+
+        Returns:
+            the number of changes deleted
+        """
+        cutoff = db.session.scalar(select(func.max(cls.id)).where(cls.created_at < older_than))
+        if cutoff is None:
+            db.session.rollback()
+            return 0
+        count = cls.query.filter(cls.id <= cutoff).delete(synchronize_session=False)
+        ChangeHorizon.advance(cutoff)
+        db.session.commit()
+        logger.info("Pruned %d change(s) up to cursor %d", count, cutoff)
+        return count
+
+    @staticmethod
+    def wait(timeout):
+        """Waits until this process commits a change or the timeout passes"""
+        with _written:
+            _written.wait(timeout)
+
+
+class ChangeHorizon(db.Model):
+    """Class that remembers how far the change log was pruned"""
+
+    __tablename__ = "change_log_horizon"
+
+    id = db.Column(db.Integer, primary_key=True)
+    cursor = db.Column(db.BigInteger, nullable=False, default=0)
+    pruned_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<ChangeHorizon cursor={self.cursor}>"
+
+    @staticmethod
+    def current():
+        """Returns the cursor of the newest change pruned, 0 if none was"""
+        return db.session.scalar(select(ChangeHorizon.cursor)) or 0
+
+    @classmethod
+    def advance(cls, cursor):
+        """Records in this transaction that the changes up to a cursor were pruned"""
+        horizon = db.session.get(cls, 1, with_for_update=True)
+        if horizon is None:
+            horizon = cls(id=1, cursor=0)
+            db.session.add(horizon)
+        horizon.cursor = max(horizon.cursor, cursor)
+        horizon.pruned_at = datetime.now(timezone.utc)
+
+
+@event.listens_for(db.session, "after_commit")
+def _wake_readers(session):
+    """Wakes the readers waiting for new changes"""
+    if session.info.pop("changes_written", False):
+        with _written:
+            _written.notify_all()
@@ -0,0 +1,78 @@
+"""
+Hybrid logical clock
+
+Every change to a record is stamped with a version from this clock. A
+version packs the wall clock in milliseconds, a counter for changes made
+within the same millisecond and the id of the node that made the change
+into one 63 bit integer, so versions from different nodes never tie and
+comparing two of them needs no coordination.
+
+The clock never runs behind a version it has seen from a peer, so a change
+made after receiving a replicated write always wins over that write even
+when the two nodes' wall clocks disagree.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+NODE_BITS = 10
+COUNTER_BITS = 12
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_COUNTER = (1 << COUNTER_BITS) - 1
+
+
+def encode(millis, counter, node_id):
+    """Packs the parts of a version into one integer"""
+    return (millis << (COUNTER_BITS + NODE_BITS)) | (counter << NODE_BITS) | node_id
+
+
+def decode(version):
+    """Returns the (millis, counter, node_id) of a version"""
+    return (
+        version >> (COUNTER_BITS + NODE_BITS),
+        (version >> NODE_BITS) & MAX_COUNTER,
+        version & MAX_NODE_ID,
+    )
+
+
+class HybridLogicalClock:
+    """Hands out versions that only ever move forward"""
+
+    def __init__(self, node_id=0, wall=None):
+        self.node_id = node_id
+        self._wall = wall or (lambda: int(time.time() * 1000))
+        self._millis = 0
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Takes the id of this node from the app configuration"""
+        node_id = app.config["NODE_ID"]
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"NODE_ID must be from 0 to {MAX_NODE_ID}")
+        self.node_id = node_id
+
+    def now(self):
+        """Returns a version later than every one handed out or seen so far"""
+        with self._lock:
+            wall = self._wall()
+            if wall > self._millis:
+                self._millis, self._counter = wall, 0
+            elif self._counter < MAX_COUNTER:
+                self._counter += 1
+            else:
+                # too many changes in one millisecond: borrow the next one
+                self._millis, self._counter = self._millis + 1, 0
+            return encode(self._millis, self._counter, self.node_id)
+
+    def observe(self, version):
+        """Moves the clock past a version received from a peer"""
+        millis, counter, _ = decode(version)
+        with self._lock:
+            (self._millis, self._counter) = max((self._millis, self._counter), (millis, counter))
+
+
+clock = HybridLogicalClock()
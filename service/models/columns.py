@@ -0,0 +1,129 @@
+"""
+Column management
+
+db.create_all() creates only the tables a database does not have, so a
+column added to a model later never reaches a database that already has
+the table, and every query that reads the model fails on it. add_columns()
+adds every column the models define that the database is missing, and runs
+whenever db.create_all() does, so the app brings its own tables up to date
+as it starts.
+
+A column with a server default is added with it, which fills in the rows
+already there at once. Any other column is added as nullable, filled in
+from its Python default, row by row when that default is a function like
+the uid of an item, and only then made NOT NULL and unique if the model
+says so. The indexes of a new column are left to create_indexes().
+"""
+
+import logging
+
+from sqlalchemy import and_, bindparam, event, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+# rows given a value from a Python function per statement
+BATCH_SIZE = 1000
+
+
+def missing_columns(bind=None):
+    """Returns the columns the models define that the tables in the database lack"""
+    inspector = inspect(bind or db.engine)
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing)
+    return missing
+
+
+def _add(connection, column):
+    """Adds a column to its table, with its server default if it has one"""
+    if column.server_default is not None:
+        definition = CreateColumn(column).compile(dialect=connection.dialect)
+    else:
+        kind = column.type.compile(dialect=connection.dialect)
+        definition = f'"{column.name}" {kind}'
+    exists = "IF NOT EXISTS " if connection.dialect.name == "postgresql" else ""
+    connection.execute(text(f'ALTER TABLE "{column.table.name}" ADD COLUMN {exists}{definition}'))
+
+
+def _fill(connection, column):
+    """Gives the rows already in the table the Python default of a column
+
+    Returns:
+        the number of rows filled in
+    """
+    default = column.default
+    if default is None or not (default.is_scalar or default.is_callable):
+        return 0
+    table = column.table
+    if default.is_scalar:
+        return connection.execute(
+            table.update().where(column.is_(None)).values({column.name: default.arg})
+        ).rowcount
+
+    keys = list(table.primary_key.columns)
+    match = and_(*(key == bindparam(f"key_{key.name}") for key in keys))
+    statement = table.update().where(match).values({column.name: bindparam("value")})
+    rows = connection.execute(select(*keys).where(column.is_(None))).all()
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(
+            statement,
+            [
+                {**{f"key_{key.name}": value for key, value in zip(keys, row)}, "value": default.arg(None)}
+                for row in rows[start:start + BATCH_SIZE]
+            ],
+        )
+    return len(rows)
+
+
+def _constrain(connection, column):
+    """Makes a filled in column NOT NULL and unique as the model says
+
+    Only PostgreSQL can change a column that is already there
+    """
+    if connection.dialect.name != "postgresql" or column.server_default is not None:
+        return
+    table = column.table.name
+    if not column.nullable:
+        connection.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN "{column.name}" SET NOT NULL'))
+    if column.unique:
+        # named as PostgreSQL names the constraint db.create_all() makes
+        connection.execute(
+            text(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_{column.name}_key" ON "{table}" ("{column.name}")')
+        )
+
+
+def add_columns(bind=None):
+    """Adds the missing columns in one transaction
+
+    Args:
+        bind: an engine, or a connection whose transaction to add them in
+
+    Returns:
+        the names of the columns that were added, as "table.column"
+    """
+    bind = bind or db.engine
+    if isinstance(bind, Engine):
+        with bind.begin() as connection:
+            return add_columns(connection)
+    added = []
+    for column in missing_columns(bind):
+        logger.warning("Adding column %s.%s", column.table.name, column.name)
+        _add(bind, column)
+        filled = _fill(bind, column)
+        if filled:
+            logger.info("Filled in %s.%s for %d row(s)", column.table.name, column.name, filled)
+        _constrain(bind, column)
+        added.append(f"{column.table.name}.{column.name}")
+    return added
+
+
+@event.listens_for(db.metadata, "after_create")
+def _add_missing_columns(metadata, connection, **kw):  # pylint: disable=unused-argument
+    """Adds the columns the tables db.create_all() did not make are missing"""
+    add_columns(connection)
@@ -0,0 +1,118 @@
+"""
+Idempotency keys
+
+Remembers the response to a request sent with an Idempotency-Key header so
+that a retry of the same request is answered from here instead of being
+applied a second time. Keys are stored as a digest so every row is the same
+small size however long the client's key is, and they expire after a while.
+
+A key is reserved before its request runs, with the status code 102
+Processing, so a retry that arrives while the first request is still
+running finds it taken. A reservation expires on its own if the process
+running the request dies.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import IntegrityError
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+# the status code of a key whose request has not finished yet
+PROCESSING = 102
+
+
+class IdempotencyKey(db.Model):
+    """Class that represents the stored response to a request"""
+
+    __tablename__ = "idempotency_key"
+
+    key = db.Column(db.String(40), primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False)
+    status_code = db.Column(db.SmallInteger, nullable=False)
+    body = db.Column(db.JSON, nullable=True)
+    location = db.Column(db.String(255), nullable=True)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} → {self.status_code}>"
+
+    @property
+    def processing(self):
+        """True while the request that reserved the key has not finished"""
+        return self.status_code == PROCESSING
+
+    @classmethod
+    def find(cls, key):
+        """Returns the stored response for a key unless it has expired"""
+        stored = db.session.get(cls, key)
+        if stored is None:
+            return None
+        expires_at = stored.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return stored if expires_at > datetime.now(timezone.utc) else None
+
+    @classmethod
+    def reserve(cls, key, fingerprint, ttl):
+        """Takes a key for a request about to run, dropping keys that have expired
+
+        Args:
+            ttl (float): seconds until the reservation lapses if it is not completed
+
+        Returns:
+            the reserved key, or None if another request holds it
+        """
+        now = datetime.now(timezone.utc)
+        cls.query.filter(cls.expires_at <= now).delete(synchronize_session="fetch")
+        reserved = cls(
+            key=key,
+            fingerprint=fingerprint,
+            status_code=PROCESSING,
+            expires_at=now + timedelta(seconds=ttl),
+        )
+        db.session.add(reserved)
+        try:
+            db.session.flush()
+            # kept out of the session so that it outlives the request's commits
+            db.session.expunge(reserved)
+            db.session.commit()
+        except IntegrityError:
+            # a retry racing with this request reserved it first
+            db.session.rollback()
+            return None
+        return reserved
+
+    def complete(self, status_code, body, location, ttl):
+        """Stores the response to the request that reserved the key
+
+        Nothing is stored if the reservation lapsed and another request took the key
+        """
+        db.session.rollback()
+        self._reservation().update(
+            {
+                "status_code": status_code,
+                "body": body,
+                "location": location,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    def release(self):
+        """Gives up the key of a request that failed, so it can be retried"""
+        db.session.rollback()
+        self._reservation().delete(synchronize_session=False)
+        db.session.commit()
+
+    def _reservation(self):
+        """Returns a query for this reservation, unless it lapsed and was taken over"""
+        cls = type(self)
+        return cls.query.filter(
+            cls.key == self.key,
+            cls.status_code == PROCESSING,
+            cls.expires_at == self.expires_at,
+        )
@@ -0,0 +1,160 @@
+"""
+Index management
+
+db.create_all() builds the indexes of a table only when it creates the
+table, so an index added to a model later never reaches a database that
+already has the table. create_indexes() builds every index the models
+define that the database is missing.
+
+On PostgreSQL each index is built CONCURRENTLY, which does not block
+writes to the table while it is built. A concurrent build that failed
+leaves an invalid index behind; it is dropped and built again.
+
+Trigram indexes need the pg_trgm extension. They are built, and the
+extension installed, only on PostgreSQL servers that ship it; elsewhere
+the searches they serve read the table instead.
+"""
+
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+TRIGRAM = "pg_trgm"
+
+AVAILABLE_EXTENSION = text(
+    "SELECT installed_version FROM pg_available_extensions WHERE name = :name"
+)
+
+INVALID_INDEXES = text(
+    "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+    "WHERE NOT i.indisvalid"
+)
+
+
+# extensions known to be installed, by database URL
+_installed = set()
+
+
+def _extension_available(connection, name):
+    """Says whether the database server can install an extension"""
+    if connection.dialect.name != "postgresql":
+        return False
+    return connection.execute(AVAILABLE_EXTENSION, {"name": name}).first() is not None
+
+
+def _install_extension(connection, name):
+    """Installs an extension unless it already is"""
+    logger.info("Installing the %s extension", name)
+    connection.execute(text(f'CREATE EXTENSION IF NOT EXISTS "{name}"'))
+
+
+def has_extension(name, engine=None):
+    """Says whether an extension is installed in the database"""
+    engine = engine or db.engine
+    if (engine.url, name) in _installed:
+        return True
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as connection:
+        row = connection.execute(AVAILABLE_EXTENSION, {"name": name}).first()
+    if row is None or row.installed_version is None:
+        return False
+    _installed.add((engine.url, name))
+    return True
+
+
+def _extension_ready(ddl, index, bind, **kw):  # pylint: disable=unused-argument
+    """Lets db.create_all() build an index only if its extension can be had"""
+    if bind is None:
+        return True
+    name = index.info["extension"]
+    if not _extension_available(bind, name):
+        logger.warning("Skipping index %s: the %s extension is not available", index.name, name)
+        return False
+    _install_extension(bind, name)
+    return True
+
+
+def trigram_index(name, column):
+    """Returns a trigram index for case-insensitive substring and fuzzy matches"""
+    return db.Index(
+        name,
+        column,
+        postgresql_using="gin",
+        postgresql_ops={column: "gin_trgm_ops"},
+        info={"extension": TRIGRAM},
+    ).ddl_if(dialect="postgresql", callable_=_extension_ready)
+
+
+def _buildable(connection, index):
+    """Says whether an index can be built on this database"""
+    extension = index.info.get("extension")
+    return extension is None or _extension_available(connection, extension)
+
+
+def _invalid_indexes(connection):
+    """Returns the names of the indexes a failed concurrent build left behind"""
+    if connection.dialect.name != "postgresql":
+        return set()
+    return set(connection.execute(INVALID_INDEXES).scalars())
+
+
+def _create(connection, index):
+    """Builds one index without blocking writes where the database can"""
+    concurrently = connection.dialect.name == "postgresql"
+    index.dialect_kwargs["postgresql_concurrently"] = concurrently
+    try:
+        connection.execute(CreateIndex(index))
+    finally:
+        del index.dialect_kwargs["postgresql_concurrently"]
+
+
+def missing_indexes(engine=None):
+    """Returns the indexes the models define that the database lacks
+
+    Returns:
+        a tuple of (list of missing Index, set of names of invalid indexes)
+    """
+    engine = engine or db.engine
+    with engine.connect() as connection:
+        inspector = inspect(connection)
+        invalid = _invalid_indexes(connection)
+        missing = []
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            missing.extend(
+                index
+                for index in sorted(table.indexes, key=lambda index: index.name)
+                if (index.name not in existing or index.name in invalid)
+                and _buildable(connection, index)
+            )
+        return missing, invalid
+
+
+def create_indexes(engine=None):
+    """Builds the missing indexes one at a time
+
+    Returns:
+        the names of the indexes that were built
+    """
+    engine = engine or db.engine
+    missing, invalid = missing_indexes(engine)
+    built = []
+    # a concurrent build cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for index in missing:
+            if index.name in invalid:
+                logger.warning("Dropping invalid index %s", index.name)
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+            if "extension" in index.info:
+                _install_extension(connection, index.info["extension"])
+            logger.info("Building index %s on %s", index.name, index.table.name)
+            _create(connection, index)
+            built.append(index.name)
+    return built
@@ -3,7 +3,9 @@ Properties and functions for Item
 """
 
 import logging
+from uuid import uuid4
 from .persistent_base import db, PersistentBase, DataValidationError
+from .indexes import trigram_index
 
 logger = logging.getLogger("flask.app")
 
@@ -12,6 +14,10 @@ class Item(db.Model, PersistentBase):
     """Class that represents an Item"""
 
     id = db.Column(db.Integer, primary_key=True)
+    # the same on every node, unlike id which each node assigns itself
+    uid = db.Column(
+        db.String(32), unique=True, nullable=False, default=lambda: uuid4().hex
+    )
     order_id = db.Column(
         db.Integer, db.ForeignKey("order.id", ondelete="CASCADE"), nullable=False
     )
@@ -19,6 +25,13 @@ class Item(db.Model, PersistentBase):
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
 
+    # items are read by their order, and orders are found by their products
+    __table_args__ = (
+        db.Index("ix_item_order_id", "order_id"),
+        db.Index("ix_item_product_name", "product_name", "order_id"),
+        trigram_index("ix_item_product_name_trgm", "product_name"),
+    )
+
     def __repr__(self):
         return f"<Item id={self.id} product_name=[{self.product_name}] order_id={self.order_id} price={self.price}>"
 
@@ -26,12 +39,14 @@ class Item(db.Model, PersistentBase):
         """Converts an Item into a dictionary"""
         return {
             "id": self.id,
+            "uid": self.uid,
             "order_id": self.order_id,
             "product_name": self.product_name,
             "quantity": self.quantity,
             "price": self.price,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
+            "version": self.version,
         }
 
     def deserialize(self, data):
@@ -0,0 +1,79 @@
+"""
+Leases for background jobs
+
+Every worker process starts the same background threads. A JobLease makes
+sure only one of them runs a given job at a time: the holder renews the
+lease on every pass and another process takes over once it expires.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import IntegrityError
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+
+def _aware(when):
+    """Treats a timestamp without a zone as UTC"""
+    return when if when is None or when.tzinfo else when.replace(tzinfo=timezone.utc)
+
+
+class JobLease(db.Model):
+    """Class that represents the right to run a background job"""
+
+    __tablename__ = "job_lease"
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(255), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    completed_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<JobLease {self.name} held by {self.holder}>"
+
+    @classmethod
+    def acquire(cls, name, holder, ttl):
+        """Takes or renews a lease
+
+        Args:
+            name (string): the name of the job
+            holder (string): who wants to run it
+            ttl (float): seconds until the lease can be taken by someone else
+
+        Returns:
+            True if the holder now owns the lease
+        """
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=ttl)
+        lease = cls.query.filter_by(name=name).with_for_update().first()
+        if lease is None:
+            db.session.add(cls(name=name, holder=holder, expires_at=expires_at))
+        elif lease.holder == holder or _aware(lease.expires_at) <= now:
+            lease.holder = holder
+            lease.expires_at = expires_at
+        else:
+            db.session.rollback()
+            return False
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another process created the lease first
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def complete(cls, name, holder):
+        """Records that the holder finished a run of the job"""
+        lease = db.session.get(cls, name)
+        if lease is not None and lease.holder == holder:
+            lease.completed_at = datetime.now(timezone.utc)
+            db.session.commit()
+
+    @classmethod
+    def completed_at_of(cls, name):
+        """Returns when the job last finished or None if it never did"""
+        lease = db.session.get(cls, name)
+        return _aware(lease.completed_at) if lease is not None else None
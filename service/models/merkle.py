@@ -0,0 +1,39 @@
+"""
+Leaf hashes of the anti-entropy hash tree
+
+The leaves are rebuilt by a single background repairer per node and stored
+here so that every worker process can answer peers from the same tree
+without scanning the order table itself.
+"""
+
+import logging
+
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+
+class MerkleLeaf(db.Model):
+    """Class that represents the hash of one bucket of orders"""
+
+    __tablename__ = "merkle_leaf"
+
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    hash = db.Column(db.String(40), nullable=False)
+
+    def __repr__(self):
+        return f"<MerkleLeaf bucket={self.bucket} hash={self.hash}>"
+
+    @classmethod
+    def load(cls):
+        """Returns {bucket: hash} for every non-empty bucket"""
+        return dict(db.session.query(cls.bucket, cls.hash))
+
+    @classmethod
+    def replace(cls, leaves):
+        """Replaces every stored leaf with the given {bucket: hash}"""
+        cls.query.delete()
+        db.session.bulk_insert_mappings(
+            cls, [{"bucket": bucket, "hash": value} for bucket, value in leaves.items()]
+        )
+        db.session.commit()
@@ -3,31 +3,35 @@ Defined properties and methods of the order model
 """
 
 import logging
-from enum import Enum
+from datetime import date, datetime, timezone
+from itertools import chain
+
+from sqlalchemy import event, inspect, select, tuple_
+from sqlalchemy.orm import joinedload, load_only, selectinload
 from .persistent_base import db, PersistentBase, DataValidationError
+from .indexes import trigram_index
 from .item import Item
+from .order_filter import OrderFilter
+from .order_status import OrderStatus
 
 logger = logging.getLogger("flask.app")
 
-
-class OrderStatus(Enum):
-    """Enumeration of valid order statuses"""
-
-    CREATED = "CREATED"
-    IN_PROGRESS = "IN_PROGRESS"
-    SHIPPED = "SHIPPED"
-    COMPLETED = "COMPLETED"
-    CANCELLED = "CANCELLED"
-
-    @staticmethod
-    def list():
-        """Lists different order statuses"""
-        return list(map(lambda s: s.value, OrderStatus))
+DEFAULT_SORT = "created_at"
 
 
 class Order(db.Model, PersistentBase):
     """Class that represents an Order"""
 
+    # the orderings a list can come in, each read straight from an index
+    SORTS = {
+        "created_at": ("created_at", "id"),
+        "updated_at": ("updated_at", "id"),
+        "customer_name": ("customer_name", "created_at", "id"),
+    }
+
+    # the fields of a serialized Order, in the order they are written
+    FIELDS = ("id", "customer_name", "status", "created_at", "updated_at", "version", "items")
+
     # Table Schema
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=False)
@@ -35,26 +39,47 @@ class Order(db.Model, PersistentBase):
     status = db.Column(
         db.Enum(OrderStatus), default=OrderStatus.CREATED, nullable=False
     )
-    items = db.relationship("Item", backref="order", passive_deletes=True)
+    # the database deletes the items of a deleted order, even loaded ones;
+    # they are listed by id so a version of an Order always reads the same
+    items = db.relationship("Item", backref="order", passive_deletes="all", order_by="Item.id")
+
+    # every sort in SORTS has an index of its own; the status and customer
+    # indexes also serve a filter and the created_at order at once
+    __table_args__ = (
+        db.Index("ix_order_created_at_id", "created_at", "id"),
+        db.Index("ix_order_updated_at_id", "updated_at", "id"),
+        db.Index("ix_order_status_created_at", "status", "created_at", "id"),
+        db.Index("ix_order_customer_name_created_at", "customer_name", "created_at", "id"),
+        trigram_index("ix_order_customer_name_trgm", "customer_name"),
+    )
 
     def __repr__(self):
         return f"<Order id={self.id} by {self.customer_name}>"
 
-    def serialize(self):
-        """Converts an Order into a dictionary"""
-        if not isinstance(self.status, OrderStatus):
+    def serialize(self, fields=None):
+        """Converts an Order into a dictionary
+
+        Args:
+            fields (list): the fields to include, all of them if not given
+        """
+        fields = self.FIELDS if fields is None else fields
+        if "status" in fields and not isinstance(self.status, OrderStatus):
             raise DataValidationError(
                 f"Invalid status value '{self.status}' not in OrderStatus Enum"
             )
 
-        return {
-            "id": self.id,
-            "customer_name": self.customer_name,
-            "status": self.status.value,
-            "created_at": self.created_at.isoformat(),
-            "updated_at": self.updated_at.isoformat(),
-            "items": [item.serialize() for item in self.items],
-        }
+        return {field: self._serialize_field(field) for field in fields}
+
+    def _serialize_field(self, field):
+        """Returns the serialized value of one field"""
+        if field == "items":
+            return [item.serialize() for item in self.items]
+        value = getattr(self, field)
+        if isinstance(value, OrderStatus):
+            return value.value
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
 
     def deserialize(self, data):
         """Populates an Order from a dictionary"""
@@ -88,22 +113,192 @@ class Order(db.Model, PersistentBase):
         return self
 
     @classmethod
-    def find_by_filters(cls, customer_name=None, order_status=None, product_name=None):
+    def find(  # pylint: disable=too-many-arguments
+        cls, by_id, with_items=False, fields=None, keys=(), for_update=False
+    ):
+        """Finds an Order by its ID
+
+        Args:
+            by_id (int): the id of the Order
+            with_items (bool): join the items in when they will be read anyway
+            fields (list): read only these fields, and the items only if
+                they are one of them
+            keys (tuple): more columns to read along with the fields
+            for_update (bool): lock the Order until the transaction ends
+        """
+        logger.info("Processing lookup for id %s ...", by_id)
+        if fields is not None:
+            options = cls._load_options(fields, joinedload, keys)
+        else:
+            options = [joinedload(cls.items)] if with_items else []
+        return db.session.get(cls, by_id, options=options, with_for_update=for_update or None)
+
+    @classmethod
+    def find_version(cls, by_id):
+        """Returns the version and update time of an Order without loading it
+
+        Returns:
+            a (version, updated_at) row, or None if there is no such Order
+        """
+        return db.session.execute(
+            select(cls.version, cls.updated_at).where(cls.id == by_id)
+        ).first()
+
+    @classmethod
+    def find_many(cls, ids, fields=None):
+        """Returns the Orders with any of the given ids
+
+        The Orders are read with one IN query and their items with one more
+
+        Args:
+            ids (list): the ids of the Orders
+            fields (list): read only these fields, all of them if not given
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        options = cls._load_options(fields, selectinload)
+        return cls.query.options(*options).filter(cls.id.in_(ids)).all()
+
+    @classmethod
+    def all(cls):
+        """Returns all of the Orders with their items"""
+        logger.info("Processing all records")
+        return cls._filtered().all()
+
+    @classmethod
+    def find_by_filters(cls, customer_name=None, order_status=None, product_name=None, **filters):
         """Returns all Orders with the given filters
         Args:
             customer_name (string): the name of the customer whose orders you want
-            order_status (string): the status of orders you want
+            order_status (string): the statuses of orders you want, comma separated
             product_name (string): the product_name of orders you want
+            filters: any other filters an OrderFilter takes
+        """
+        return cls._filtered(
+            customer_name=customer_name,
+            order_status=order_status,
+            product_name=product_name,
+            **filters,
+        ).all()
+
+    @classmethod
+    def find_page(  # pylint: disable=too-many-arguments
+        cls, limit, after=None, fields=None, sort=DEFAULT_SORT, **filters
+    ):
+        """Returns a page of the Orders with the given filters
+
+        Orders come in the order of the sort, ties broken by id, and a page
+        starts right after the sort key of the last order of the previous
+        page, so every page is read straight from an index however deep it
+        is.
+
+        Args:
+            limit (int): the most orders to return
+            after (tuple): the sort key of the last order already seen
+            fields (list): read only these fields, all of them if not given
+            sort (str): one of SORTS, with a leading "-" for descending
+            filters: the filters an OrderFilter takes
+
+        Returns:
+            a tuple of (list of orders, True if there are more after them)
+        """
+        orders = cls._listing(after, fields, sort, filters).limit(limit + 1).all()
+        return orders[:limit], len(orders) > limit
+
+    @classmethod
+    def stream(  # pylint: disable=too-many-arguments
+        cls, after=None, batch_size=500, fields=None, sort=DEFAULT_SORT, **filters
+    ):
+        """Returns a query that reads the Orders with the given filters as it is iterated
+
+        The filters are checked at once, but nothing is read until the
+        iteration starts.
+
+        Rows are read through a server-side cursor batch_size at a time, with
+        the items of each batch read in one more query, so memory use stays
+        flat however many Orders match.
+
+        Args:
+            after (tuple): the sort key of the last order already seen
+            batch_size (int): how many orders to read at a time
+            fields (list): read only these fields, all of them if not given
+            sort (str): one of SORTS, with a leading "-" for descending
+            filters: the filters an OrderFilter takes
+        """
+        return cls._listing(after, fields, sort, filters).yield_per(batch_size)
+
+    @classmethod
+    def sort_key(cls, sort):
+        """Returns the columns a sort orders by and whether it is descending
+
+        Raises:
+            DataValidationError: if the sort is not one of SORTS
         """
-        query = cls.query
-        if customer_name:
-            query = query.filter(cls.customer_name == customer_name)
-        if order_status:
-            order_status = order_status.upper()
-            if order_status in OrderStatus.list():
-                query = query.filter(cls.status == OrderStatus[order_status])
-            else:
-                query = query.filter(False)
-        if product_name:
-            query = query.join(Item).filter(Item.product_name == product_name)
-        return query.all()
+        descending = sort.startswith("-")
+        columns = cls.SORTS.get(sort[1:] if descending else sort)
+        if columns is None:
+            sorts = ", ".join(cls.SORTS)
+            raise DataValidationError(f"Invalid sort '{sort}': must be one of {sorts}, each may start with -")
+        return columns, descending
+
+    @classmethod
+    def _listing(cls, after, fields, sort, filters):
+        """Returns the query for a list of Orders in sort order after a key"""
+        columns, descending = cls.sort_key(sort)
+        query = cls._filtered(fields=fields, keys=columns, **filters)
+        key = tuple_(*(getattr(cls, column) for column in columns))
+        if after is not None:
+            query = query.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+        return query.order_by(
+            *(getattr(cls, column).desc() if descending else getattr(cls, column) for column in columns)
+        )
+
+    @classmethod
+    def _filtered(cls, fields=None, keys=(), **filters):
+        """Returns a query for the Orders with the given filters
+
+        The items of all the Orders are read in one batched IN query, so a
+        list costs the same number of queries however long it is
+
+        Args:
+            fields (list): read only these fields, all of them if not given
+            keys (tuple): more columns to read, such as those of the sort
+            filters: the filters an OrderFilter takes
+        """
+        conditions = OrderFilter(**filters).conditions(cls)
+        return cls.query.options(*cls._load_options(fields, selectinload, keys)).filter(*conditions)
+
+    @classmethod
+    def _load_options(cls, fields, load_items, keys=()):
+        """Returns the loader options that read only the given fields
+
+        The keys are read as well, since a list cursor is made of them, and
+        the items are read with load_items only if they are asked for.
+        """
+        if fields is None:
+            return [load_items(cls.items)]
+        names = dict.fromkeys([*keys, *fields])
+        columns = [getattr(cls, name) for name in names if name != "items"]
+        options = [load_only(*columns)]
+        if "items" in fields:
+            options.append(load_items(cls.items))
+        return options
+
+
+@event.listens_for(db.session, "before_flush")
+def _touch_orders(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Moves an order's updated_at forward when one of its items changes
+
+    An updated_at that was already set in this flush, such as one copied
+    from a peer, is left alone
+    """
+    now = datetime.now(timezone.utc)
+    for item in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(item, Item) or (
+            item in session.dirty and not session.is_modified(item)
+        ):
+            continue
+        order = item.order
+        if order is None or order in session.deleted:
+            continue
+        if not inspect(order).attrs.updated_at.history.has_changes():
+            order.updated_at = now
@@ -0,0 +1,195 @@
+"""
+Order filters
+
+Turns the filters of an Order listing into SQL conditions. Every value is
+checked and converted when the OrderFilter is made, so bad input is refused
+before a query is built.
+
+Conditions on the items are combined into one EXISTS semi-join, so an order
+is listed once however many of its items match, and all of them must hold
+for the same item. Conditions on the orders are plain comparisons on their
+columns, so each can use an index.
+"""
+
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import and_, select, union
+from .persistent_base import DataValidationError
+from .indexes import TRIGRAM, has_extension
+from .item import Item
+from .order_status import OrderStatus
+
+logger = logging.getLogger("flask.app")
+
+# the ways a search can match the customer and product names
+MATCHES = ("prefix", "substring", "fuzzy")
+
+
+def _text(name, value):
+    """Returns a text value"""
+    if not isinstance(value, str):
+        raise DataValidationError(f"Invalid {name}: must be text")
+    return value
+
+
+def _statuses(name, value):
+    """Returns the statuses in a list or a comma separated string"""
+    values = value.split(",") if isinstance(value, str) else value
+    statuses = []
+    for status in values:
+        try:
+            statuses.append(OrderStatus(str(status).strip().upper()))
+        except ValueError as error:
+            raise DataValidationError(
+                f"Invalid {name} '{status}': must be one of {', '.join(OrderStatus.list())}"
+            ) from error
+    return statuses
+
+
+def _timestamp(name, value):
+    """Returns an ISO 8601 time as the naive UTC time the columns hold"""
+    try:
+        when = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid {name} '{value}': must be an ISO 8601 time") from error
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def _count(name, value):
+    """Returns a whole number that is not negative"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid {name} '{value}': must be a whole number") from error
+    if number < 0:
+        raise DataValidationError(f"Invalid {name} '{value}': must not be negative")
+    return number
+
+
+def _amount(name, value):
+    """Returns an amount of money that is not negative"""
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation as error:
+        raise DataValidationError(f"Invalid {name} '{value}': must be a number") from error
+    if not amount.is_finite() or amount < 0:
+        raise DataValidationError(f"Invalid {name} '{value}': must not be negative")
+    return amount
+
+
+def _match(name, value):
+    """Returns one of the ways a search can match"""
+    if value not in MATCHES:
+        raise DataValidationError(f"Invalid {name} '{value}': must be one of {', '.join(MATCHES)}")
+    return value
+
+
+# name: (converter, what an Order is compared on, the comparison)
+ORDER_FILTERS = {
+    "customer_name": (_text, "customer_name", "eq"),
+    "order_status": (_statuses, "status", "in"),
+    "created_after": (_timestamp, "created_at", "ge"),
+    "created_before": (_timestamp, "created_at", "lt"),
+    "updated_after": (_timestamp, "updated_at", "ge"),
+    "updated_before": (_timestamp, "updated_at", "lt"),
+}
+
+# name: (converter, what an Item is compared on, the comparison)
+ITEM_FILTERS = {
+    "product_name": (_text, "product_name", "eq"),
+    "min_quantity": (_count, "quantity", "ge"),
+    "max_quantity": (_count, "quantity", "le"),
+    "min_price": (_amount, "price", "ge"),
+    "max_price": (_amount, "price", "le"),
+}
+
+SEARCH_FILTERS = {"search": _text, "match": _match}
+
+# lower and upper bounds that must not cross
+RANGES = (
+    ("created_after", "created_before"),
+    ("updated_after", "updated_before"),
+    ("min_quantity", "max_quantity"),
+    ("min_price", "max_price"),
+)
+
+COMPARISONS = {
+    "eq": lambda column, value: column == value,
+    "in": lambda column, value: column.in_(value),
+    "ge": lambda column, value: column >= value,
+    "le": lambda column, value: column <= value,
+    "lt": lambda column, value: column < value,
+}
+
+
+class OrderFilter:
+    """The conditions an Order listing must meet, all of them at once
+
+    Filters that are None or empty are left out.
+    """
+
+    def __init__(self, **filters):
+        converters = {name: spec[0] for name, spec in {**ORDER_FILTERS, **ITEM_FILTERS}.items()}
+        converters.update(SEARCH_FILTERS)
+        unknown = sorted(set(filters) - set(converters))
+        if unknown:
+            raise DataValidationError(f"Unknown filters: {', '.join(unknown)}")
+        self.values = {
+            name: converters[name](name, value)
+            for name, value in filters.items()
+            if value is not None and value != "" and value != []
+        }
+        for low, high in RANGES:
+            if low in self.values and high in self.values and self.values[low] > self.values[high]:
+                raise DataValidationError(f"Invalid range: {low} is after {high}")
+
+    def __repr__(self):
+        return f"<OrderFilter {self.values}>"
+
+    def conditions(self, order):
+        """Returns the SQL conditions on an Order model"""
+        conditions = [
+            COMPARISONS[comparison](getattr(order, column), self.values[name])
+            for name, (_, column, comparison) in ORDER_FILTERS.items()
+            if name in self.values
+        ]
+        item_conditions = [
+            COMPARISONS[comparison](getattr(Item, column), self.values[name])
+            for name, (_, column, comparison) in ITEM_FILTERS.items()
+            if name in self.values
+        ]
+        if item_conditions:
+            conditions.append(order.items.any(and_(*item_conditions)))
+        if "search" in self.values:
+            conditions.append(self._matching(order))
+        return conditions
+
+    def _matching(self, order):
+        """Returns a condition for the Orders whose customer or a product matches
+
+        Matches ignore case. A fuzzy match finds names with the same
+        trigrams, so it forgives typos; without pg_trgm it is a substring
+        match. The customers and the products are searched apart and their
+        order ids combined, so each search can use its own trigram index.
+        """
+        search = self.values["search"]
+        match = self.values.get("match", "substring")
+        if match == "fuzzy" and not has_extension(TRIGRAM):
+            match = "substring"
+
+        def matches(column):
+            if match == "prefix":
+                return column.istartswith(search, autoescape=True)
+            if match == "fuzzy":
+                return column.op("%")(search)
+            return column.icontains(search, autoescape=True)
+
+        order_ids = union(
+            select(order.id).where(matches(order.customer_name)),
+            select(Item.order_id).where(matches(Item.product_name)),
+        )
+        return order.id.in_(order_ids)
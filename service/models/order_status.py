@@ -0,0 +1,20 @@
+"""
+Statuses an Order moves through
+"""
+
+from enum import Enum
+
+
+class OrderStatus(Enum):
+    """Enumeration of valid order statuses"""
+
+    CREATED = "CREATED"
+    IN_PROGRESS = "IN_PROGRESS"
+    SHIPPED = "SHIPPED"
+    COMPLETED = "COMPLETED"
+    CANCELLED = "CANCELLED"
+
+    @staticmethod
+    def list():
+        """Lists different order statuses"""
+        return list(map(lambda s: s.value, OrderStatus))
@@ -0,0 +1,331 @@
+"""
+Transactional outbox for peer replication
+
+Every order and item a transaction creates, changes or deletes is recorded
+when it is flushed, and written to the change log by the same commit that
+writes the change itself. A request that must reach the peers also calls
+OutboxEvent.capture(), and then the changes are written as OutboxEvent rows
+too, together with one OutboxDelivery row per peer.
+
+Changes are field-level deltas, so a status flip on a large order is sent
+as {"fields": {"status": "SHIPPED"}} rather than the whole order. Items are
+addressed by the id of their order and their uid, which is the same on
+every node. A delivery row is deleted once its peer
+has the event, so an event whose transaction commits after a later event has
+been sent is still picked up. Each peer also has a PeerCursor that holds the
+drain lock and backoff state for that peer.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+from enum import Enum
+
+from sqlalchemy import event, func
+from .persistent_base import db, changed_fields
+from .change_log import Change, ChangeRecord
+from .item import Item
+from .order import Order
+
+logger = logging.getLogger("flask.app")
+
+
+class OutboxEvent(db.Model, ChangeRecord):
+    """Class that represents a change waiting to be delivered to the peers"""
+
+    __tablename__ = "outbox_event"
+
+    id = db.Column(db.Integer, primary_key=True)
+    deliveries = db.relationship(
+        "OutboxDelivery", cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    def __repr__(self):
+        return f"<OutboxEvent id={self.id} {self.op} {self.entity} {self.entity_id}>"
+
+    def serialize(self):
+        """Converts an OutboxEvent into a replication mutation"""
+        return {
+            "seq": self.id,
+            "op": self.op,
+            "entity": self.entity,
+            "id": self.entity_id,
+            "data": self.payload,
+        }
+
+    @staticmethod
+    def capture(peers):
+        """Records the changes of the current transaction for the given peers
+
+        Args:
+            peers (list): the peers the changes must be delivered to
+        """
+        db.session.info["outbox_peers"] = tuple(peers)
+
+    @classmethod
+    def pending(cls, peer, limit):
+        """Returns up to limit of the oldest events not yet sent to a peer"""
+        return (
+            cls.query.join(OutboxDelivery)
+            .filter(OutboxDelivery.peer == peer)
+            .order_by(cls.id)
+            .limit(limit)
+            .all()
+        )
+
+    @classmethod
+    def prune(cls):
+        """Deletes the events that every peer has received"""
+        count = cls.query.filter(~cls.deliveries.any()).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        return count
+
+
+class OutboxDelivery(db.Model):
+    """Class that represents an event a peer has not received yet"""
+
+    __tablename__ = "outbox_delivery"
+
+    event_id = db.Column(
+        db.Integer,
+        db.ForeignKey("outbox_event.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    peer = db.Column(db.String(255), primary_key=True)
+
+    def __repr__(self):
+        return f"<OutboxDelivery event_id={self.event_id} peer={self.peer}>"
+
+    @classmethod
+    def delivered(cls, peer, event_ids):
+        """Records that a peer has received the given events"""
+        cls.query.filter(cls.peer == peer, cls.event_id.in_(event_ids)).delete(
+            synchronize_session=False
+        )
+
+    @classmethod
+    def backlog(cls):
+        """Returns {peer: (undelivered events, time of the oldest)}"""
+        # func builds SQL functions, which pylint cannot tell are callable
+        count = func.count()  # pylint: disable=not-callable
+        rows = (
+            db.session.query(cls.peer, count, func.min(OutboxEvent.created_at))
+            .join(OutboxEvent, OutboxEvent.id == cls.event_id)
+            .group_by(cls.peer)
+        )
+        return {peer: (count, oldest) for peer, count, oldest in rows}
+
+    @classmethod
+    def forget_peers(cls, keep):
+        """Drops the deliveries of every peer that is not in keep"""
+        return cls.query.filter(cls.peer.notin_(keep)).delete(
+            synchronize_session=False
+        )
+
+
+class PeerCursor(db.Model):
+    """Class that tracks delivery attempts to a peer"""
+
+    __tablename__ = "peer_cursor"
+
+    peer = db.Column(db.String(255), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+
+    def __repr__(self):
+        return f"<PeerCursor peer={self.peer} attempts={self.attempts}>"
+
+    def is_backing_off(self, now):
+        """Returns True if the peer should not be tried again yet"""
+        if self.next_attempt_at is None:
+            return False
+        when = self.next_attempt_at
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return when > now
+
+    @classmethod
+    def lock(cls, peer):
+        """Returns the cursor for a peer locked for update
+
+        Returns None if another worker is already draining this peer
+        """
+        cursor = (
+            cls.query.filter_by(peer=peer).with_for_update(skip_locked=True).first()
+        )
+        if cursor is None and db.session.get(cls, peer) is None:
+            cursor = cls(peer=peer, attempts=0)
+            db.session.add(cursor)
+        return cursor
+
+
+def to_json(payload):
+    """Makes a serialized entity safe to store in a JSON column"""
+    return json.loads(json.dumps(payload, default=str))
+
+
+def _field_value(value):
+    """Returns a column value as it is sent to the peers"""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _record(changes, key, op, instance, fields=()):
+    """Adds a change to the ones recorded for a transaction
+
+    A create or delete already recorded for the same row absorbs later
+    patches, and patches of the same row are merged into one
+    """
+    recorded = changes.get(key)
+    if op == "patch" and recorded is not None:
+        if recorded[0] == "patch":
+            recorded[2].update(fields)
+        return
+    changes.pop(key, None)
+    changes[key] = (op, instance, dict.fromkeys(fields))
+
+
+def _record_created(changes, created, new):
+    """Records new orders and the items added to orders created earlier"""
+    for instance in new:
+        if isinstance(instance, Order):
+            created.add(instance.id)
+            _record(changes, ("order", instance.id), "create", instance)
+    for instance in new:
+        # items of an order created in the same transaction travel with it
+        if isinstance(instance, Item) and instance.order_id not in created:
+            _record(changes, ("item", instance.uid), "create", instance)
+
+
+def _record_deleted(changes, deleted):
+    """Records deleted items and orders"""
+    for instance in deleted:
+        if isinstance(instance, Item):
+            _record(changes, ("item", instance.uid), "delete", instance)
+    for instance in deleted:
+        if isinstance(instance, Order):
+            _record(changes, ("order", instance.id), "delete", instance)
+
+
+@event.listens_for(db.session, "after_flush")
+def _capture_changes(session, flush_context):  # pylint: disable=unused-argument
+    """Records the orders and items changed by a flush"""
+    changes = session.info.setdefault("outbox", {})
+    _record_created(changes, session.info.setdefault("outbox_created", set()), session.new)
+    for instance in session.dirty:
+        if isinstance(instance, (Order, Item)):
+            fields = changed_fields(instance)
+            if fields:
+                key = (instance.__tablename__, getattr(instance, "uid", instance.id))
+                _record(changes, key, "patch", instance, fields)
+    _record_deleted(changes, session.deleted)
+
+
+def _payload(op, instance, fields, now):
+    """Returns the change record sent to the peers for one change"""
+    if op == "patch":
+        versions = instance.field_versions or {}
+        payload = {
+            "fields": {name: _field_value(getattr(instance, name)) for name in fields},
+            "field_versions": {name: versions.get(name, instance.version) for name in fields},
+        }
+    elif op == "create":
+        payload = to_json(instance.serialize())
+    else:
+        payload = {}
+
+    if isinstance(instance, Order):
+        if op == "delete":
+            # peers compare this against their copy when repairing deletes
+            payload["deleted_at"] = now.isoformat()
+        else:
+            payload["updated_at"] = instance.updated_at.isoformat()
+            payload["version"] = instance.version
+        return payload
+
+    payload["uid"] = instance.uid
+    payload["version"] = instance.version
+    order = db.session.get(Order, instance.order_id)
+    if order is not None:
+        payload["order_updated_at"] = order.updated_at.isoformat()
+        payload["order_version"] = order.version
+    return payload
+
+
+@event.listens_for(db.session, "before_commit")
+def _write_outbox(session):
+    """Writes the recorded changes to the change log and the outbox
+
+    Both are written inside the committing transaction
+    """
+    session.flush()
+    changes = session.info.pop("outbox", {})
+    if not changes:
+        return
+    Change.lock(session)
+    peers = session.info.get("outbox_peers", ())
+    now = datetime.now(timezone.utc)
+    for (entity, _), (op, instance, fields) in changes.items():
+        entity_id = instance.id if entity == "order" else instance.order_id
+        payload = _payload(op, instance, fields, now)
+        session.add(
+            Change(op=op, entity=entity, entity_id=entity_id, payload=payload, created_at=now)
+        )
+        if peers:
+            session.add(
+                OutboxEvent(
+                    op=op,
+                    entity=entity,
+                    entity_id=entity_id,
+                    payload=payload,
+                    created_at=now,
+                    deliveries=[OutboxDelivery(peer=peer) for peer in peers],
+                )
+            )
+    session.info["changes_written"] = True
+    logger.debug("Wrote %d change(s) to the change log", len(changes))
+
+
+def _snapshot(session):
+    """Returns a copy of what has been recorded so far"""
+    return (
+        {
+            key: (op, instance, dict(fields))
+            for key, (op, instance, fields) in session.info.get("outbox", {}).items()
+        },
+        set(session.info.get("outbox_created", ())),
+    )
+
+
+@event.listens_for(db.session, "after_transaction_create")
+def _begin_savepoint(session, transaction):
+    """Remembers what was recorded before a savepoint
+
+    The snapshots are kept until the whole transaction is over
+    """
+    if transaction.nested:
+        session.info.setdefault("outbox_savepoints", {})[transaction] = _snapshot(session)
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_soft_rollback")
+def _stop_capture(session, previous_transaction=None):
+    """Stops recording once the transaction is over
+
+    Rolling back to a savepoint only forgets what was recorded after it
+    """
+    savepoints = session.info.get("outbox_savepoints", {})
+    if previous_transaction is not None and previous_transaction in savepoints:
+        session.info["outbox"], session.info["outbox_created"] = savepoints[previous_transaction]
+        return
+    for key in ("outbox", "outbox_peers", "outbox_created", "outbox_savepoints"):
+        session.info.pop(key, None)
+    if previous_transaction is not None:
+        session.info.pop("changes_written", None)
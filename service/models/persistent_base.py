@@ -7,6 +7,9 @@ from datetime import datetime, timezone
 import logging
 from abc import abstractmethod
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+from .clock import clock
 
 logger = logging.getLogger("flask.app")
 
@@ -18,6 +21,10 @@ class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+# Columns that every node sets for itself and so are never sent as deltas
+LOCAL_FIELDS = ("id", "uid", "created_at", "updated_at", "version", "field_versions")
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -34,6 +41,11 @@ class PersistentBase:
         onupdate=lambda: datetime.now(timezone.utc),
         nullable=False,
     )
+    # hybrid logical clock version of the last change, see clock.py
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    # the version of the last change to each replicated field, so changes
+    # two nodes make to different fields at the same time are both kept
+    field_versions = db.Column(db.JSON, nullable=False, default=dict, server_default="{}")
 
     @abstractmethod
     def serialize(self) -> dict:
@@ -96,3 +108,46 @@ class PersistentBase:
         logger.info("Processing lookup for id %s ...", by_id)
         # pylint: disable=no-member
         return cls.query.session.get(cls, by_id)
+
+
+######################################################################
+#  V E R S I O N   S T A M P S
+######################################################################
+@event.listens_for(PersistentBase, "before_insert", propagate=True)
+def _stamp_new(mapper, connection, target):  # pylint: disable=unused-argument
+    """Gives a new record its first version"""
+    if target.version:
+        # a version copied from a peer is kept
+        clock.observe(target.version)
+    else:
+        target.version = clock.now()
+
+
+@event.listens_for(PersistentBase, "before_update", propagate=True)
+def _stamp_changed(mapper, connection, target):  # pylint: disable=unused-argument
+    """Gives a changed record a new version"""
+    if inspect(target).attrs.version.history.has_changes():
+        clock.observe(target.version)
+    elif object_session(target).is_modified(target, include_collections=False):
+        target.version = clock.now()
+        _stamp_fields(target)
+
+
+def changed_fields(instance):
+    """Returns the names of the replicated columns changed on an instance"""
+    state = inspect(instance)
+    return [
+        attr.key
+        for attr in state.mapper.column_attrs
+        if attr.key not in LOCAL_FIELDS and state.attrs[attr.key].history.has_changes()
+    ]
+
+
+def _stamp_fields(target):
+    """Gives the replicated fields a change set the version of the change"""
+    changed = changed_fields(target)
+    if changed:
+        target.field_versions = {
+            **(target.field_versions or {}),
+            **dict.fromkeys(changed, target.version),
+        }
@@ -0,0 +1,230 @@
+"""
+Order statistics
+
+Counts of orders by status, and orders, quantities and revenue by product
+and by customer, kept in one summary table so reading them never scans the
+orders. Every flush that touches an order or its items reads what those
+orders added to the statistics before and after it, and adds the
+difference, so the counters move in the same transaction as the change.
+The orders are locked before they are read, so a concurrent change to the
+same orders waits for this transaction and reads what it committed.
+
+Revenue is the quantity times the price of the items. A cancelled order is
+still counted under its status and its customer, but its items add nothing
+to the product and customer totals.
+"""
+
+import logging
+from collections import defaultdict
+from decimal import Decimal
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from .persistent_base import db
+from .item import Item
+from .order import Order, OrderStatus
+
+logger = logging.getLogger("flask.app")
+
+STATUS = "status"
+PRODUCT = "product"
+CUSTOMER = "customer"
+
+
+class OrderStat(db.Model):
+    """Class that represents the running totals of one status, product or customer"""
+
+    __tablename__ = "order_stat"
+
+    kind = db.Column(db.String(16), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+    # the top products and customers are read in revenue order
+    __table_args__ = (db.Index("ix_order_stat_kind_revenue", "kind", "revenue"),)
+
+    def __repr__(self):
+        return f"<OrderStat {self.kind} {self.key} orders={self.orders}>"
+
+    def serialize(self):
+        """Converts an OrderStat into a dictionary"""
+        return {
+            "orders": self.orders,
+            "quantity": self.quantity,
+            "revenue": self.revenue,
+        }
+
+    @classmethod
+    def report(cls, top=10):
+        """Returns the totals by status and the top products and customers
+
+        Args:
+            top (int): how many products and customers to return
+        """
+        statuses = {stat.key: stat for stat in cls.query.filter(cls.kind == STATUS)}
+        by_status = []
+        for order_status in OrderStatus.list():
+            stat = statuses.get(order_status)
+            totals = stat.serialize() if stat else {"orders": 0, "quantity": 0, "revenue": Decimal(0)}
+            by_status.append({"status": order_status, **totals})
+        return {
+            "orders": sum(row["orders"] for row in by_status),
+            "revenue": sum(
+                row["revenue"] for row in by_status if row["status"] != OrderStatus.CANCELLED.value
+            ),
+            "by_status": by_status,
+            "by_product": [
+                {"product_name": stat.key, **stat.serialize()} for stat in cls._top(PRODUCT, top)
+            ],
+            "by_customer": [
+                {"customer_name": stat.key, **stat.serialize()} for stat in cls._top(CUSTOMER, top)
+            ],
+        }
+
+    @classmethod
+    def _top(cls, kind, top):
+        """Returns the top rows of one kind by revenue"""
+        return (
+            cls.query.filter(cls.kind == kind, cls.orders > 0)
+            .order_by(cls.revenue.desc(), cls.key)
+            .limit(top)
+            .all()
+        )
+
+    @classmethod
+    def rebuild(cls):
+        """Counts every order again, for a database that had orders before the totals"""
+        logger.info("Rebuilding the order statistics")
+        cls.query.delete()
+        connection = db.session.connection()
+        _add_totals(connection, {}, _totals(connection))
+        db.session.commit()
+
+
+def _totals(connection, order_ids=None):
+    """Returns what some orders add to the statistics as the database has them now
+
+    Args:
+        order_ids (set): the orders to count, all of them if not given
+
+    Returns:
+        a dict of (kind, key) to [orders, quantity, revenue]
+    """
+    totals = defaultdict(lambda: [0, 0, Decimal(0)])
+    if order_ids is not None and not order_ids:
+        return totals
+    orders, items = Order.__table__, Item.__table__
+    query = select(
+        orders.c.id,
+        orders.c.status,
+        orders.c.customer_name,
+        items.c.product_name,
+        items.c.quantity,
+        items.c.price,
+    ).select_from(orders.outerjoin(items, items.c.order_id == orders.c.id))
+    if order_ids is not None:
+        query = query.where(orders.c.id.in_(order_ids))
+
+    counted = set()
+    for row in connection.execute(query):
+        order_status = OrderStatus(row.status).value
+        cancelled = order_status == OrderStatus.CANCELLED.value
+        keys = [(STATUS, order_status), (CUSTOMER, row.customer_name)]
+        if row.product_name is not None and not cancelled:
+            keys.append((PRODUCT, row.product_name))
+        for key in keys:
+            total = totals[key]
+            # an order is counted once however many items it has
+            if (row.id, key) not in counted:
+                counted.add((row.id, key))
+                total[0] += 1
+            if row.product_name is not None and (key[0] == STATUS or not cancelled):
+                total[1] += row.quantity
+                total[2] += row.quantity * row.price
+    return totals
+
+
+def _upsert(connection):
+    """Returns the INSERT ... ON CONFLICT statement of the database"""
+    dialect = postgresql if connection.dialect.name == "postgresql" else sqlite
+    table = OrderStat.__table__
+    statement = dialect.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.kind, table.c.key],
+        set_={
+            "orders": table.c.orders + statement.excluded.orders,
+            "quantity": table.c.quantity + statement.excluded.quantity,
+            "revenue": table.c.revenue + statement.excluded.revenue,
+        },
+    )
+
+
+def _add_totals(connection, before, after):
+    """Adds the difference between two sets of totals to the statistics
+
+    Rows are changed in key order so that two transactions that change the
+    same rows never wait on each other in a cycle
+    """
+    zero = (0, 0, Decimal(0))
+    rows = []
+    for kind, key in sorted(set(before) | set(after)):
+        delta = [new - old for new, old in zip(after.get((kind, key), zero), before.get((kind, key), zero))]
+        if any(delta):
+            rows.append(
+                {"kind": kind, "key": key, "orders": delta[0], "quantity": delta[1], "revenue": delta[2]}
+            )
+    if rows:
+        connection.execute(_upsert(connection), rows)
+
+
+def _touched_orders(session):
+    """Returns the ids of the orders a flush is about to change"""
+    order_ids = set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        if isinstance(instance, Order):
+            order_ids.add(instance.id)
+        elif isinstance(instance, Item):
+            # the order it was moved from as well as the one it is in
+            order_ids.update(inspect(instance).attrs.order_id.history.sum())
+            if instance.order is not None:
+                order_ids.add(instance.order.id)
+    order_ids.discard(None)
+    return order_ids
+
+
+def _lock_orders(connection, order_ids):
+    """Locks the rows of some orders until the transaction ends
+
+    Rows are locked in id order so that two flushes never wait on each other
+    in a cycle. The totals are read by the next statement, which sees the
+    changes committed while this one waited.
+    """
+    if order_ids:
+        orders = Order.__table__
+        connection.execute(
+            select(orders.c.id).where(orders.c.id.in_(order_ids)).order_by(orders.c.id).with_for_update()
+        )
+
+
+@event.listens_for(db.session, "before_flush")
+def _read_totals_before(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Reads what the orders a flush changes added to the statistics so far"""
+    order_ids = _touched_orders(session)
+    connection = session.connection()
+    _lock_orders(connection, order_ids)
+    session.info["stats_orders"] = order_ids
+    session.info["stats_before"] = _totals(connection, order_ids)
+
+
+@event.listens_for(db.session, "after_flush")
+def _update_totals(session, flush_context):  # pylint: disable=unused-argument
+    """Adds what the flush changed to the statistics"""
+    order_ids = session.info.pop("stats_orders", set())
+    before = session.info.pop("stats_before", {})
+    connection = session.connection()
+    _add_totals(connection, before, _totals(connection, order_ids))
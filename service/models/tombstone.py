@@ -0,0 +1,73 @@
+"""
+Tombstones for deleted records
+
+A Tombstone remembers that a record was deleted so that anti-entropy repair
+does not bring it back from a peer that has not heard of the delete yet.
+Tombstones are written by the same flush that deletes the record.
+"""
+
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+
+class Tombstone(db.Model):
+    """Class that represents a deleted record"""
+
+    __tablename__ = "tombstone"
+
+    entity = db.Column(db.String(32), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False
+    )
+
+    def __repr__(self):
+        return f"<Tombstone {self.entity} {self.entity_id}>"
+
+    @classmethod
+    def exists(cls, entity, entity_id):
+        """Returns True if the record was deleted"""
+        return db.session.get(cls, (entity, entity_id)) is not None
+
+    @classmethod
+    def in_range(cls, entity, low, high):
+        """Returns (entity_id, deleted_at) for ids from low up to high"""
+        return (
+            db.session.query(cls.entity_id, cls.deleted_at)
+            .filter(cls.entity == entity, cls.entity_id >= low, cls.entity_id < high)
+            .all()
+        )
+
+    @classmethod
+    def prune(cls, older_than):
+        """Deletes tombstones from before the given time"""
+        count = cls.query.filter(cls.deleted_at < older_than).delete()
+        db.session.commit()
+        return count
+
+
+# Only whole records that peers replicate need a tombstone
+TRACKED = ("order",)
+
+
+@event.listens_for(db.session, "before_flush")
+def _write_tombstones(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Adds a tombstone for every tracked record being deleted
+
+    A record created again with the same id loses its tombstone
+    """
+    for instance in session.deleted:
+        entity = getattr(instance, "__tablename__", None)
+        if entity in TRACKED:
+            session.merge(Tombstone(entity=entity, entity_id=instance.id))
+    for instance in session.new:
+        entity = getattr(instance, "__tablename__", None)
+        if entity in TRACKED and instance.id is not None:
+            tombstone = session.get(Tombstone, (entity, instance.id))
+            if tombstone is not None:
+                session.delete(tombstone)
@@ -0,0 +1,287 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Replication Endpoints
+
+The endpoints peer nodes send their changes to and walk the hash tree of,
+and the health and replication metrics of the peers
+"""
+
+from flask import current_app as app  # Import Flask application
+from flask_restx import Resource, fields, reqparse
+from sqlalchemy.exc import SQLAlchemyError
+from service.common import status  # HTTP Status Codes
+from service.common.anti_entropy import bucket_records, bucket_rows, current_tree
+from service.common.dispatcher import dispatcher
+from service.common.idempotency import idempotent
+from service.common.peers import manager
+from service.common.replication import apply_mutations
+from service.routes import abort, api
+
+
+# A change sent from one node to its peers
+mutation_model = api.model(
+    "Mutation",
+    {
+        "seq": fields.Integer(
+            description="Position of the change in the sender's outbox"
+        ),
+        "op": fields.String(
+            required=True,
+            enum=["create", "update", "patch", "delete"],
+            description="The kind of change: update replaces the whole record, "
+            "patch sets only the fields listed in the change",
+        ),
+        "entity": fields.String(
+            required=True,
+            enum=["order", "item"],
+            description="The kind of record that changed",
+        ),
+        "id": fields.Integer(
+            required=True, description="The id of the order the change belongs to"
+        ),
+        "data": fields.Raw(description="The record or the changed fields"),
+    },
+)
+
+mutation_batch_model = api.model(
+    "MutationBatch",
+    {
+        "mutations": fields.List(
+            fields.Nested(mutation_model),
+            required=True,
+            description="The changes to apply, in order",
+        ),
+    },
+)
+
+# query string arguments for walking the anti-entropy hash tree
+tree_args = reqparse.RequestParser()
+tree_args.add_argument(
+    "level",
+    type=int,
+    location="args",
+    required=False,
+    help="The level of the tree, 0 being the leaf buckets",
+)
+tree_args.add_argument(
+    "index",
+    type=str,
+    location="args",
+    required=False,
+    help="Comma-separated indexes of the nodes to return at that level",
+)
+
+# query string arguments for reading a leaf bucket of the hash tree
+bucket_args = reqparse.RequestParser()
+bucket_args.add_argument(
+    "ids",
+    type=str,
+    location="args",
+    required=False,
+    help="Comma-separated ids of the orders to return in full",
+)
+
+peer_health_model = api.model(
+    "PeerHealth",
+    {
+        "peer": fields.String(readOnly=True, description="The URL of the peer"),
+        "state": fields.String(
+            readOnly=True,
+            enum=["closed", "open", "half-open"],
+            description="State of the circuit breaker to the peer",
+        ),
+        "consecutive_failures": fields.Integer(readOnly=True),
+        "total_successes": fields.Integer(readOnly=True),
+        "total_failures": fields.Integer(readOnly=True),
+        "last_latency_ms": fields.Float(readOnly=True),
+        "last_error": fields.String(readOnly=True),
+        "last_success_at": fields.String(readOnly=True),
+    },
+)
+
+peer_metrics_model = api.model(
+    "PeerMetrics",
+    {
+        "peer": fields.String(readOnly=True, description="The URL of the peer"),
+        "state": fields.String(
+            readOnly=True,
+            enum=["closed", "open", "half-open"],
+            description="State of the circuit breaker to the peer",
+        ),
+        "in_flight": fields.Integer(
+            readOnly=True, description="Requests to the peer waiting for an answer"
+        ),
+        "requests": fields.Integer(
+            readOnly=True, description="Recent requests the figures below are taken over"
+        ),
+        "error_rate": fields.Float(
+            readOnly=True, description="Share of the recent requests that failed"
+        ),
+        "latency_p50_ms": fields.Float(readOnly=True),
+        "latency_p99_ms": fields.Float(readOnly=True),
+        "queue_depth": fields.Integer(
+            readOnly=True, description="Changes the peer has not received yet"
+        ),
+        "lag_seconds": fields.Float(
+            readOnly=True,
+            description="Age of the oldest change the peer has not received yet",
+        ),
+    },
+)
+
+
+######################################################################
+#  PATH: /replication/batch
+######################################################################
+@api.route("/replication/batch")
+class ReplicationBatchResource(Resource):
+    """Applies batches of changes sent by peer nodes"""
+
+    @api.doc("apply_replication_batch")
+    @api.response(400, "The posted batch was not valid")
+    @api.response(503, "The batch could not be stored, send it again later")
+    @api.expect(mutation_batch_model)
+    @idempotent
+    def post(self):
+        """
+        Apply a batch of replicated changes
+
+        The changes are applied in order in a single transaction. Changes
+        that are not valid are skipped and their seq numbers returned.
+        """
+        data = api.payload
+        if not isinstance(data, dict) or not isinstance(data.get("mutations"), list):
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Required list 'mutations' missing from request body",
+            )
+
+        app.logger.info("Request to apply %d replicated changes", len(data["mutations"]))
+        try:
+            applied, rejected = apply_mutations(data["mutations"])
+        except SQLAlchemyError as error:
+            app.logger.error("Could not apply replicated changes: %s", error)
+            abort(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "The batch could not be stored, send it again later",
+            )
+        return {"applied": applied, "rejected": rejected}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /replication/tree
+######################################################################
+@api.route("/replication/tree")
+class ReplicationTreeResource(Resource):
+    """The hash tree peers use to find differences"""
+
+    MAX_NODES = 4096
+
+    @api.doc("get_replication_tree")
+    @api.expect(tree_args, validate=True)
+    @api.response(400, "The level or indexes were not valid")
+    @api.response(503, "The tree has not been built yet")
+    def get(self):
+        """
+        Returns the shape of the hash tree and, when a level is given,
+        the hashes of the requested nodes at that level
+        """
+        args = tree_args.parse_args()
+        tree = current_tree(app)
+        if tree is None:
+            abort(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "The hash tree has not been built yet",
+            )
+        result = tree.info()
+        if args["level"] is None:
+            return result, status.HTTP_200_OK
+
+        try:
+            indexes = [int(i) for i in (args["index"] or "").split(",") if i]
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, "Indexes must be integers")
+        if not 0 <= args["level"] <= tree.top_level or len(indexes) > self.MAX_NODES:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Level must be from 0 to {tree.top_level} "
+                f"with at most {self.MAX_NODES} indexes",
+            )
+        result["level"] = args["level"]
+        result["hashes"] = {str(i): tree.node_hash(args["level"], i) for i in indexes}
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /replication/buckets/<int:bucket>
+######################################################################
+@api.route("/replication/buckets/<int:bucket>")
+@api.param("bucket", "The index of the leaf bucket")
+class ReplicationBucketResource(Resource):
+    """The orders in one leaf bucket of the hash tree"""
+
+    @api.doc("get_replication_bucket")
+    @api.expect(bucket_args, validate=True)
+    @api.response(400, "The ids were not valid")
+    def get(self, bucket):
+        """
+        Returns the digest and last update of every order in a bucket and
+        when its deleted orders were deleted. The orders listed in ids are
+        also returned in full.
+        """
+        args = bucket_args.parse_args()
+        bucket_size = app.config["ANTI_ENTROPY_BUCKET_SIZE"]
+        result = bucket_rows(bucket, bucket_size)
+        result["bucket"] = bucket
+        if args["ids"]:
+            try:
+                ids = [int(i) for i in args["ids"].split(",") if i]
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, "Ids must be integers")
+            result["records"] = bucket_records(bucket, bucket_size, ids)
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /peers
+######################################################################
+@api.route("/peers")
+class PeerCollection(Resource):
+    """Health of the peer nodes"""
+
+    @api.doc("list_peers")
+    @api.marshal_list_with(peer_health_model)
+    def get(self):
+        """Returns the health of every peer node"""
+        app.logger.info("Request for peer health")
+        return manager.health(app.config["PEER_NODES"]), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /peers/metrics
+######################################################################
+@api.route("/peers/metrics")
+class PeerMetricsResource(Resource):
+    """Replication lag and throughput of the peer nodes"""
+
+    @api.doc("list_peer_metrics")
+    @api.marshal_list_with(peer_metrics_model)
+    def get(self):
+        """Returns the replication metrics of every peer node"""
+        app.logger.info("Request for peer metrics")
+        return dispatcher.metrics(app.config["PEER_NODES"]), status.HTTP_200_OK
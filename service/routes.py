@@ -21,28 +21,47 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Order
 """
 
-from flask import request
+import json
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from flask import Response, request, stream_with_context
 from flask import current_app as app  # Import Flask application
-from flask_restx import Resource, fields, reqparse, Api
-from service.models import Order, Item, OrderStatus
+from flask_restx import Resource, fields, marshal, reqparse, Api
+from werkzeug.http import http_date, quote_etag
+from service.models import db, Order, Item, OrderStatus, OutboxEvent
 from service.common import status  # HTTP Status Codes
+from service.common.cursors import decode_cursor, encode_cursor
+from service.common.dispatcher import dispatcher
+from service.common.idempotency import idempotent
+from service.common.known_orders import known_orders
+from service.common.order_cache import order_cache
 
-import requests
 
+# Media type of a streamed list: one JSON document per line
+NDJSON = "application/x-ndjson"
 
-def forward_request_to_peers(method, path, json=None):
-    """Forward mutating requests (POST/PUT/DELETE) to peer nodes"""
-    peers = app.config.get("PEER_NODES", [])
-    for peer in peers:
-        url = f"{peer}{path}"
-        try:
-            headers = {"X-From-Peer": "true"}
-            response = requests.request(
-                method, url, json=json, headers=headers, timeout=2
-            )
-            app.logger.info(f"Forwarded to {url} → {response.status_code}")
-        except requests.RequestException as e:
-            app.logger.error(f"Failed to sync with peer {peer}: {e}")
+# query string arguments passed to OrderFilter under the same name
+FILTER_ARGS = (
+    "order_status",
+    "product_name",
+    "created_after",
+    "created_before",
+    "updated_after",
+    "updated_before",
+    "min_quantity",
+    "max_quantity",
+    "min_price",
+    "max_price",
+)
+
+# what the order cache holds for an order id that does not exist
+MISSING = {"missing": True}
+
+# stands in for the items while an order body is rendered, to find where
+# they go; no client can send it, since it is made up anew by each process
+ITEMS_MARK = f"items-{uuid.uuid4().hex}"
 
 
 ######################################################################
@@ -102,6 +121,9 @@ item_model = api.inherit(
             readOnly=True,
             description="The unique order id assigned internally by service",
         ),
+        "version": fields.Integer(
+            readOnly=True, description="The version of the last change to the item"
+        ),
     },
 )
 
@@ -129,11 +151,55 @@ order_model = api.inherit(
         "id": fields.Integer(
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "version": fields.Integer(
+            readOnly=True,
+            description="The version of the last change to the order, "
+            "used to settle concurrent changes made on different nodes",
+        ),
     },
 )
 
+batch_get_model = api.model(
+    "BatchGet",
+    {
+        "ids": fields.List(
+            fields.Integer, required=True, description="The ids of the Orders to read"
+        ),
+    },
+)
+
+batch_get_result_model = api.model(
+    "BatchGetResult",
+    {
+        "orders": fields.List(
+            fields.Nested(order_model), description="The Orders found, in the order asked for"
+        ),
+        "missing": fields.List(
+            fields.Integer, description="The ids of the Orders that were not found"
+        ),
+    },
+)
+
+# query string arguments: the fields of an Order to return
+projection_args = reqparse.RequestParser()
+projection_args.add_argument(
+    "fields",
+    type=str,
+    location="args",
+    required=False,
+    help="Comma separated Order fields to return, all of them if not given",
+)
+projection_args.add_argument(
+    "include",
+    type=str,
+    location="args",
+    required=False,
+    choices=("items",),
+    help="Also return the items when fields is given",
+)
+
 # query string arguments: customer_name, order_status and product_name
-order_args = reqparse.RequestParser()
+order_args = projection_args.copy()
 order_args.add_argument(
     "name",
     type=str,
@@ -146,7 +212,7 @@ order_args.add_argument(
     type=str,
     location="args",
     required=False,
-    help="List orders by status",
+    help="List orders by status, several of them comma separated",
 )
 order_args.add_argument(
     "product_name",
@@ -155,6 +221,55 @@ order_args.add_argument(
     required=False,
     help="List orders by product_name in items",
 )
+order_args.add_argument(
+    "q",
+    type=str,
+    location="args",
+    required=False,
+    help="List orders whose customer or product name matches, ignoring case",
+)
+order_args.add_argument(
+    "match",
+    type=str,
+    location="args",
+    required=False,
+    default="substring",
+    help="How q matches the names: prefix, substring or fuzzy",
+)
+# ranges, checked with the other filters by OrderFilter
+for name, description in (
+    ("created_after", "List orders created at or after this ISO 8601 time"),
+    ("created_before", "List orders created before this ISO 8601 time"),
+    ("updated_after", "List orders updated at or after this ISO 8601 time"),
+    ("updated_before", "List orders updated before this ISO 8601 time"),
+    ("min_quantity", "List orders with an item of at least this quantity"),
+    ("max_quantity", "List orders with an item of at most this quantity"),
+    ("min_price", "List orders with an item of at least this price"),
+    ("max_price", "List orders with an item of at most this price"),
+):
+    order_args.add_argument(name, type=str, location="args", required=False, help=description)
+order_args.add_argument(
+    "sort",
+    type=str,
+    location="args",
+    required=False,
+    default="created_at",
+    help="created_at, updated_at or customer_name, with a leading - for descending",
+)
+order_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    help="The most orders to return in one page",
+)
+order_args.add_argument(
+    "cursor",
+    type=str,
+    location="args",
+    required=False,
+    help="Where the page starts, taken from the next link of the page before",
+)
 
 
 ######################################################################
@@ -176,21 +291,25 @@ class OrderResource(Resource):
     # RETRIEVE AN ORDER
     # ------------------------------------------------------------------
     @api.doc("get_order")
+    @api.expect(projection_args, validate=True)
+    @api.response(200, "The Order", order_model)
+    @api.response(304, "The client's copy of the Order is current")
+    @api.response(400, "An unknown field was asked for")
     @api.response(404, "Order not found")
-    @api.marshal_with(order_model)
+    @api.header("ETag", "The version of the Order")
+    @api.header("Last-Modified", "When the Order or one of its items last changed")
     def get(self, order_id):
-        """Retrieve a single order"""
-        app.logger.info("Request for Order with id: %s", order_id)
-
-        # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' could not be found.",
-            )
+        """Retrieve a single order
 
-        return order.serialize(), status.HTTP_200_OK
+        Send If-None-Match with the ETag, or If-Modified-Since, to get a 304
+        without a body when the Order has not changed.
+        """
+        app.logger.info("Request for Order with id: %s", order_id)
+        selected_fields = requested_fields(projection_args.parse_args())
+        rendered, headers = read_order(order_id, selected_fields)
+        if rendered is None:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(order_body(rendered), mimetype="application/json", headers=headers)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -198,33 +317,29 @@ class OrderResource(Resource):
     @api.doc("update_order")
     @api.response(404, "Order not found")
     @api.response(400, "The posted Order data was not valid")
+    @api.response(412, "The Order changed since the version in If-Match")
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
-        """Updates an order"""
+        """Updates an order
+
+        Send If-Match with the ETag of the Order to update it only if it
+        has not changed since.
+        """
         app.logger.info(f"Request to update order id:{order_id}")
-        # Check if order exists
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
-            )
+        # Check if order exists and is the version the client has
+        order = find_order_to_change(order_id)
         # Update order with info in the json request
         data = api.payload
         app.logger.debug("Payload received for update: %s", data)
         order.deserialize(data)
         order.id = order_id
+        replicate()
         order.update()
-        message = order.serialize()
-
-        if request.headers.get("X-From-Peer") == "true":
-            return message, status.HTTP_200_OK
-
-        # Otherwise, forward to peer nodes
-        path = request.path
-        forward_request_to_peers("PUT", path, message)
+        dispatcher.notify()
 
-        return message, status.HTTP_200_OK
+        data = order.serialize()
+        return data, status.HTTP_200_OK, order_headers(data)
 
     # ------------------------------------------------------------------
     # DELETE AN ORDER
@@ -236,14 +351,11 @@ class OrderResource(Resource):
         app.logger.info("Request to delete an entire order with order id: %s", order_id)
 
         # See if the order first exists
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if order:
+            replicate()
             order.delete()
-
-        if request.headers.get("X-From-Peer") == "true":
-            return "", status.HTTP_204_NO_CONTENT
-
-        forward_request_to_peers("DELETE", request.path)
+            dispatcher.notify()
 
         return "", status.HTTP_204_NO_CONTENT
 
@@ -260,33 +372,72 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_orders")
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @api.response(200, "A page of Orders", [order_model])
+    @api.response(400, "The limit, cursor, sort, filters or fields were not valid")
+    @api.header("Link", 'The URL of the next page with rel="next", if there is one')
+    @api.produces(["application/json", NDJSON])
     def get(self):
-        """Returns all of the Orders"""
+        """
+        Returns the Orders one page at a time
+
+        Orders are listed oldest first unless sort says otherwise. When
+        there are more, the Link header holds the URL of the next page.
+
+        Sending Accept: application/x-ndjson streams every matching Order
+        instead, one JSON document per line, starting after the cursor if
+        one is given.
+
+        fields=id,status returns only those fields of each Order, read
+        without the rest; add include=items to have the items as well.
+
+        q searches the customer and product names by prefix, substring or,
+        with match=fuzzy, by similarity.
+        """
         app.logger.info("Request to list Orders...")
-        orders = []
         args = order_args.parse_args()
-        customer_name = args["name"]
-        order_status = args["order_status"]
-        product_name = args["product_name"]
-
-        orders = Order.find_by_filters(
-            customer_name=customer_name,
-            order_status=order_status,
-            product_name=product_name,
+        selected_fields = requested_fields(args)
+        filters = {name: args[name] for name in FILTER_ARGS}
+        filters.update(
+            customer_name=args["name"], search=args["q"], match=args["match"]
         )
+        sort = args["sort"]
+        columns, _ = Order.sort_key(sort)
+        after = decode_cursor(args["cursor"], columns) if args["cursor"] else None
+        if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+            app.logger.info("Streaming Orders as %s", NDJSON)
+            batch_size = app.config["ORDERS_STREAM_BATCH_SIZE"]
+            orders = Order.stream(after, batch_size, selected_fields, sort, **filters)
+            return Response(stream_with_context(ndjson_lines(orders, selected_fields)), mimetype=NDJSON)
+
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["ORDERS_PAGE_SIZE"]
+        if not 1 <= limit <= app.config["ORDERS_MAX_PAGE_SIZE"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Limit must be from 1 to {app.config['ORDERS_MAX_PAGE_SIZE']}",
+            )
+        orders, more = Order.find_page(limit, after, selected_fields, sort, **filters)
 
         # Return as an array of dictionaries
-        results = [order.serialize() for order in orders]
-        return results, status.HTTP_200_OK
+        results = [marshal_order(order, selected_fields) for order in orders]
+        headers = {}
+        if more:
+            query = {key: value for key, value in request.args.items() if key != "cursor"}
+            query["cursor"] = encode_cursor(orders[-1], columns)
+            headers["Link"] = f'<{request.base_url}?{urlencode(query)}>; rel="next"'
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW ORDER
     # ------------------------------------------------------------------
     @api.doc("create_order")
     @api.response(400, "The posted data was not valid")
+    @api.response(409, "The Idempotency-Key was already used for a different Order")
+    @api.header("Idempotency-Key", "Answer retries of this request with the first response")
     @api.expect(base_order_model)
     @api.marshal_with(order_model, code=201)
+    @idempotent
     def post(self):
         """Create an Order"""
         app.logger.info("Request to create an Order")
@@ -294,18 +445,56 @@ class OrderCollection(Resource):
         # Create the order
         order = Order()
         order.deserialize(api.payload)
+        replicate()
         order.create()
+        dispatcher.notify()
 
         # Create a message to return
         message = order.serialize()
         location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
 
-        if request.headers.get("X-From-Peer") == "true":
-            return message, status.HTTP_201_CREATED, {"Location": location_url}
+        return message, status.HTTP_201_CREATED, {"Location": location_url}
 
-        forward_request_to_peers("POST", request.path, message)
 
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+######################################################################
+#  PATH: /orders:batchGet
+######################################################################
+@api.route("/orders:batchGet")
+class OrderBatchGet(Resource):
+    """Reads many Orders at once"""
+
+    @api.doc("batch_get_orders")
+    @api.expect(batch_get_model, projection_args, validate=False)
+    @api.response(200, "The Orders found and the ids that were not", batch_get_result_model)
+    @api.response(400, "The ids or fields were not valid")
+    def post(self):
+        """
+        Returns the Orders with the posted ids
+
+        All of them are read with one query, plus one for their items. Ids
+        that are not found are listed under missing rather than failing the
+        request. fields and include work as they do for a single Order.
+        """
+        data = api.payload
+        ids = data.get("ids") if isinstance(data, dict) else None
+        if not isinstance(ids, list) or not all(
+            isinstance(order_id, int) and not isinstance(order_id, bool) for order_id in ids
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, "Required list of integer 'ids' missing from request body")
+        ids = list(dict.fromkeys(ids))
+        if not 1 <= len(ids) <= app.config["ORDERS_BATCH_GET_MAX_IDS"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Send from 1 to {app.config['ORDERS_BATCH_GET_MAX_IDS']} ids",
+            )
+        selected_fields = requested_fields(projection_args.parse_args())
+
+        app.logger.info("Request to read %d Orders", len(ids))
+        found = {order.id: order for order in Order.find_many(ids, selected_fields)}
+        return {
+            "orders": [marshal_order(found[order_id], selected_fields) for order_id in ids if order_id in found],
+            "missing": [order_id for order_id in ids if order_id not in found],
+        }, status.HTTP_200_OK
 
 
 ######################################################################
@@ -318,25 +507,25 @@ class CancelOrderResource(Resource):
 
     @api.doc("cancel_order")
     @api.response(404, "Order not found")
+    @api.response(412, "The Order changed since the version in If-Match")
     @api.marshal_with(order_model)
     def put(self, order_id):
         """Cancels an order"""
         app.logger.info(f"Request to cancel order id:{order_id}")
-        # Check if order exists
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
-            )
+        # Check if order exists and is the version the client has
+        order = find_order_to_change(order_id)
 
         app.logger.info(
             f"Changing status of order with order id:{order_id} to CANCELLED"
         )
         order.status = OrderStatus.CANCELLED
+        replicate()
         order.update()
+        dispatcher.notify()
         app.logger.info(f"{order}")
         # Return the updated order
-        return order.serialize(), status.HTTP_200_OK
+        data = order.serialize()
+        return data, status.HTTP_200_OK, order_headers(data)
 
 
 ######################################################################
@@ -350,6 +539,7 @@ class UpdateStatusResource(Resource):
     @api.doc("update_order_status")
     @api.response(404, "Order not found")
     @api.response(400, "The posted Order data was not valid")
+    @api.response(412, "The Order changed since the version in If-Match")
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
@@ -358,13 +548,8 @@ class UpdateStatusResource(Resource):
             "Request to update order status for order with id: %s", order_id
         )
 
-        # Find the order by ID
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' was not found.",
-            )
+        # Find the order by ID, as the version the client has
+        order = find_order_to_change(order_id)
 
         # Get the new status from request body
         data = api.payload
@@ -388,13 +573,14 @@ class UpdateStatusResource(Resource):
             )
 
         # If the status is not changing, return success (idempotent)
-        if order.status == new_status:
-            return order.serialize(), status.HTTP_200_OK
-
-        # Update the status
-        order.status = new_status
-        order.update()
-        return order.serialize(), status.HTTP_200_OK
+        if order.status != new_status:
+            # Update the status
+            order.status = new_status
+            replicate()
+            order.update()
+            dispatcher.notify()
+        data = order.serialize()
+        return data, status.HTTP_200_OK, order_headers(data)
 
 
 ######################################################################
@@ -415,24 +601,18 @@ class ItemCollection(Resource):
     # LIST ALL ITEMS IN AN ORDER
     # ------------------------------------------------------------------
     @api.doc("get_items_in_order")
+    @api.response(200, "The Items", [item_model])
+    @api.response(304, "The client's copy of the Items is current")
     @api.response(404, "Order not found")
-    @api.marshal_with(item_model)
+    @api.header("ETag", "The version of the Order")
+    @api.header("Last-Modified", "When the Order or one of its items last changed")
     def get(self, order_id):
         """Returns all of the Items for an Order"""
         app.logger.info("Request for all Items for Order with id: %s", order_id)
-
-        # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' could not be found.",
-            )
-
-        # Get the items for the order
-        results = [item.serialize() for item in order.items]
-
-        return results, status.HTTP_200_OK
+        rendered, headers = read_order(order_id)
+        if rendered is None:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(rendered["items"], mimetype="application/json", headers=headers)
 
     # ------------------------------------------------------------------
     # ADD AN ITEM IN AN ORDER
@@ -450,7 +630,7 @@ class ItemCollection(Resource):
         """
         app.logger.info("Request to create an Item for Order with id: %s", order_id)
         # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -463,7 +643,9 @@ class ItemCollection(Resource):
 
         # Append the item to the order
         order.items.append(item)
+        replicate()
         order.update()
+        dispatcher.notify()
 
         # Prepare a message to return
         message = item.serialize()
@@ -509,7 +691,7 @@ class ItemResource(Resource):
         )
 
         # See if the item exists and abort if it doesn't
-        item = Item.find(item_id)
+        item = Item.find(item_id) if known_orders.may_exist(order_id) else None
         if not item:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -533,7 +715,7 @@ class ItemResource(Resource):
             f"Request to update item {item_id} in order with order id:{order_id}"
         )
         # Check if order exists
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
@@ -553,7 +735,9 @@ class ItemResource(Resource):
         item.deserialize(data)
         item.id = item_id
         if item:
+            replicate()
             Item.update(item)
+            dispatcher.notify()
         # Return the updated order
         return item.serialize(), status.HTTP_200_OK
 
@@ -567,14 +751,16 @@ class ItemResource(Resource):
         """Delete an item from an order"""
         app.logger.info(f"Request to delete Item {item_id} from Order id: {order_id}")
         # Check if order exists
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
         item = Item.find(item_id)
         if item:
+            replicate()
             item.delete()
+            dispatcher.notify()
         return "", status.HTTP_204_NO_CONTENT
 
 
@@ -597,7 +783,194 @@ class TriggerResource(Resource):
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-def abort(error_code: int, message: str):
-    """Logs errors before aborting"""
+def abort(error_code: int, message: str, **kwargs):
+    """Logs errors before aborting, with any other fields of the error body"""
     app.logger.error(message)
-    api.abort(error_code, message)
+    api.abort(error_code, message, **kwargs)
+
+
+def requested_fields(args):
+    """Returns the Order fields a request asked for, or None for all of them"""
+    if not args["fields"]:
+        return None
+    selected_fields = [field.strip() for field in args["fields"].split(",") if field.strip()]
+    if not selected_fields:
+        return None
+    unknown = [field for field in selected_fields if field not in Order.FIELDS]
+    if unknown:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Unknown fields {', '.join(unknown)}; Orders have {', '.join(Order.FIELDS)}",
+        )
+    if args["include"] == "items" and "items" not in selected_fields:
+        selected_fields.append("items")
+    return selected_fields
+
+
+def read_order(order_id, selected_fields=None):
+    """Returns an Order rendered as JSON along with its ETag and Last-Modified
+
+    A rendered Order is a dictionary of its version, its updated_at and
+    the body of GET /orders/<id> ("order"). A whole Order also has the body
+    of GET /orders/<id>/items ("items"), which is left out of the order body
+    and spliced back in by order_body(), so the items are held only once.
+    Whole Orders are cached, so reading one again only looks it up. A
+    projection is rendered from the cached Order, or read from the database
+    on its own and not cached, since it is read to save loading the rest. When the client's copy is current the Order is not
+    read at all, only its version, and None is returned for it.
+
+    An id the filter of known orders does not hold is answered with 404
+    without a query, and one found missing in the database is cached as
+    MISSING for ORDER_MISSING_TTL seconds.
+    """
+    rendered = order_cache.get(order_id) if known_orders.may_exist(order_id) else MISSING
+    if rendered is None:
+        if request.if_none_match or request.if_modified_since:
+            epoch = order_cache.epoch()
+            row = Order.find_version(order_id)
+            if row is None:
+                order_cache.put(order_id, MISSING, epoch, app.config["ORDER_MISSING_TTL"])
+                rendered = MISSING
+            elif not_modified(row.version, row.updated_at):
+                return None, validator_headers(row.version, row.updated_at)
+    if rendered is None:
+        rendered = render_order(order_id, selected_fields)
+    if rendered.get("missing"):
+        abort(
+            status.HTTP_404_NOT_FOUND,
+            f"Order with id '{order_id}' could not be found.",
+        )
+    if selected_fields is not None and "items" in rendered:
+        data = marshal_fields(json.loads(order_body(rendered)), selected_fields)
+        rendered = {"version": rendered["version"], "updated_at": rendered["updated_at"], "order": render(data)}
+
+    headers = order_headers(rendered)
+    if not_modified(rendered["version"], datetime.fromisoformat(rendered["updated_at"])):
+        return None, headers
+    return rendered, headers
+
+
+def render_order(order_id, selected_fields=None):
+    """Reads an Order from the database and renders it, caching it if it is whole"""
+    epoch = order_cache.epoch()
+    order = Order.find(order_id, with_items=True, fields=selected_fields, keys=("version", "updated_at"))
+    if not order:
+        order_cache.put(order_id, MISSING, epoch, app.config["ORDER_MISSING_TTL"])
+        return MISSING
+    data = marshal_fields(order.serialize(selected_fields), selected_fields)
+    rendered = {"version": order.version, "updated_at": order.updated_at.isoformat()}
+    if selected_fields is not None:
+        rendered["order"] = render(data)
+        return rendered
+    items = render(data["items"])
+    data["items"] = ITEMS_MARK
+    body = render(data)
+    mark = json.dumps(ITEMS_MARK)
+    rendered["splice"] = body.index(mark)
+    rendered["order"] = body.replace(mark, "", 1)
+    rendered["items"] = items
+    order_cache.put(order_id, rendered, epoch)
+    return rendered
+
+
+def order_body(rendered):
+    """Returns the body of GET /orders/<id> of a rendered Order, with its items spliced in"""
+    if "splice" not in rendered:
+        return rendered["order"]
+    order, splice = rendered["order"], rendered["splice"]
+    return order[:splice] + rendered["items"].rstrip("\n") + order[splice:]
+
+
+def find_order(order_id, **options):
+    """Returns an Order by id like Order.find, or None without a query if it is not known"""
+    if not known_orders.may_exist(order_id):
+        return None
+    return Order.find(order_id, **options)
+
+
+def render(data):
+    """Returns a response body the way the API would write it"""
+    settings = dict(app.config.get("RESTX_JSON", {}))
+    if app.debug:
+        settings.setdefault("indent", 4)
+    return json.dumps(data, **settings) + "\n"
+
+
+def validator_headers(version, updated_at):
+    """Returns the ETag and Last-Modified headers of a version of an Order"""
+    return {"ETag": quote_etag(str(version)), "Last-Modified": http_date(as_utc(updated_at))}
+
+
+def order_headers(data):
+    """Returns the ETag and Last-Modified headers of a serialized or rendered Order"""
+    return validator_headers(data["version"], datetime.fromisoformat(data["updated_at"]))
+
+
+def as_utc(when):
+    """Returns a time the database holds as naive UTC as an aware one"""
+    return when.replace(tzinfo=timezone.utc) if when.tzinfo is None else when.astimezone(timezone.utc)
+
+
+def not_modified(version, updated_at):
+    """Says whether If-None-Match or If-Modified-Since shows the client has this version
+
+    If-Modified-Since is only looked at without If-None-Match, and to the
+    second, the precision of an HTTP date.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(str(version))
+    if request.if_modified_since:
+        return as_utc(updated_at).replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def find_order_to_change(order_id):
+    """Returns the Order a request is about to change, or aborts
+
+    With If-Match the Order is locked until the change is committed, and
+    refused unless the ETag the client sent is the current one, so the
+    client cannot overwrite a change it has not seen.
+    """
+    order = find_order(order_id, for_update=bool(request.if_match))
+    if not order:
+        abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+    if request.if_match and not request.if_match.contains(str(order.version)):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Order with id '{order_id}' has changed since the version in If-Match.",
+        )
+    return order
+
+
+def marshal_order(order, selected_fields=None):
+    """Returns an Order marshalled with only the fields that were asked for"""
+    return marshal_fields(order.serialize(selected_fields), selected_fields)
+
+
+def marshal_fields(data, selected_fields=None):
+    """Returns a serialized Order marshalled with only the fields that were asked for"""
+    mask = ",".join(selected_fields) if selected_fields is not None else None
+    return marshal(data, order_model, mask=mask)
+
+
+def ndjson_lines(orders, selected_fields=None):
+    """Yields Orders as marshalled JSON lines
+
+    The session is closed when the stream ends, since the response outlives
+    the request that made it.
+    """
+    try:
+        for order in orders:
+            yield json.dumps(marshal_order(order, selected_fields)) + "\n"
+    finally:
+        db.session.remove()
+
+
+def replicate():
+    """Sends the changes of the transaction about to commit to the peers
+
+    Changes that arrived from a peer are not sent on again
+    """
+    if request.headers.get("X-From-Peer") == "true" or not app.config["PEER_NODES"]:
+        return
+    OutboxEvent.capture(app.config["PEER_NODES"])
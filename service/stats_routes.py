@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Order Statistics Endpoint
+
+Reports the running totals of the orders by status, product and customer
+"""
+
+from flask import current_app as app  # Import Flask application
+from flask_restx import Resource, fields, reqparse
+from service.models import OrderStat
+from service.common import status  # HTTP Status Codes
+from service.routes import abort, api
+
+
+stat_fields = {
+    "orders": fields.Integer(readOnly=True, description="Number of orders"),
+    "quantity": fields.Integer(readOnly=True, description="Units of the items ordered"),
+    "revenue": fields.Float(readOnly=True, description="Quantity times price of the items"),
+}
+
+order_stats_model = api.model(
+    "OrderStats",
+    {
+        "orders": fields.Integer(readOnly=True, description="Number of orders"),
+        "revenue": fields.Float(
+            readOnly=True, description="Revenue of the orders that were not cancelled"
+        ),
+        "by_status": fields.List(
+            fields.Nested(api.model("StatusStats", {"status": fields.String, **stat_fields}))
+        ),
+        "by_product": fields.List(
+            fields.Nested(api.model("ProductStats", {"product_name": fields.String, **stat_fields}))
+        ),
+        "by_customer": fields.List(
+            fields.Nested(api.model("CustomerStats", {"customer_name": fields.String, **stat_fields}))
+        ),
+    },
+)
+
+# query string arguments for the order statistics
+stats_args = reqparse.RequestParser()
+stats_args.add_argument(
+    "top",
+    type=int,
+    location="args",
+    required=False,
+    default=10,
+    help="How many products and customers to return, by revenue",
+)
+
+
+######################################################################
+#  PATH: /orders/stats
+######################################################################
+@api.route("/orders/stats")
+class OrderStatistics(Resource):
+    """Running totals of the orders"""
+
+    @api.doc("get_order_stats")
+    @api.expect(stats_args, validate=True)
+    @api.response(400, "The query was not valid")
+    @api.marshal_with(order_stats_model)
+    def get(self):
+        """
+        Returns the orders by status and the top products and customers
+
+        The totals are kept up to date by every change to the orders, so
+        reading them does not depend on how many orders there are.
+        """
+        app.logger.info("Request for the order statistics")
+        top = stats_args.parse_args()["top"]
+        if not 0 <= top <= app.config["ORDERS_MAX_PAGE_SIZE"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Top must be from 0 to {app.config['ORDERS_MAX_PAGE_SIZE']}",
+            )
+        return OrderStat.report(top), status.HTTP_200_OK
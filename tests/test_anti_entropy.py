@@ -0,0 +1,392 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Anti-Entropy Repair Test Suite
+"""
+
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from service.common import status
+from service.common.anti_entropy import (
+    BUCKET_PATH,
+    LEASE,
+    TREE_PATH,
+    AntiEntropy,
+    MerkleTree,
+    anti_entropy,
+    bucket_of,
+    bucket_records,
+    bucket_rows,
+    clear_tree,
+)
+from service.models import Item, JobLease, Order, OrderStatus, Tombstone, db
+from tests.factories import OrderFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+PEER = "http://peer-1"
+# the longest request line gunicorn accepts by default
+MAX_REQUEST_LINE = 4094
+
+
+class FakePeer:  # pylint: disable=too-few-public-methods
+    """Answers anti-entropy requests from a snapshot of this node"""
+
+    def __init__(self, bucket_size, fanout):
+        self.tree = MerkleTree.scan(bucket_size, fanout)
+        buckets = set(self.tree.leaves) | {
+            bucket_of(tombstone.entity_id, bucket_size) for tombstone in Tombstone.query
+        }
+        self.buckets = {bucket: bucket_rows(bucket, bucket_size) for bucket in buckets}
+        ids = [order_id for (order_id,) in db.session.query(Order.id)]
+        self.records = {bucket: bucket_records(bucket, bucket_size, ids) for bucket in buckets}
+        self.requests = []
+
+    def fetch(self, peer, path, params=None, timeout=None):  # pylint: disable=unused-argument
+        """Stands in for peers.fetch_from_peer"""
+        self.requests.append((path, params))
+        if len(f"GET {path}?{urlencode(params or {})} HTTP/1.1") > MAX_REQUEST_LINE:
+            return None
+        if path == TREE_PATH:
+            result = self.tree.info()
+            if params:
+                level = params["level"]
+                result["hashes"] = {
+                    i: self.tree.node_hash(level, int(i)) for i in params["index"].split(",")
+                }
+            return result
+        bucket = int(path.rsplit("/", 1)[1])
+        if params:
+            records = self.records.get(bucket, {})
+            return {"records": {i: records[i] for i in params["ids"].split(",") if i in records}}
+        return self.buckets.get(bucket, {"orders": {}, "deleted": {}})
+
+
+class AntiEntropyTestBase(TestBase):
+    """Sets up a peer and a small tree for the anti-entropy tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.config = dict(app.config)
+        app.config["PEER_NODES"] = [PEER]
+        app.config["ANTI_ENTROPY_BUCKET_SIZE"] = 4
+        app.config["ANTI_ENTROPY_FANOUT"] = 2
+        clear_tree()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        clear_tree()
+        super().tearDown()
+
+    def _create_numbered_orders(self, ids):
+        """Creates orders with the given ids through the API"""
+        for order_id in ids:
+            order = OrderFactory(id=order_id)
+            data = order.serialize()
+            data["items"] = [{"product_name": "widget", "quantity": 1, "price": 2.5}]
+            resp = self.client.post("/api/orders", json=data)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def _build_tree(self):
+        """Builds the stored tree the way the repairer does"""
+        self.assertTrue(JobLease.acquire(LEASE, anti_entropy.holder, 60))
+        anti_entropy.rebuild_tree()
+
+    def _bucket_requests(self, peer):
+        """Returns the bucket paths a fake peer was asked for"""
+        return [path for path, params in peer.requests if path.startswith(BUCKET_PATH) and not params]
+
+
+######################################################################
+#  R E P A I R   T E S T   C A S E S
+######################################################################
+class TestAntiEntropy(AntiEntropyTestBase):
+    """Anti-Entropy Repair Tests"""
+
+    def test_tree_is_stable(self):
+        """It should build the same tree for the same orders"""
+        self._create_numbered_orders(range(1, 30))
+        first = MerkleTree.scan(4, 2)
+        second = MerkleTree.scan(4, 2)
+        self.assertEqual(first.node_hash(first.top_level, 0), second.node_hash(second.top_level, 0))
+        self.assertNotEqual(first.node_hash(first.top_level, 0), "")
+        self.assertEqual(first.node_hash(0, 999), "")
+
+    def test_tree_root(self):
+        """It should find the lowest node that covers a range of buckets"""
+        tree = MerkleTree(4, 2)
+        self.assertEqual(tree.top_level, 30)
+        self.assertEqual(tree.root(bucket_of(1, 4), bucket_of(3, 4)), (0, bucket_of(1, 4)))
+        self.assertEqual(tree.root(bucket_of(1, 4), bucket_of(7, 4)), (1, bucket_of(1, 4) // 2))
+        # negative and positive ids meet at the top of the tree
+        self.assertEqual(tree.root(bucket_of(-5, 4), bucket_of(5, 4)), (30, 0))
+        self.assertEqual(tree.root(0, 2**40), (30, 0))
+        self.assertEqual(list(tree.children(1)), [2, 3])
+
+    def test_negative_ids(self):
+        """It should put negative ids in buckets below the positive ones"""
+        self._create_numbered_orders([-5, 5])
+        tree = MerkleTree.scan(4, 2)
+        self.assertEqual(sorted(tree.leaves), [bucket_of(-5, 4), bucket_of(5, 4)])
+        self.assertLess(bucket_of(-5, 4), bucket_of(5, 4))
+        self.assertEqual(list(bucket_rows(bucket_of(-5, 4), 4)["orders"]), ["-5"])
+
+    def test_repair_differences(self):
+        """It should copy over only the orders that differ"""
+        self._create_numbered_orders(range(1, 41))
+        self.client.delete("/api/orders/12")
+        peer = FakePeer(4, 2)
+
+        # order 5 was deleted here after the snapshot
+        self.client.delete("/api/orders/5")
+        # order 12 came back here from a node that missed the delete
+        order = OrderFactory(id=12)
+        order.create()
+        order.updated_at = datetime(2000, 1, 1)
+        db.session.commit()
+        # order 22 is missing here and nobody deleted it
+        db.session.query(Item).filter(Item.order_id == 22).delete()
+        db.session.query(Order).filter(Order.id == 22).delete()
+        db.session.commit()
+        # order 30 was changed on the peer after it changed here
+        order = Order.find(30)
+        order.customer_name = "Stale Name"
+        order.version = 1
+        order.update()
+
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            repaired = anti_entropy.repair_peer(PEER)
+
+        self.assertEqual(repaired, 3)
+        self.assertIsNone(Order.find(5))
+        self.assertIsNone(Order.find(12))
+        # the delete keeps the time it happened on the peer
+        deleted_at = peer.buckets[bucket_of(12, 4)]["deleted"]["12"]
+        self.assertEqual(
+            db.session.get(Tombstone, ("order", 12)).deleted_at.isoformat(), deleted_at
+        )
+        self.assertIsNotNone(Order.find(22))
+        self.assertEqual(len(Order.find(22).items), 1)
+        self.assertNotEqual(Order.find(30).customer_name, "Stale Name")
+        # only the four differing buckets were fetched out of eleven
+        self.assertEqual(len(self._bucket_requests(peer)), 4)
+
+        # the peer's timestamps came along, so a second pass finds nothing
+        peer.requests = []
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+
+    def test_repair_many_buckets(self):
+        """It should ask for long lists of tree nodes and orders a chunk at a time"""
+        first = 2_000_000_000
+        # orders in buckets under more than one wide node, whose children
+        # are all asked for, and six hundred orders in one bucket
+        for bucket_size, fanout, ids in [
+            (4, 512, range(first, first + 4096, 512)),
+            (1024, 2, range(first, first + 600)),
+        ]:
+            with self.subTest(bucket_size=bucket_size, fanout=fanout):
+                app.config["ANTI_ENTROPY_BUCKET_SIZE"] = bucket_size
+                app.config["ANTI_ENTROPY_FANOUT"] = fanout
+                db.session.add_all(
+                    Order(id=order_id, customer_name="Ann", status=OrderStatus.CREATED) for order_id in ids
+                )
+                db.session.commit()
+                peer = FakePeer(bucket_size, fanout)
+                # lost here without a trace
+                db.session.query(Order).delete()
+                db.session.commit()
+                clear_tree()
+
+                with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+                    self.assertEqual(anti_entropy.repair_peer(PEER), len(ids))
+                self.assertEqual(Order.query.count(), len(ids))
+                db.session.query(Order).delete()
+                db.session.commit()
+
+    def test_keep_newer_local_changes(self):
+        """It should not overwrite an order that changed here more recently"""
+        self._create_numbered_orders(range(1, 5))
+        peer = FakePeer(4, 2)
+        order = Order.find(2)
+        order.customer_name = "Newer Name"
+        order.update()
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+        self.assertEqual(Order.find(2).customer_name, "Newer Name")
+
+    def test_keep_recreated_order(self):
+        """It should not delete an order created again after the peer deleted it"""
+        self._create_numbered_orders([3])
+        self.client.delete("/api/orders/3")
+        peer = FakePeer(4, 2)
+        self._create_numbered_orders([3])
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+        self.assertIsNotNone(Order.find(3))
+
+    def test_nothing_to_repair(self):
+        """It should not fetch any buckets when the trees match"""
+        self._create_numbered_orders(range(1, 20))
+        peer = FakePeer(4, 2)
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+        self.assertEqual(len(peer.requests), 2)
+
+    def test_empty_nodes(self):
+        """It should do nothing when neither node has orders"""
+        peer = FakePeer(4, 2)
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+
+    def test_unreachable_peer(self):
+        """It should give up when the peer cannot be reached"""
+        with patch(
+            "service.common.anti_entropy.peers.fetch_from_peer", return_value=None
+        ):
+            self.assertEqual(anti_entropy.repair_all(), {PEER: 0})
+
+    def test_different_tree_shape(self):
+        """It should not compare against a peer with a different tree shape"""
+        self._create_numbered_orders(range(1, 5))
+        peer = FakePeer(8, 2)
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", peer.fetch):
+            self.assertEqual(anti_entropy.repair_peer(PEER), 0)
+
+    def test_repair_all_database_error(self):
+        """It should carry on with the next peer after a database error"""
+        with patch.object(
+            anti_entropy, "repair_peer", side_effect=db.exc.SQLAlchemyError("boom")
+        ):
+            self.assertEqual(anti_entropy.repair_all(), {PEER: 0})
+
+    def test_background_thread(self):
+        """It should repair from a background thread"""
+        app.config["ANTI_ENTROPY_INTERVAL"] = 0.01
+        background = AntiEntropy(app)
+        with patch.object(background, "repair_all") as mock_repair:
+            background.start()
+            background.start()  # already running
+            background._thread.join(0.2)
+        self.assertTrue(mock_repair.called)
+        app.extensions["anti_entropy"] = anti_entropy
+
+    ######################################################################
+    #  L E A S E
+    ######################################################################
+
+    def test_single_repairer(self):
+        """It should leave the repair to the process holding the lease"""
+        self.assertTrue(JobLease.acquire(LEASE, "other-host:1", 60))
+        with patch("service.common.anti_entropy.peers.fetch_from_peer") as mock_fetch:
+            self.assertEqual(anti_entropy.repair_all(), {})
+        mock_fetch.assert_not_called()
+        self.assertFalse(JobLease.acquire(LEASE, anti_entropy.holder, 60))
+
+    def test_take_over_expired_lease(self):
+        """It should take over the repair once the holder stops renewing it"""
+        self.assertTrue(JobLease.acquire(LEASE, "other-host:1", 60))
+        lease = db.session.get(JobLease, LEASE)
+        lease.expires_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+        with patch("service.common.anti_entropy.peers.fetch_from_peer", return_value=None):
+            self.assertEqual(anti_entropy.repair_all(), {PEER: 0})
+        self.assertEqual(db.session.get(JobLease, LEASE).holder, anti_entropy.holder)
+        self.assertIsNotNone(JobLease.completed_at_of(LEASE))
+
+
+######################################################################
+#  T O M B S T O N E   A N D   E N D P O I N T   T E S T   C A S E S
+######################################################################
+class TestAntiEntropyEndpoints(AntiEntropyTestBase):
+    """Tombstone and Anti-Entropy Endpoint Tests"""
+
+    def test_delete_writes_tombstone(self):
+        """It should remember deleted orders until they are created again"""
+        self._create_numbered_orders([7])
+        self.client.delete("/api/orders/7")
+        self.assertTrue(Tombstone.exists("order", 7))
+        self._create_numbered_orders([7])
+        self.assertFalse(Tombstone.exists("order", 7))
+
+    def test_prune_tombstones(self):
+        """It should forget tombstones after a while"""
+        self._create_numbered_orders([7])
+        self.client.delete("/api/orders/7")
+        self.assertEqual(Tombstone.prune(datetime(2000, 1, 1)), 0)
+        self.assertEqual(Tombstone.prune(datetime(2999, 1, 1)), 1)
+
+    ######################################################################
+    #  E N D P O I N T S
+    ######################################################################
+
+    def test_get_tree(self):
+        """It should return the shape and node hashes of the stored tree"""
+        self._create_numbered_orders(range(1, 10))
+        resp = self.client.get(TREE_PATH)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        self._build_tree()
+        resp = self.client.get(TREE_PATH)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["min_bucket"], bucket_of(1, 4))
+        self.assertEqual(data["max_bucket"], bucket_of(9, 4))
+        self.assertEqual(data["top_level"], 30)
+        self.assertNotIn("hashes", data)
+
+        first, empty = bucket_of(1, 4), bucket_of(100, 4)
+        resp = self.client.get(TREE_PATH, query_string={"level": 0, "index": f"{first},{empty}"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        hashes = resp.get_json()["hashes"]
+        self.assertNotEqual(hashes[str(first)], "")
+        self.assertEqual(hashes[str(empty)], "")
+
+    def test_get_tree_bad_args(self):
+        """It should not return nodes for bad levels or indexes"""
+        self._build_tree()
+        resp = self.client.get(TREE_PATH, query_string={"level": 0, "index": "a,b"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(TREE_PATH, query_string={"level": -1, "index": "0"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(TREE_PATH, query_string={"level": 31, "index": "0"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(TREE_PATH, query_string={"level": 10**9, "index": "0"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_bucket(self):
+        """It should return the digests of the orders in a bucket"""
+        self._create_numbered_orders(range(1, 10))
+        self.client.delete("/api/orders/6")
+        bucket = bucket_of(4, 4)
+        resp = self.client.get(f"{BUCKET_PATH}/{bucket}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sorted(data["orders"]), ["4", "5", "7"])
+        self.assertIn("digest", data["orders"]["4"])
+        self.assertEqual(list(data["deleted"]), ["6"])
+        self.assertNotIn("records", data)
+
+        resp = self.client.get(f"{BUCKET_PATH}/{bucket}", query_string={"ids": "4,6,9"})
+        records = resp.get_json()["records"]
+        self.assertEqual(list(records), ["4"])
+        self.assertEqual(records["4"]["items"][0]["price"], "2.50")
+
+        resp = self.client.get(f"{BUCKET_PATH}/{bucket}", query_string={"ids": "x"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
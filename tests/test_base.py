@@ -4,10 +4,28 @@ Base Test Case for Order Service Test Suite
 
 import logging
 import os
+from contextlib import contextmanager
 from unittest import TestCase
 
-from service.common import status
-from service.models import Item, Order, db
+from sqlalchemy import event
+
+from service.common import peers, status
+from service.common.known_orders import known_orders
+from service.models import (
+    Change,
+    ChangeHorizon,
+    IdempotencyKey,
+    Item,
+    JobLease,
+    MerkleLeaf,
+    Order,
+    OrderStat,
+    OutboxDelivery,
+    OutboxEvent,
+    PeerCursor,
+    Tombstone,
+    db,
+)
 from tests.factories import OrderFactory
 from wsgi import app
 
@@ -16,6 +34,19 @@ DATABASE_URI = os.getenv(
 )
 
 
+def use_peers(test, peer_nodes, **settings):
+    """Points the app at peer nodes for one test, and back once it ends
+
+    The connections and health of the peers are forgotten before and after.
+    """
+    config = dict(app.config)
+    app.config["PEER_NODES"] = peer_nodes
+    app.config.update(settings)
+    peers.manager.reset()
+    test.addCleanup(app.config.update, config)
+    test.addCleanup(peers.manager.reset)
+
+
 class TestBase(TestCase):
     """Base Test Case with common setup and helper methods"""
 
@@ -39,12 +70,45 @@ class TestBase(TestCase):
         self.client = app.test_client()
         db.session.query(Order).delete()  # clean up the last tests
         db.session.query(Item).delete()  # clean up the last tests
+        db.session.query(OutboxDelivery).delete()
+        db.session.query(OutboxEvent).delete()
+        db.session.query(PeerCursor).delete()
+        db.session.query(Tombstone).delete()
+        db.session.query(MerkleLeaf).delete()
+        db.session.query(JobLease).delete()
+        db.session.query(IdempotencyKey).delete()
+        db.session.query(Change).delete()
+        db.session.query(ChangeHorizon).delete()
+        db.session.query(OrderStat).delete()
         db.session.commit()
+        known_orders.may_exist(0)  # fill the filter before queries are counted
 
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
 
+    @contextmanager
+    def count_queries(self):
+        """Counts the SQL statements run inside the block"""
+        statements = []
+
+        def count(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+    def _post_order(self, order):
+        """Posts an Order and returns the Order that was created"""
+        resp = self.client.post(
+            "/api/orders", json=order.serialize(), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
     def _create_orders(self, count):
         """Factory method to create orders in bulk"""
         orders = []
@@ -0,0 +1,167 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Feed Test Suite
+"""
+
+import runpy
+import threading
+import time
+from datetime import datetime
+
+from service.common import status
+from service.models import Change, ChangeHorizon, db
+from tests.factories import OrderFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+FEED_URL = "/api/orders/changes"
+
+
+class TestChangeFeed(TestBase):
+    """Change Feed Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.config = dict(app.config)
+        app.config["CHANGE_FEED_POLL_INTERVAL"] = 0.1
+        app.config["CHANGE_FEED_STREAM_DURATION"] = 0.3
+
+    def tearDown(self):
+        app.config.update(self.config)
+        super().tearDown()
+
+    def test_changes_in_commit_order(self):
+        """It should list the changes after a cursor in commit order"""
+        order = self._create_orders(1)[0]
+        data = order.serialize()
+        data["customer_name"] = "Jane Doe"
+        self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        self.client.delete(f"{BASE_URL}/{order.id}")
+
+        resp = self.client.get(FEED_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        changes = data["changes"]
+        self.assertEqual([change["op"] for change in changes], ["create", "patch", "delete"])
+        self.assertTrue(all(change["id"] == order.id for change in changes))
+        self.assertEqual(changes[1]["data"]["fields"], {"customer_name": "Jane Doe"})
+        self.assertEqual(data["cursor"], changes[-1]["cursor"])
+
+        # paging on from a cursor
+        resp = self.client.get(FEED_URL, query_string={"since": changes[0]["cursor"], "limit": 1})
+        self.assertEqual(resp.get_json()["changes"], changes[1:2])
+        resp = self.client.get(FEED_URL, query_string={"since": data["cursor"]})
+        self.assertEqual(resp.get_json(), {"changes": [], "cursor": data["cursor"]})
+
+    def test_bad_limit(self):
+        """It should refuse a limit out of range"""
+        resp = self.client.get(FEED_URL, query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(FEED_URL, query_string={"since": "abc"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_long_poll(self):
+        """It should wait for the next change instead of returning nothing"""
+
+        def create_later():
+            time.sleep(0.2)
+            with app.app_context():
+                OrderFactory().create()
+                db.session.remove()
+
+        writer = threading.Thread(target=create_later)
+        writer.start()
+        start = time.monotonic()
+        resp = self.client.get(FEED_URL, query_string={"wait": 5})
+        writer.join()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(len(resp.get_json()["changes"]), 1)
+
+    def test_long_poll_times_out(self):
+        """It should return an empty page when nothing changes in time"""
+        start = time.monotonic()
+        resp = self.client.get(FEED_URL, query_string={"since": 7, "wait": 0.2})
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(resp.get_json(), {"changes": [], "cursor": 7})
+
+    def test_event_stream(self):
+        """It should stream changes as Server-Sent Events"""
+        self._create_orders(2)
+        first, second = [change.id for change in Change.since(0, 10)]
+        headers = {"Accept": "text/event-stream"}
+        resp = self.client.get(FEED_URL, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        body = resp.get_data(as_text=True)
+        self.assertIn(f"id: {first}\nevent: change\n", body)
+        self.assertIn(f"id: {second}\n", body)
+        self.assertIn(": keep-alive", body)
+
+        # a reconnecting client resumes after the last event it received
+        headers["Last-Event-ID"] = str(first)
+        body = self.client.get(FEED_URL, headers=headers).get_data(as_text=True)
+        self.assertNotIn(f"id: {first}\n", body)
+        self.assertIn(f"id: {second}\n", body)
+
+    def test_prune_changes(self):
+        """It should prune old changes and tell readers behind them to read the orders again"""
+        self._create_orders(2)
+        first, second = [change.id for change in Change.since(0, 10)]
+        self.assertEqual(Change.prune(datetime(2000, 1, 1)), 0)
+        self.assertEqual(ChangeHorizon.current(), 0)
+        self.assertEqual(Change.prune(datetime(2999, 1, 1)), 2)
+        self.assertEqual(ChangeHorizon.current(), second)
+        self._create_orders(1)
+        third = Change.newest()
+
+        for since in (0, first):
+            resp = self.client.get(FEED_URL, query_string={"since": since})
+            self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+            self.assertEqual(resp.get_json()["cursor"], third)
+        headers = {"Accept": "text/event-stream", "Last-Event-ID": str(first)}
+        resp = self.client.get(FEED_URL, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+
+        resp = self.client.get(FEED_URL, query_string={"since": second})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([change["cursor"] for change in resp.get_json()["changes"]], [third])
+
+    def test_gunicorn_outlasts_streams(self):
+        """It should run gunicorn on threads with a timeout longer than a stream"""
+        settings = runpy.run_path("gunicorn.conf.py")
+        self.assertEqual(settings["worker_class"], "gthread")
+        self.assertGreater(settings["timeout"], self.config["CHANGE_FEED_STREAM_DURATION"])
+        self.assertGreater(settings["timeout"], self.config["CHANGE_FEED_MAX_WAIT"])
+
+    def test_replicated_changes(self):
+        """It should log replicated changes but not rejected ones"""
+        order = OrderFactory()
+        data = order.serialize()
+        data["items"] = []
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": data},
+            {"seq": 2, "op": "update", "entity": "order", "id": order.id, "data": {"id": order.id}},
+            {"seq": 3, "op": "patch", "entity": "order", "id": order.id, "data": {"fields": {"customer_name": "Jo"}}},
+        ]
+        resp = self.client.post(
+            "/api/replication/batch", json={"mutations": mutations}, headers={"X-From-Peer": "true"}
+        )
+        self.assertEqual(resp.get_json()["rejected"], [2])
+        changes = Change.since(0, 10)
+        self.assertEqual([change.op for change in changes], ["create", "patch"])
@@ -24,7 +24,13 @@ from unittest.mock import MagicMock, patch
 
 from click.testing import CliRunner
 
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    changes_prune,
+    db_create,
+    db_indexes,
+    db_upgrade,
+    stats_rebuild,
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -40,3 +46,49 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch("service.common.cli_commands.create_indexes")
+    def test_db_indexes(self, create_mock):
+        """It should report the indexes the db-indexes command built"""
+        create_mock.return_value = ["ix_item_order_id"]
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Built index ix_item_order_id", result.output)
+
+        create_mock.return_value = []
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+        self.assertIn("already built", result.output)
+
+    @patch("service.common.cli_commands.add_columns")
+    def test_db_upgrade(self, add_mock):
+        """It should report the columns the db-upgrade command added"""
+        add_mock.return_value = ["item.uid"]
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Added column item.uid", result.output)
+
+        add_mock.return_value = []
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+        self.assertIn("already there", result.output)
+
+    @patch("service.common.cli_commands.OrderStat")
+    def test_stats_rebuild(self, stat_mock):
+        """It should rebuild the order statistics"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(stats_rebuild)
+        self.assertEqual(result.exit_code, 0)
+        stat_mock.rebuild.assert_called_once()
+
+    @patch("service.common.cli_commands.Change")
+    def test_changes_prune(self, change_mock):
+        """It should prune the changes past their retention"""
+        change_mock.prune.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(changes_prune)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pruned 3 change(s)", result.output)
+        change_mock.prune.assert_called_once()
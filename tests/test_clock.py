@@ -0,0 +1,106 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Hybrid Logical Clock and Version Test Suite
+"""
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from service.models import Item, Order
+from service.models.clock import MAX_COUNTER, HybridLogicalClock, decode, encode
+from tests.test_base import TestBase
+
+
+class TestHybridLogicalClock(TestCase):
+    """Hybrid Logical Clock Tests"""
+
+    def test_encode_decode(self):
+        """It should pack and unpack the parts of a version"""
+        self.assertEqual(decode(encode(1_700_000_000_000, 5, 7)), (1_700_000_000_000, 5, 7))
+        self.assertLess(encode(1_700_000_000_000, MAX_COUNTER, 1023), 2**63)
+
+    def test_now_moves_forward(self):
+        """It should hand out increasing versions when the wall clock stands still"""
+        clock = HybridLogicalClock(node_id=3, wall=lambda: 1000)
+        versions = [clock.now() for _ in range(3)]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual([decode(version)[1] for version in versions], [0, 1, 2])
+        self.assertTrue(all(decode(version)[2] == 3 for version in versions))
+
+    def test_counter_overflow(self):
+        """It should borrow the next millisecond when the counter runs out"""
+        clock = HybridLogicalClock(wall=lambda: 1000)
+        for _ in range(MAX_COUNTER + 1):
+            clock.now()
+        self.assertEqual(decode(clock.now())[:2], (1001, 0))
+
+    def test_wall_clock_goes_back(self):
+        """It should not go back when the wall clock does"""
+        wall = MagicMock(side_effect=[2000, 1000])
+        clock = HybridLogicalClock(wall=wall)
+        first = clock.now()
+        self.assertGreater(clock.now(), first)
+
+    def test_observe(self):
+        """It should give later versions than one seen from a peer"""
+        clock = HybridLogicalClock(node_id=1, wall=lambda: 1000)
+        remote = encode(5000, 9, 2)
+        clock.observe(remote)
+        self.assertEqual(decode(clock.now()), (5000, 10, 1))
+        # an older version changes nothing
+        clock.observe(encode(10, 0, 2))
+        self.assertEqual(decode(clock.now()), (5000, 11, 1))
+
+    def test_versions_do_not_tie(self):
+        """It should order changes made at the same moment on two nodes"""
+        first = HybridLogicalClock(node_id=1, wall=lambda: 1000).now()
+        second = HybridLogicalClock(node_id=2, wall=lambda: 1000).now()
+        self.assertNotEqual(first, second)
+
+    def test_init_app(self):
+        """It should take its node id from the configuration"""
+        clock = HybridLogicalClock()
+        clock.init_app(MagicMock(config={"NODE_ID": 42}))
+        self.assertEqual(clock.node_id, 42)
+        self.assertRaises(ValueError, clock.init_app, MagicMock(config={"NODE_ID": 1024}))
+
+
+class TestVersions(TestBase):
+    """Record Version Tests"""
+
+    def test_changes_get_new_versions(self):
+        """It should stamp a new version on every change"""
+        order = self._create_orders(1)[0]
+        order = Order.find(order.id)
+        created = order.version
+        self.assertGreater(created, 0)
+
+        order.customer_name = "Jane Doe"
+        order.update()
+        self.assertGreater(order.version, created)
+        # and each field changed the version of that change
+        self.assertEqual(order.field_versions, {"customer_name": order.version})
+
+        # adding an item changes the order too
+        updated = order.version
+        item = Item(product_name="widget", quantity=1, price=1)
+        order.items.append(item)
+        order.update()
+        self.assertGreater(order.version, updated)
+        self.assertGreater(item.version, 0)
+        self.assertEqual(order.serialize()["version"], order.version)
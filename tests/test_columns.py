@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for Column management
+"""
+
+from sqlalchemy import inspect, text
+
+from service.models import Item, Order, add_columns, db, missing_columns
+from tests.test_base import TestBase
+
+
+######################################################################
+#  C O L U M N   T E S T   C A S E S
+######################################################################
+class TestColumns(TestBase):
+    """Column management Tests"""
+
+    def setUp(self):
+        super().setUp()
+        db.session.remove()
+
+    def tearDown(self):
+        add_columns()
+        super().tearDown()
+
+    def _columns(self, table):
+        """Returns {name: column} of a table in the database"""
+        return {column["name"]: column for column in inspect(db.engine).get_columns(table)}
+
+    def test_add_on_create_all(self):
+        """It should add the missing columns whenever the tables are created"""
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "order" DROP COLUMN version'))
+        db.create_all()
+        self.assertEqual(missing_columns(), [])
+
+    def test_nothing_missing(self):
+        """It should find every column of the models in the database"""
+        self.assertEqual(missing_columns(), [])
+        self.assertEqual(add_columns(), [])
+
+    def test_add_missing_columns(self):
+        """It should add the version and uid columns to tables made before them"""
+        with db.engine.begin() as connection:
+            connection.execute(
+                text("""INSERT INTO "order" (id, customer_name, status, created_at, updated_at, version) """
+                     """VALUES (1, 'Ann', 'CREATED', now(), now(), 1)""")
+            )
+            for product in ("bolt", "nut"):
+                connection.execute(
+                    text("INSERT INTO item (uid, order_id, product_name, quantity, price, created_at, "
+                         "updated_at, version) VALUES (:uid, 1, :product, 1, 1, now(), now(), 1)"),
+                    {"uid": product, "product": product},
+                )
+            connection.execute(text('ALTER TABLE "order" DROP COLUMN version'))
+            connection.execute(text("ALTER TABLE item DROP COLUMN uid"))
+        self.assertCountEqual(
+            [f"{column.table.name}.{column.name}" for column in missing_columns()],
+            ["order.version", "item.uid"],
+        )
+
+        self.assertCountEqual(add_columns(), ["order.version", "item.uid"])
+        self.assertEqual(missing_columns(), [])
+        self.assertFalse(self._columns(Order.__tablename__)["version"]["nullable"])
+        self.assertFalse(self._columns(Item.__tablename__)["uid"]["nullable"])
+        unique = inspect(db.engine).get_indexes(Item.__tablename__)
+        self.assertIn(("item_uid_key", True), {(index["name"], index["unique"]) for index in unique})
+
+        # the rows already there can be read and changed again
+        order = Order.find(1)
+        self.assertEqual(order.version, 0)
+        uids = [item.uid for item in order.items]
+        self.assertEqual(len(set(uids)), 2)
+        self.assertTrue(all(len(uid) == 32 for uid in uids))
+        order.customer_name = "Bob"
+        order.update()
+        self.assertGreater(order.version, 0)
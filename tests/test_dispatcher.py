@@ -0,0 +1,304 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Outbox and Dispatcher Test Suite
+"""
+
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+from service.common import peers, status
+from service.common.dispatcher import BATCH_PATH, OutboxDispatcher, dispatcher
+from service.models import OrderStatus, OutboxDelivery, OutboxEvent, PeerCursor, db
+from service.models.outbox import to_json
+from tests.factories import OrderFactory
+from tests.test_base import TestBase, use_peers
+from wsgi import app
+
+BASE_URL = "/api/orders"
+PEERS = ["http://peer-1", "http://peer-2"]
+
+
+def answer(code, rejected=()):
+    """Returns what a peer answers to a batch"""
+    response = MagicMock(status_code=code)
+    response.json.return_value = {"applied": 0, "rejected": list(rejected)}
+    return response
+
+
+class TestOutbox(TestBase):
+    """Transactional Outbox Tests"""
+
+    def setUp(self):
+        super().setUp()
+        use_peers(self, PEERS, PEER_SYNC_FORWARD=False)
+
+    def test_post_writes_outbox(self):
+        """It should write an outbox event when an Order is created"""
+        order = OrderFactory()
+        resp = self.client.post(BASE_URL, json=order.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        events = OutboxEvent.query.all()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].op, "create")
+        self.assertEqual(events[0].entity, "order")
+        self.assertEqual(events[0].entity_id, order.id)
+        self.assertEqual(events[0].payload["id"], order.id)
+        mutation = events[0].serialize()
+        self.assertEqual(mutation["seq"], events[0].id)
+        self.assertEqual(mutation["op"], "create")
+
+    def test_put_and_delete_write_outbox(self):
+        """It should write outbox events for updates and deletes"""
+        order = self._create_orders(1)[0]
+        data = order.serialize()
+        data["customer_name"] = "Jane Doe"
+        resp = self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.delete(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        events = OutboxEvent.query.order_by(OutboxEvent.id).all()
+        self.assertEqual([event.op for event in events], ["create", "patch", "delete"])
+        self.assertEqual(events[1].payload["fields"], {"customer_name": "Jane Doe"})
+        self.assertIn("deleted_at", events[2].payload)
+
+    def test_cancel_writes_small_delta(self):
+        """It should send only the status when an Order is cancelled"""
+        order = OrderFactory(status=OrderStatus.CREATED)
+        resp = self.client.post(BASE_URL, json=order.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.put(f"{BASE_URL}/{order.id}/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        event = OutboxEvent.query.order_by(OutboxEvent.id.desc()).first()
+        self.assertEqual(event.op, "patch")
+        self.assertEqual(event.payload["fields"], {"status": "CANCELLED"})
+        self.assertLess(len(to_json(event.payload)), 100)
+
+    def test_item_routes_write_outbox(self):
+        """It should write item deltas for item changes"""
+        order = self._create_orders(1)[0]
+        item = {"product_name": "widget", "quantity": 1, "price": 5}
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item_id = resp.get_json()["id"]
+        item["quantity"] = 3
+        resp = self.client.put(f"{BASE_URL}/{order.id}/items/{item_id}", json=item)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.delete(f"{BASE_URL}/{order.id}/items/{item_id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+        events = OutboxEvent.query.filter_by(entity="item").order_by(OutboxEvent.id).all()
+        self.assertEqual([event.op for event in events], ["create", "patch", "delete"])
+        self.assertTrue(all(event.entity_id == order.id for event in events))
+        uid = events[0].payload["uid"]
+        self.assertTrue(all(event.payload["uid"] == uid for event in events))
+        self.assertEqual(events[1].payload["fields"], {"quantity": 3})
+        self.assertIn("order_updated_at", events[2].payload)
+
+    def test_peer_writes_skip_outbox(self):
+        """It should not write outbox events for changes sent by a peer"""
+        order = OrderFactory()
+        resp = self.client.post(
+            BASE_URL, json=order.serialize(), headers={"X-From-Peer": "true"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(OutboxEvent.query.all(), [])
+
+    def test_no_peers_skip_outbox(self):
+        """It should not write outbox events when there are no peers"""
+        app.config["PEER_NODES"] = []
+        self._create_orders(1)
+        self.assertEqual(OutboxEvent.query.all(), [])
+
+    def test_rollback_discards_outbox(self):
+        """It should not write outbox events when the change fails"""
+        order = self._create_orders(1)[0]
+        resp = self.client.post(BASE_URL, json=order.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(OutboxEvent.query.all()), 1)
+        self.assertNotIn("outbox", db.session.info)
+
+
+class TestDispatcher(TestBase):
+    """Outbox Dispatcher Tests"""
+
+    def setUp(self):
+        super().setUp()
+        use_peers(self, PEERS, PEER_SYNC_FORWARD=False)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_delivers_in_order(self, mock_send):
+        """It should deliver outbox events to every peer in one ordered batch"""
+        mock_send.return_value = answer(status.HTTP_200_OK)
+        orders = self._create_orders(3)
+        for future in dispatcher.drain_once():
+            self.assertEqual(future.result(), 3)
+        self.assertEqual(mock_send.call_count, 2)
+        for call in mock_send.call_args_list:
+            self.assertEqual(call.args[1:3], ("POST", BATCH_PATH))
+            mutations = call.kwargs["json"]["mutations"]
+            self.assertEqual([m["id"] for m in mutations], [o.id for o in orders])
+        # every peer has everything so the outbox is pruned
+        self.assertEqual(OutboxEvent.query.all(), [])
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_in_batches(self, mock_send):
+        """It should split the outbox into batches of the configured size"""
+        mock_send.return_value = answer(status.HTTP_200_OK)
+        app.config["OUTBOX_BATCH_SIZE"] = 2
+        self._create_orders(3)
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 3)
+        sizes = [len(c.kwargs["json"]["mutations"]) for c in mock_send.call_args_list]
+        self.assertEqual(sizes, [2, 1])
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_late_commit(self, mock_send):
+        """It should deliver an event that commits after a later one was sent"""
+        mock_send.return_value = answer(status.HTTP_200_OK)
+        order = self._create_orders(1)[0]
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 1)
+        sent = OutboxEvent.query.one()
+        # a transaction that took a lower id commits only now
+        late = OutboxEvent(
+            id=sent.id - 1,
+            op="update",
+            entity="order",
+            entity_id=order.id,
+            payload={},
+            deliveries=[OutboxDelivery(peer=peer) for peer in PEERS],
+        )
+        db.session.add(late)
+        db.session.commit()
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 1)
+        self.assertEqual(mock_send.call_args.kwargs["json"]["mutations"][0]["seq"], late.id)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_prune_removed_peers(self, mock_send):
+        """It should not keep events around for peers that were removed"""
+        mock_send.return_value = answer(status.HTTP_200_OK)
+        self._create_orders(2)
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 2)
+        self.assertEqual(dispatcher.prune(), 0)
+        app.config["PEER_NODES"] = PEERS[:1]
+        self.assertEqual(dispatcher.prune(), 2)
+        self.assertEqual(OutboxDelivery.query.all(), [])
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_backs_off(self, mock_send):
+        """It should back off from a failing peer and keep its events"""
+        mock_send.side_effect = [answer(status.HTTP_200_OK), None]
+        app.config["OUTBOX_BATCH_SIZE"] = 1
+        self._create_orders(2)
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 1)
+        cursor = db.session.get(PeerCursor, PEERS[0])
+        self.assertEqual(cursor.attempts, 1)
+        self.assertIsNotNone(cursor.last_error)
+        self.assertTrue(cursor.is_backing_off(datetime.now(timezone.utc)))
+        # nothing is sent while backing off
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(dispatcher.prune(), 0)
+        self.assertEqual(len(OutboxEvent.query.all()), 2)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_skips_open_circuit(self, mock_send):
+        """It should not back off further while a peer's circuit is open"""
+        self._create_orders(1)
+        client = peers.manager.get(PEERS[0])
+        for _ in range(client.threshold):
+            client.record_failure("refused")
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+        mock_send.assert_not_called()
+        self.assertIsNone(db.session.get(PeerCursor, PEERS[0]))
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_retries_after_backoff(self, mock_send):
+        """It should retry a peer once its backoff has passed"""
+        mock_send.side_effect = [answer(status.HTTP_503_SERVICE_UNAVAILABLE), answer(status.HTTP_200_OK)]
+        self._create_orders(1)
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+        cursor = db.session.get(PeerCursor, PEERS[0])
+        cursor.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 1)
+        cursor = db.session.get(PeerCursor, PEERS[0])
+        self.assertEqual(cursor.attempts, 0)
+        self.assertFalse(cursor.is_backing_off(datetime.now(timezone.utc)))
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_keeps_events_on_client_errors(self, mock_send):
+        """It should keep a batch a peer answers with 404 or another 4xx"""
+        mock_send.return_value = answer(status.HTTP_404_NOT_FOUND)
+        self._create_orders(1)
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+        cursor = db.session.get(PeerCursor, PEERS[0])
+        self.assertEqual(cursor.attempts, 1)
+        self.assertIn("404", cursor.last_error)
+        self.assertEqual(OutboxDelivery.query.filter_by(peer=PEERS[0]).count(), 1)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_drain_records_rejected(self, mock_send):
+        """It should not send again the events a peer rejected"""
+        self._create_orders(2)
+        seq = OutboxEvent.query.order_by(OutboxEvent.id).first().id
+        mock_send.return_value = answer(status.HTTP_200_OK, rejected=[seq])
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 2)
+        cursor = db.session.get(PeerCursor, PEERS[0])
+        self.assertIn(str(seq), cursor.last_error)
+        self.assertEqual(OutboxDelivery.query.filter_by(peer=PEERS[0]).count(), 0)
+        # a body that is not JSON still counts as delivered
+        self._create_orders(1)
+        mock_send.return_value.json.side_effect = ValueError("not json")
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 1)
+        self.assertIsNone(db.session.get(PeerCursor, PEERS[0]).last_error)
+
+    @patch("service.common.dispatcher.peers.request_peer")
+    def test_sync_mode_drains_on_request(self, mock_send):
+        """It should deliver before responding in synchronous mode"""
+        mock_send.return_value = answer(status.HTTP_201_CREATED)
+        app.config["PEER_SYNC_FORWARD"] = True
+        self._create_orders(1)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(OutboxEvent.query.all(), [])
+
+    def test_prune_without_peers(self):
+        """It should not prune when there are no peers"""
+        app.config["PEER_NODES"] = []
+        self.assertEqual(dispatcher.prune(), 0)
+
+    @patch("service.common.dispatcher.PeerCursor.lock")
+    def test_drain_database_error(self, mock_lock):
+        """It should survive database errors while draining"""
+        mock_lock.side_effect = db.exc.SQLAlchemyError("boom")
+        self.assertEqual(dispatcher.drain_peer(PEERS[0]), 0)
+
+    def test_background_thread(self):
+        """It should drain the outbox from a background thread when notified"""
+        drained = threading.Event()
+        app.config["OUTBOX_BATCH_WINDOW"] = 0
+        background = OutboxDispatcher(app)
+        with patch.object(
+            background, "drain_once", side_effect=lambda **_: drained.set()
+        ):
+            background.start()
+            background.start()  # already running
+            background.notify()
+            self.assertTrue(drained.wait(2))
+        self.assertIs(app.extensions["outbox_dispatcher"], background)
+        app.extensions["outbox_dispatcher"] = dispatcher
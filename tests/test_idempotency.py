@@ -0,0 +1,163 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Key Test Suite
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from service.common import status
+from service.models import IdempotencyKey, Order, db
+from tests.factories import ItemFactory, OrderFactory
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+BATCH_URL = "/api/replication/batch"
+
+
+class TestIdempotency(TestBase):
+    """Idempotency Key Tests"""
+
+    def _order_data(self):
+        """Returns the body of a new order with one item"""
+        data = OrderFactory().serialize()
+        data["items"] = [ItemFactory().serialize()]
+        return data
+
+    def test_replay_create(self):
+        """It should answer a retried create with the first response"""
+        data = self._order_data()
+        headers = {"Idempotency-Key": "retry-me"}
+        first = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+
+        with patch.object(Order, "create") as create:
+            second = self.client.post(BASE_URL, json=data, headers=headers)
+        create.assert_not_called()
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(second.headers["Location"], first.headers["Location"])
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+
+    def test_retry_without_key(self):
+        """It should still refuse a retried create sent without a key"""
+        data = self._order_data()
+        self.client.post(BASE_URL, json=data)
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_key_reused_for_other_request(self):
+        """It should refuse a key sent again with a different body"""
+        headers = {"Idempotency-Key": "used-once"}
+        resp = self.client.post(BASE_URL, json=self._order_data(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.post(BASE_URL, json=self._order_data(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_failures_are_not_stored(self):
+        """It should let a failed request be retried with the same key"""
+        data = self._order_data()
+        del data["customer_name"]
+        headers = {"Idempotency-Key": "fix-and-retry"}
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(IdempotencyKey.query.count(), 0)
+
+    def test_expired_keys(self):
+        """It should forget keys once they expire"""
+        data = self._order_data()
+        headers = {"Idempotency-Key": "short-lived"}
+        self.client.post(BASE_URL, json=data, headers=headers)
+        stored = IdempotencyKey.query.one()
+        stored.expires_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+        self.assertIsNone(IdempotencyKey.find(stored.key))
+
+        # the expired key is dropped when the next one is stored
+        self.client.post(BASE_URL, json=self._order_data(), headers={"Idempotency-Key": "next"})
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_replay_batch(self):
+        """It should answer a redelivered replication batch from the store"""
+        order = OrderFactory()
+        data = order.serialize()
+        data["items"] = []
+        mutations = [{"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": data}]
+        headers = {"Idempotency-Key": "batch-1", "X-From-Peer": "true"}
+        first = self.client.post(BATCH_URL, json={"mutations": mutations}, headers=headers)
+        self.assertEqual(first.get_json(), {"applied": 1, "rejected": []})
+        with patch("service.replication_routes.apply_mutations") as apply:
+            second = self.client.post(BATCH_URL, json={"mutations": mutations}, headers=headers)
+        apply.assert_not_called()
+        self.assertEqual(second.get_json(), first.get_json())
+
+    def test_concurrent_retry(self):
+        """It should refuse a retry sent while the first request is still running"""
+        data = self._order_data()
+        headers = {"Idempotency-Key": "sent-twice"}
+        create = Order.create
+        responses = []
+
+        def slow_create(order):
+            time.sleep(0.5)
+            create(order)
+
+        def first_request():
+            with app.app_context():
+                responses.append(app.test_client().post(BASE_URL, json=data, headers=headers))
+
+        with patch.object(Order, "create", slow_create):
+            writer = threading.Thread(target=first_request)
+            writer.start()
+            time.sleep(0.2)
+            retry = self.client.post(BASE_URL, json=data, headers=headers)
+            writer.join()
+        self.assertEqual(retry.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("still being processed", retry.get_json()["message"])
+        self.assertEqual(responses[0].status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.query.count(), 1)
+
+        # once it finished the retry gets its response
+        again = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(again.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(again.headers["Idempotent-Replayed"], "true")
+
+    def test_lapsed_reservation(self):
+        """It should run a request again once the key of one that never finished lapses"""
+        data = self._order_data()
+        headers = {"Idempotency-Key": "crashed"}
+        self.client.post(BASE_URL, json=data, headers=headers)
+        stored = IdempotencyKey.query.one()
+        stored.status_code = 102
+        db.session.commit()
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+        stored = IdempotencyKey.query.one()
+        stored.expires_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+        db.session.query(Order).delete()
+        db.session.commit()
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
@@ -0,0 +1,86 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for Index management
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from service.models import Item, Order, create_indexes, db, missing_indexes
+from service.models.indexes import TRIGRAM, has_extension
+from tests.test_base import TestBase
+
+
+######################################################################
+#  I N D E X   T E S T   C A S E S
+######################################################################
+class TestIndexes(TestBase):
+    """Index management Tests"""
+
+    def setUp(self):
+        super().setUp()
+        db.session.remove()
+        create_indexes()
+
+    def _index_names(self, table):
+        """Returns the names of the indexes of a table in the database"""
+        return {index["name"] for index in inspect(db.engine).get_indexes(table)}
+
+    def test_models_define_indexes(self):
+        """It should index the columns orders are filtered and joined on"""
+        self.assertTrue(
+            {"ix_order_created_at_id", "ix_order_status_created_at", "ix_order_customer_name_created_at"}
+            <= self._index_names(Order.__tablename__)
+        )
+        self.assertTrue({"ix_item_order_id", "ix_item_product_name"} <= self._index_names(Item.__tablename__))
+        self.assertEqual(missing_indexes()[0], [])
+
+    def test_create_missing_indexes(self):
+        """It should build only the indexes the database is missing"""
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_item_product_name"))
+            connection.execute(text("DROP INDEX ix_order_status_created_at"))
+        missing, _ = missing_indexes()
+        self.assertEqual(
+            sorted(index.name for index in missing),
+            ["ix_item_product_name", "ix_order_status_created_at"],
+        )
+        self.assertCountEqual(create_indexes(), ["ix_item_product_name", "ix_order_status_created_at"])
+        self.assertIn("ix_item_product_name", self._index_names(Item.__tablename__))
+        self.assertEqual(create_indexes(), [])
+
+    def test_rebuild_invalid_index(self):
+        """It should rebuild an index a failed concurrent build left invalid"""
+        with db.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "UPDATE pg_index SET indisvalid = false "
+                    "WHERE indexrelid = 'ix_item_order_id'::regclass"
+                )
+            )
+        self.assertEqual(create_indexes(), ["ix_item_order_id"])
+        self.assertEqual(missing_indexes(), ([], set()))
+
+    def test_trigram_indexes(self):
+        """It should build the trigram indexes only where pg_trgm is available"""
+        index = next(index for index in Order.__table__.indexes if index.name == "ix_order_customer_name_trgm")
+        ddl = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+        self.assertIn("USING gin (customer_name gin_trgm_ops)", ddl)
+        built = "ix_order_customer_name_trgm" in self._index_names(Order.__tablename__)
+        self.assertEqual(built, has_extension(TRIGRAM))
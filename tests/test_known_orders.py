@@ -0,0 +1,226 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the filter of known Orders and the cache of missing ones
+"""
+
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from service.common import status
+from service.common.known_orders import BloomFilter, known_orders
+from service.common.order_cache import order_cache
+from service.models import Change, Order, db
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+METRICS_URL = "/api/cache/metrics"
+
+
+class TestBloomFilter(TestCase):
+    """Bloom Filter Tests"""
+
+    def test_no_false_negatives(self):
+        """It should hold every value added to it"""
+        bloom = BloomFilter(1000)
+        for value in range(0, 3000, 3):
+            bloom.add(value)
+        self.assertEqual(bloom.count, 1000)
+        self.assertTrue(all(value in bloom for value in range(0, 3000, 3)))
+
+    def test_error_rate(self):
+        """It should let through about the share of unknown values it was made for"""
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for value in range(1000):
+            bloom.add(value)
+        false_positives = sum(value in bloom for value in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+
+class TestKnownOrders(TestBase):
+    """Known Order Ids Tests"""
+
+    def setUp(self):
+        super().setUp()
+        order_cache.clear()
+        known_orders.reset()
+
+    def _create_order(self, order_id=1):
+        """Creates an order through the API"""
+        data = {"id": order_id, "customer_name": "Ann", "status": "CREATED", "items": []}
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_unknown_order_without_query(self):
+        """It should answer reads and writes of an unknown order with 404 without reading the orders"""
+        self._create_order()
+        self.client.get(f"{BASE_URL}/1")
+        with self.count_queries() as statements:
+            for order_id in range(1000, 1010):
+                resp = self.client.get(f"{BASE_URL}/{order_id}")
+                if resp.status_code != status.HTTP_404_NOT_FOUND:
+                    break
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("could not be found", resp.get_json()["message"])
+        # each only looks up the newest change, and one in a hundred
+        # unknown ids may get through to the orders
+        orders = [statement for statement in statements if "change_log" not in statement]
+        self.assertLessEqual(len(orders), 2)
+        self.assertLessEqual(len(statements), 12)
+
+        with patch("service.common.known_orders.KnownOrders.may_exist", return_value=False):
+            with self.count_queries() as statements:
+                put = self.client.put(f"{BASE_URL}/7", json={"customer_name": "Bob"})
+                items = self.client.get(f"{BASE_URL}/7/items")
+                item = self.client.get(f"{BASE_URL}/7/items/1")
+                post = self.client.post(f"{BASE_URL}/7/items", json={"product_name": "nut"})
+                delete = self.client.delete(f"{BASE_URL}/7")
+        self.assertEqual(statements, [])
+        self.assertEqual(put.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(items.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(item.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(post.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(delete.status_code, status.HTTP_204_NO_CONTENT)
+
+        metrics = self.client.get(METRICS_URL).get_json()
+        self.assertGreaterEqual(metrics["filter_rejections"], 9)
+        self.assertEqual(metrics["filter_ids"], 1)
+
+    def test_created_order_is_known(self):
+        """It should know an order this process created at once"""
+        self.client.get(f"{BASE_URL}/1")
+        self._create_order()
+        resp = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(known_orders.may_exist(1))
+
+    def test_rolled_back_order_is_not_added(self):
+        """It should not add an order whose transaction was rolled back"""
+        self.assertFalse(known_orders.may_exist(5))
+        db.session.add(Order(id=5, customer_name="Ann", status="CREATED"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertFalse(known_orders.may_exist(5))
+
+    def test_refresh_from_change_log(self):
+        """It should find the orders another process created in the change log"""
+        self.assertFalse(known_orders.may_exist(1))
+        # as if other workers had created them, or applied them from a peer
+        with patch.object(known_orders, "add"):
+            self._create_order()
+            resp = self.client.post("/api/replication/batch", json={"mutations": [{
+                "seq": 1,
+                "op": "create",
+                "entity": "order",
+                "id": 2,
+                "data": {"id": 2, "customer_name": "Bob", "status": "CREATED", "items": []},
+            }]})
+            self.assertEqual(resp.get_json()["applied"], 1)
+        self.assertEqual(self.client.get(f"{BASE_URL}/1").status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f"{BASE_URL}/2/items").status_code, status.HTTP_200_OK)
+        resp = self.client.post(f"{BASE_URL}/2/items", json={"product_name": "nut", "quantity": 1, "price": 1})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(known_orders.may_exist(3))
+
+    def test_refill_after_prune(self):
+        """It should be filled again when changes it has not read were pruned"""
+        self.assertFalse(known_orders.may_exist(1))
+        with patch.object(known_orders, "add"):
+            self._create_order(1)
+            Change.prune(datetime(2999, 1, 1))
+            self._create_order(2)
+        self.assertTrue(known_orders.may_exist(1))
+        self.assertTrue(known_orders.may_exist(2))
+
+    def test_refill_when_full(self):
+        """It should be filled again with more room once it holds more ids than it was made for"""
+        capacity = known_orders.capacity
+        known_orders.capacity = 2
+        try:
+            known_orders.reset()
+            self.assertFalse(known_orders.may_exist(1))
+            with patch.object(known_orders, "add"):
+                for order_id in range(1, 4):
+                    self._create_order(order_id)
+            self.assertTrue(all(known_orders.may_exist(order_id) for order_id in range(1, 4)))
+            self.assertGreaterEqual(known_orders.metrics()["filter_ids"], 3)
+        finally:
+            known_orders.capacity = capacity
+
+    def test_database_unavailable(self):
+        """It should let every id through when the filter cannot be filled"""
+        error = OperationalError("SELECT", {}, Exception("down"))
+        with patch("service.common.known_orders.db.session.scalar", side_effect=error):
+            self.assertTrue(known_orders.may_exist(1))
+        self.assertIsNone(known_orders.metrics()["filter_ids"])
+
+    def test_filter_disabled(self):
+        """It should let every id through when its capacity is 0"""
+        capacity = known_orders.capacity
+        known_orders.capacity = 0
+        try:
+            self.assertTrue(known_orders.may_exist(1))
+            self.assertIsNone(known_orders.metrics()["filter_ids"])
+        finally:
+            known_orders.capacity = capacity
+
+
+class TestMissingOrders(TestBase):
+    """Cached Missing Order Tests"""
+
+    def setUp(self):
+        super().setUp()
+        order_cache.clear()
+        known_orders.reset()
+
+    def test_cache_missing_order(self):
+        """It should answer a deleted order with 404 from the cache until it is created again"""
+        resp = self.client.post(BASE_URL, json={"id": 1, "customer_name": "Ann", "status": "CREATED"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.client.delete(f"{BASE_URL}/1")
+
+        # a deleted id stays in the filter, so the database says it is gone
+        self.assertEqual(self.client.get(f"{BASE_URL}/1").status_code, status.HTTP_404_NOT_FOUND)
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/1")
+            items = self.client.get(f"{BASE_URL}/1/items")
+            conditional = self.client.get(f"{BASE_URL}/1", headers={"If-None-Match": '"1"'})
+        self.assertEqual(statements, [])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(items.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(conditional.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(METRICS_URL).get_json()["missing_hits"], 3)
+
+        resp = self.client.post(BASE_URL, json={"id": 1, "customer_name": "Bob", "status": "CREATED"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["customer_name"], "Bob")
+
+    def test_conditional_read_of_missing_order(self):
+        """It should cache an order a conditional read found missing"""
+        resp = self.client.post(BASE_URL, json={"id": 1, "customer_name": "Ann", "status": "CREATED"})
+        self.client.delete(f"{BASE_URL}/1")
+        resp = self.client.get(f"{BASE_URL}/1", headers={"If-None-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(statements, [])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
@@ -242,16 +242,12 @@ class TestOrder(TestBase):
             self.assertEqual(order.status, order_status)
 
     def test_find_by__invalid_order_status(self):
-        """It should Find empty list for invalid order status queried"""
-        orders = OrderFactory.create_batch(10)
-        for order in orders:
-            order.create()
-        order_status = "INVALID_STATUS"
-        count = len([order for order in orders if order.status.value == order_status])
-        found = Order.find_by_filters(order_status=order_status)
-        self.assertEqual(len(found), count)
-        self.assertEqual(len(found), 0)
-        self.assertEqual(count, 0)
+        """It should refuse an invalid order status before querying"""
+        with self.count_queries() as statements:
+            self.assertRaises(
+                DataValidationError, Order.find_by_filters, order_status="INVALID_STATUS"
+            )
+        self.assertEqual(statements, [])
 
     def test_find_by_product_name(self):
         """It should Find an Order by product_name"""
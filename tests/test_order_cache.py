@@ -0,0 +1,601 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Order cache
+"""
+
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from service.common import status
+from service.common.cache_backends import (
+    CacheError,
+    MemoryBackend,
+    RedisBackend,
+    SharedMemoryBackend,
+    make_backend,
+)
+from service.common.order_cache import OrderCache, order_cache
+from service.models import Order, db
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+METRICS_URL = "/api/cache/metrics"
+
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of a Redis server in this process for the cache"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.lock = threading.Lock()
+        self.values = {}  # key -> (value, expiry time or None)
+        self.versions = {}  # key -> times it was written
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        """Returns the URL of the stand-in"""
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def stop(self):
+        """Stops serving"""
+        self.shutdown()
+        self.server_close()
+
+    def read(self, key):
+        """Returns the value of a key unless it expired"""
+        value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires <= time.monotonic():
+            self.values.pop(key)
+            return None
+        return value
+
+    def write(self, key, value=None, expires=None):
+        """Sets or deletes a key"""
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if value is None:
+            return self.values.pop(key, None) is not None
+        self.values[key] = (value, expires)
+        return True
+
+    def run(self, command, args):
+        """Returns the reply to one command"""
+        if command == b"GET":
+            return self.read(args[0])
+        if command == b"MGET":
+            return [self.read(key) for key in args]
+        if command == b"SET":
+            expires = time.monotonic() + int(args[3]) / 1000 if len(args) > 3 else None
+            self.write(args[0], args[1], expires)
+            return "OK"
+        if command == b"DEL":
+            return sum(self.write(key) for key in args)
+        if command == b"INCR":
+            value = int(self.read(args[0]) or 0) + 1
+            self.write(args[0], str(value).encode())
+            return value
+        return "OK"
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """Serves one connection to the stand-in"""
+
+    def _command(self):
+        """Reads a command as a list of bulk strings"""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _reply(self, value):
+        """Encodes a reply"""
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self._reply(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        server, watched, queued = self.server, {}, None
+        while True:
+            args = self._command()
+            if args is None:
+                return
+            command, args = args[0].upper(), args[1:]
+            with server.lock:
+                if command == b"WATCH":
+                    watched.update({key: server.versions.get(key, 0) for key in args})
+                    reply = "OK"
+                elif command == b"UNWATCH":
+                    watched, reply = {}, "OK"
+                elif command == b"MULTI":
+                    queued, reply = [], "OK"
+                elif command == b"EXEC":
+                    changed = any(server.versions.get(key, 0) != version for key, version in watched.items())
+                    reply = None if changed else [server.run(*entry) for entry in queued or []]
+                    watched, queued = {}, None
+                    if reply is None:
+                        self.wfile.write(b"*-1\r\n")
+                        continue
+                elif queued is not None:
+                    queued.append((command, args))
+                    reply = "QUEUED"
+                else:
+                    reply = server.run(command, args)
+            self.wfile.write(self._reply(reply))
+
+
+######################################################################
+#  C A C H E   B A C K E N D   T E S T   C A S E S
+######################################################################
+class BackendTests:
+    """Tests every cache backend must pass"""
+
+    def make_backend(self, size=8, ttl=5):
+        """Returns the backend under test"""
+        raise NotImplementedError
+
+    # named for the TestCase each backend's tests are mixed into
+    def setUp(self):  # pylint: disable=invalid-name
+        """Runs before each test"""
+        self.backend = self.make_backend()
+        self.backend.invalidate()
+
+    def tearDown(self):  # pylint: disable=invalid-name
+        """Runs after each test"""
+        self.backend.close()
+
+    def test_put_and_get(self):
+        """It should return a cached Order as it was put"""
+        self.assertIsNone(self.backend.get(1))
+        data = {"id": 1, "items": [{"product_name": "bolt", "quantity": 2}]}
+        self.backend.put(1, data, self.backend.epoch())
+        self.assertEqual(self.backend.get(1), data)
+
+    def test_invalidate(self):
+        """It should drop the Orders that changed"""
+        for order_id in (1, 2):
+            self.backend.put(order_id, {"id": order_id}, self.backend.epoch())
+        self.backend.invalidate([1, 5])
+        self.assertIsNone(self.backend.get(1))
+        self.assertIsNotNone(self.backend.get(2))
+        self.backend.invalidate()
+        self.assertIsNone(self.backend.get(2))
+
+    def test_skip_stale_read(self):
+        """It should not keep an Order read before a change was committed"""
+        epoch = self.backend.epoch()
+        self.backend.invalidate([1])
+        self.backend.put(1, {"id": 1}, epoch)
+        self.assertIsNone(self.backend.get(1))
+
+    def test_share_between_clients(self):
+        """It should show what one client caches and invalidates to another"""
+        other = self.make_backend()
+        try:
+            epoch = other.epoch()
+            self.backend.put(1, {"id": 1}, self.backend.epoch())
+            self.assertEqual(other.get(1), {"id": 1})
+            other.invalidate([1])
+            self.assertIsNone(self.backend.get(1))
+            # a read that began before the other client invalidated is not kept
+            self.backend.put(1, {"id": 1}, epoch)
+            self.assertIsNone(other.get(1))
+        finally:
+            other.close()
+
+    def test_disabled(self):
+        """It should keep nothing when its size is zero"""
+        backend = self.make_backend(size=0)
+        try:
+            backend.put(1, {"id": 1}, backend.epoch())
+            self.assertIsNone(backend.get(1))
+        finally:
+            backend.close()
+
+
+class TestMemoryBackend(BackendTests, TestCase):
+    """In-process Backend Tests"""
+
+    def make_backend(self, size=8, ttl=5):
+        if size == 8 and hasattr(self, "backend"):
+            return self.backend
+        self.clock = FakeClock()
+        return MemoryBackend(size, ttl, clock=self.clock)
+
+    def test_share_between_clients(self):
+        """It should not be shared"""
+        self.assertIsNot(MemoryBackend(), self.backend)
+
+    def test_expire(self):
+        """It should not serve an Order older than its time to live"""
+        self.backend.put(1, {"id": 1}, self.backend.epoch())
+        self.clock.now = 4.9
+        self.assertIsNotNone(self.backend.get(1))
+        self.clock.now = 5
+        self.assertIsNone(self.backend.get(1))
+        self.assertEqual(self.backend.entries(), 0)
+
+    def test_evict_least_recently_used(self):
+        """It should drop the least recently read Order when it is full"""
+        backend = MemoryBackend(2, 5)
+        for order_id in (1, 2):
+            backend.put(order_id, {"id": order_id}, backend.epoch())
+        backend.get(1)
+        backend.put(3, {"id": 3}, backend.epoch())
+        self.assertIsNone(backend.get(2))
+        self.assertIsNotNone(backend.get(1))
+        self.assertIsNotNone(backend.get(3))
+        self.assertEqual(backend.evictions, 1)
+
+
+class TestSharedMemoryBackend(BackendTests, TestCase):
+    """Shared Memory Backend Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        cls.path = os.path.join(cls.directory.name, "orders-cache")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def make_backend(self, size=8, ttl=5):
+        self.clock = FakeClock()
+        return SharedMemoryBackend(self.path, size, ttl, entry_size=256, clock=self.clock)
+
+    def test_bounded(self):
+        """It should keep a fixed number of slots and evict the oldest of a full set"""
+        self.backend = self.make_backend(ttl=100)
+        for order_id in range(0, 16, 2):
+            self.clock.now = order_id
+            self.backend.put(order_id, {"id": order_id}, self.backend.epoch())
+        self.assertEqual(os.path.getsize(self.path), 24 + 8 * 256)
+        # eight slots in two sets of four: the even ids all went to the first
+        self.assertEqual(self.backend.entries(), 4)
+        self.assertEqual(self.backend.evictions, 4)
+        self.assertIsNone(self.backend.get(0))
+        self.assertIsNotNone(self.backend.get(14))
+
+    def test_expire(self):
+        """It should not serve an Order older than its time to live"""
+        self.backend.put(1, {"id": 1}, self.backend.epoch())
+        self.clock.now = 5
+        self.assertIsNone(self.backend.get(1))
+        self.assertEqual(self.backend.entries(), 0)
+
+    def test_too_large(self):
+        """It should not cache an Order larger than a slot"""
+        self.backend.put(1, {"id": 1, "customer_name": "x" * 256}, self.backend.epoch())
+        self.assertIsNone(self.backend.get(1))
+        self.assertEqual(self.backend.oversize, 1)
+
+    def test_reformat(self):
+        """It should format the file again for a different layout"""
+        self.backend.put(1, {"id": 1}, self.backend.epoch())
+        other = SharedMemoryBackend(self.path, 16, 5, entry_size=256, clock=self.clock)
+        try:
+            self.assertIsNone(other.get(1))
+            self.assertEqual(os.path.getsize(self.path), 24 + 16 * 256)
+        finally:
+            other.close()
+
+    def test_unreachable(self):
+        """It should raise a CacheError when it cannot open its file"""
+        backend = SharedMemoryBackend(os.path.join(self.path, "missing"))
+        self.assertRaises(CacheError, backend.get, 1)
+
+
+class TestRedisBackend(BackendTests, TestCase):
+    """Redis Protocol Backend Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RespStandIn()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def make_backend(self, size=8, ttl=5):
+        return RedisBackend(self.server.url, size, ttl)
+
+    def test_expire(self):
+        """It should let the server expire an Order"""
+        backend = RedisBackend(self.server.url, ttl=0.001)
+        backend.put(1, {"id": 1}, backend.epoch())
+        time.sleep(0.01)
+        self.assertIsNone(backend.get(1))
+
+    def test_abort_on_concurrent_invalidation(self):
+        """It should not store an Order when the epoch moves during the write"""
+        epoch = self.backend.epoch()
+        real_execute = self.backend._execute  # pylint: disable=protected-access
+
+        def invalidate_first(*commands):
+            if commands[0] == ("MULTI",):
+                self.make_backend().invalidate([1])
+            return real_execute(*commands)
+
+        with patch.object(self.backend, "_execute", side_effect=invalidate_first):
+            self.backend.put(1, {"id": 1}, epoch)
+        self.assertIsNone(self.backend.get(1))
+
+    def test_unreachable(self):
+        """It should raise a CacheError when the server cannot be reached"""
+        backend = RedisBackend("redis://127.0.0.1:1")
+        self.assertRaises(CacheError, backend.get, 1)
+        self.assertRaises(CacheError, backend.invalidate, [1])
+
+
+######################################################################
+#  O R D E R   C A C H E   T E S T   C A S E S
+######################################################################
+class TestOrderCache(TestCase):
+    """OrderCache Tests"""
+
+    def test_count_hits(self):
+        """It should count a miss until an Order is put and a hit after"""
+        cache = OrderCache()
+        self.assertIsNone(cache.get(1))
+        cache.put(1, {"id": 1}, cache.epoch())
+        self.assertEqual(cache.get(1), {"id": 1})
+        metrics = cache.metrics()
+        self.assertEqual((metrics["hits"], metrics["misses"]), (1, 1))
+        self.assertEqual(metrics["hit_rate"], 0.5)
+        self.assertEqual(metrics["entries"], 1)
+        self.assertEqual(metrics["backend"], "memory")
+
+    def test_backend_unreachable(self):
+        """It should read from the database when its backend cannot be reached"""
+        cache = OrderCache(RedisBackend("redis://127.0.0.1:1"))
+        self.assertIsNone(cache.epoch())
+        cache.put(1, {"id": 1}, None)
+        self.assertIsNone(cache.get(1))
+        cache.invalidate([1])
+        self.assertEqual(cache.metrics()["misses"], 1)
+        self.assertIsNone(cache.metrics()["entries"])
+
+    def test_make_backend(self):
+        """It should make the backend a URL names"""
+        self.assertIsInstance(make_backend("memory://", 10, 5, 2048), MemoryBackend)
+        self.assertIsInstance(make_backend("mmap:///dev/shm/x", 10, 5, 2048), SharedMemoryBackend)
+        backend = make_backend("redis://:secret@cache:6380/2", 10, 5, 2048)
+        self.assertEqual(backend.address, ("cache", 6380))
+        self.assertEqual((backend.password, backend.database), ("secret", 2))
+        self.assertRaises(ValueError, make_backend, "memcached://cache", 10, 5, 2048)
+
+
+######################################################################
+#  C A C H E D   R E A D S   T E S T   C A S E S
+######################################################################
+class TestCachedReads(TestBase):
+    """Cached Order Reads Tests"""
+
+    def setUp(self):
+        super().setUp()
+        order_cache.clear()
+
+    def _create_order(self, order_id=1):
+        """Creates an order with one item"""
+        data = {
+            "id": order_id,
+            "customer_name": "Ann",
+            "status": "CREATED",
+            "items": [{"product_name": "bolt", "quantity": 2, "price": 1.5}],
+        }
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
+    def _get(self, order_id=1):
+        """Returns an order after reading it twice, the second time from the cache"""
+        self.client.get(f"{BASE_URL}/{order_id}")
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/{order_id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(statements, [])
+        return resp.get_json()
+
+    def test_get_order_from_cache(self):
+        """It should read an order from the database once"""
+        self._create_order()
+        data = self._get()
+        self.assertEqual(data["customer_name"], "Ann")
+        self.assertEqual(len(data["items"]), 1)
+
+        # the items and sparse fieldsets are served from the cached order
+        with self.count_queries() as statements:
+            items = self.client.get(f"{BASE_URL}/1/items").get_json()
+            fields = self.client.get(f"{BASE_URL}/1", query_string={"fields": "status"}).get_json()
+        self.assertEqual(statements, [])
+        self.assertEqual(items[0]["product_name"], "bolt")
+        self.assertEqual(fields, {"status": "CREATED"})
+
+        metrics = self.client.get(METRICS_URL).get_json()
+        self.assertEqual(metrics["hits"], 3)
+        self.assertEqual(metrics["misses"], 1)
+        self.assertEqual(metrics["entries"], 1)
+
+    def test_serve_rendered_order(self):
+        """It should send a cached order as it was rendered without serializing it again"""
+        self._create_order()
+        first = self.client.get(f"{BASE_URL}/1")
+        items = self.client.get(f"{BASE_URL}/1/items")
+        with patch.object(Order, "serialize") as serialize, patch("service.routes.render") as render:
+            again = self.client.get(f"{BASE_URL}/1")
+            items_again = self.client.get(f"{BASE_URL}/1/items")
+        serialize.assert_not_called()
+        render.assert_not_called()
+        self.assertEqual(again.data, first.data)
+        self.assertEqual(items_again.data, items.data)
+        self.assertEqual(again.content_type, "application/json")
+        self.assertEqual(again.get_json()["items"], items.get_json())
+
+    def test_order_not_found(self):
+        """It should not cache an order that does not exist"""
+        resp = self.client.get(f"{BASE_URL}/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(order_cache.metrics()["entries"], 0)
+
+    def test_do_not_cache_projection(self):
+        """It should not cache an order read with only some of its fields"""
+        self._create_order()
+        self.client.get(f"{BASE_URL}/1", query_string={"fields": "status"})
+        self.assertEqual(order_cache.metrics()["entries"], 0)
+
+    def test_invalidate_on_update(self):
+        """It should read an order again after it was updated"""
+        order = self._create_order()
+        self._get()
+        order["customer_name"] = "Bob"
+        resp = self.client.put(f"{BASE_URL}/1", json=order)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._get()["customer_name"], "Bob")
+
+    def test_invalidate_on_status(self):
+        """It should read an order again after its status changed"""
+        self._create_order()
+        self._get()
+        self.client.put(f"{BASE_URL}/1/status", json={"status": "SHIPPED"})
+        self.assertEqual(self._get()["status"], "SHIPPED")
+        self.client.put(f"{BASE_URL}/1/cancel")
+        self.assertEqual(self._get()["status"], "CANCELLED")
+
+    def test_invalidate_on_items(self):
+        """It should read an order again after its items changed"""
+        self._create_order()
+        self._get()
+        resp = self.client.post(
+            f"{BASE_URL}/1/items", json={"product_name": "nut", "quantity": 1, "price": 10}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item = resp.get_json()
+        self.assertEqual(len(self._get()["items"]), 2)
+
+        item["quantity"] = 5
+        self.client.put(f"{BASE_URL}/1/items/{item['id']}", json=item)
+        items = {row["id"]: row for row in self._get()["items"]}
+        self.assertEqual(items[item["id"]]["quantity"], 5)
+
+        self.client.delete(f"{BASE_URL}/1/items/{item['id']}")
+        self.assertEqual(len(self._get()["items"]), 1)
+
+    def test_invalidate_on_delete(self):
+        """It should not serve an order after it was deleted"""
+        self._create_order()
+        self._get()
+        self.client.delete(f"{BASE_URL}/1")
+        resp = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalidate_on_replicated_write(self):
+        """It should read an order again after a peer changed it"""
+        order = self._create_order()
+        self._get()
+        order.update(customer_name="Cy", updated_at="2099-01-01T00:00:00")
+        mutations = [{"seq": 1, "op": "update", "entity": "order", "id": 1, "data": order}]
+        resp = self.client.post("/api/replication/batch", json={"mutations": mutations})
+        self.assertEqual(resp.get_json()["applied"], 1)
+        self.assertEqual(self._get()["customer_name"], "Cy")
+
+    def test_keep_cache_on_rollback(self):
+        """It should not drop an order for a change that was rolled back"""
+        self._create_order()
+        self._get()
+        order = Order.find(1)
+        order.customer_name = "Bob"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(order_cache.metrics()["invalidations"], 0)
+        self.assertEqual(self._get()["customer_name"], "Ann")
+
+    def test_shared_backend(self):
+        """It should serve and invalidate orders kept in a shared backend"""
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SharedMemoryBackend(os.path.join(directory, "orders-cache"))
+            with patch.object(order_cache, "backend", backend):
+                order = self._create_order()
+                data = self._get()
+                self.assertEqual(data["items"][0]["price"], 1.5)
+                self.assertEqual(data, self.client.get(f"{BASE_URL}/1").get_json())
+
+                order["customer_name"] = "Bob"
+                self.client.put(f"{BASE_URL}/1", json=order)
+                self.assertEqual(self._get()["customer_name"], "Bob")
+                self.assertEqual(self.client.get(METRICS_URL).get_json()["backend"], "mmap")
+            backend.close()
+
+    def test_items_kept_once(self):
+        """It should keep the items of a cached order once and count orders too large to cache"""
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SharedMemoryBackend(os.path.join(directory, "orders-cache"))
+            with patch.object(order_cache, "backend", backend):
+                for order_id, count in [(1, 10), (2, 20)]:
+                    data = {
+                        "id": order_id,
+                        "customer_name": "Ann",
+                        "status": "CREATED",
+                        "items": [
+                            {"product_name": f"widget-{i}", "quantity": 2, "price": 12.5} for i in range(count)
+                        ],
+                    }
+                    self.client.post(BASE_URL, json=data)
+                first = self.client.get(f"{BASE_URL}/1")
+                with self.count_queries() as statements:
+                    again = self.client.get(f"{BASE_URL}/1")
+                    items = self.client.get(f"{BASE_URL}/1/items")
+                self.assertEqual(statements, [])
+                self.assertEqual(again.data, first.data)
+                self.assertEqual(again.get_json()["items"], items.get_json())
+                self.assertEqual(len(items.get_json()), 10)
+                self.assertEqual(backend.get(1)["order"].count("widget"), 0)
+
+                self.assertEqual(len(self.client.get(f"{BASE_URL}/2").get_json()["items"]), 20)
+                self.assertIsNone(backend.get(2))
+                self.assertEqual(self.client.get(METRICS_URL).get_json()["oversize"], 1)
+            backend.close()
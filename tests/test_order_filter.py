@@ -0,0 +1,137 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Order filters
+"""
+
+from datetime import datetime
+from decimal import Decimal
+
+from service.common import status
+from service.models import DataValidationError, Item, Order, OrderFilter, OrderStatus
+from tests.test_base import TestBase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  O R D E R   F I L T E R   T E S T   C A S E S
+######################################################################
+class TestOrderFilter(TestBase):
+    """Order filter Tests"""
+
+    def _create(self, order_id, order_status, created_at, *items):
+        """Creates an order with (product_name, quantity, price) items"""
+        order = Order(
+            id=order_id,
+            customer_name=f"customer-{order_id}",
+            status=order_status,
+            created_at=created_at,
+            updated_at=created_at,
+        )
+        for product_name, quantity, price in items:
+            order.items.append(Item(product_name=product_name, quantity=quantity, price=price))
+        order.create()
+
+    def _ids(self, **filters):
+        """Returns the ids of the Orders the filters find"""
+        return sorted(order.id for order in Order.find_by_filters(**filters))
+
+    def setUp(self):
+        super().setUp()
+        self._create(1, OrderStatus.CREATED, datetime(2024, 1, 1), ("bolt", 1, 2), ("nut", 10, 1))
+        self._create(2, OrderStatus.SHIPPED, datetime(2024, 2, 1), ("bolt", 5, 2), ("bolt", 6, 2))
+        self._create(3, OrderStatus.CANCELLED, datetime(2024, 3, 1), ("washer", 2, 50))
+
+    def test_several_statuses(self):
+        """It should find Orders in any of several statuses"""
+        self.assertEqual(self._ids(order_status="created,shipped"), [1, 2])
+        self.assertEqual(self._ids(order_status=["CANCELLED"]), [3])
+
+    def test_time_ranges(self):
+        """It should find Orders created or updated within a range"""
+        self.assertEqual(self._ids(created_after="2024-02-01"), [2, 3])
+        self.assertEqual(self._ids(created_before="2024-02-01T00:00:00"), [1])
+        self.assertEqual(
+            self._ids(created_after="2024-01-15", created_before="2024-02-15T00:00:00+00:00"), [2]
+        )
+        self.assertEqual(self._ids(updated_before="2024-01-01T01:00:00+02:00"), [])
+
+    def test_item_ranges(self):
+        """It should find Orders with one item that meets every item filter"""
+        self.assertEqual(self._ids(min_quantity=5), [1, 2])
+        self.assertEqual(self._ids(min_price="10.5"), [3])
+        self.assertEqual(self._ids(max_price=1), [1])
+        # order 1 has a bolt and an item of quantity 10, but not in one item
+        self.assertEqual(self._ids(product_name="bolt", min_quantity=10), [])
+        self.assertEqual(self._ids(product_name="bolt", min_quantity=2, max_quantity=5), [2])
+
+    def test_no_duplicates(self):
+        """It should list an Order once however many of its items match"""
+        orders = Order.find_by_filters(product_name="bolt")
+        self.assertEqual(sorted(order.id for order in orders), [1, 2])
+
+    def test_combined_filters(self):
+        """It should combine order and item filters"""
+        self.assertEqual(self._ids(order_status="SHIPPED,CANCELLED", min_quantity=2), [2, 3])
+        self.assertEqual(self._ids(order_status="SHIPPED", product_name="washer"), [])
+
+    def test_bad_filters(self):
+        """It should refuse bad filters without querying"""
+        bad = [
+            {"order_status": "LOST"},
+            {"created_after": "yesterday"},
+            {"min_quantity": "two"},
+            {"min_quantity": -1},
+            {"max_price": "NaN"},
+            {"min_price": "cheap"},
+            {"min_price": 5, "max_price": 1},
+            {"created_after": "2024-02-01", "created_before": "2024-01-01"},
+            {"match": "regex"},
+            {"customer_name": 5},
+            {"colour": "red"},
+        ]
+        with self.count_queries() as statements:
+            for filters in bad:
+                with self.assertRaises(DataValidationError, msg=filters):
+                    OrderFilter(**filters)
+        self.assertEqual(statements, [])
+
+    def test_empty_filters(self):
+        """It should ignore filters that are not set"""
+        order_filter = OrderFilter(order_status="", min_price=None, product_name=[])
+        self.assertEqual(order_filter.values, {})
+        self.assertEqual(self._ids(order_status=""), [1, 2, 3])
+        self.assertIn("min_price", repr(OrderFilter(min_price="1.50")))
+        self.assertEqual(OrderFilter(min_price="1.50").values["min_price"], Decimal("1.50"))
+
+    def test_list_with_filters(self):
+        """It should filter the listing and refuse bad filters with 400"""
+        resp = self.client.get(
+            BASE_URL, query_string={"order_status": "created,shipped", "min_quantity": 6}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(order["id"] for order in resp.get_json()), [1, 2])
+
+        resp = self.client.get(BASE_URL, query_string={"created_after": "not a time"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("created_after", resp.get_json()["message"])
+
+        resp = self.client.get(
+            BASE_URL, query_string={"order_status": "LOST"}, headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
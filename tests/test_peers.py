@@ -0,0 +1,293 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Peer Forwarding Test Suite
+"""
+
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from service.common import peers, status
+from service.models import OutboxDelivery, db
+from tests.test_base import TestBase, use_peers
+from wsgi import app
+
+PEERS = ["http://peer-1", "http://peer-2", "http://peer-3"]
+
+
+def send_to_all(method, path, json=None):
+    """Sends a request to every peer and returns futures of the status codes"""
+    deadline = time.monotonic() + app.config["PEER_DEADLINE"]
+
+    def send(peer):
+        response = peers.request_peer(
+            peer, method, path, json=json, deadline=deadline, timeout=app.config["PEER_TIMEOUT"]
+        )
+        return response.status_code if response is not None else None
+
+    return peers.fan_out(send, deadline=deadline)
+
+
+class TestPeerForwarding(TestCase):
+    """Peer Forwarding Tests"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        use_peers(self, PEERS, PEER_SYNC_FORWARD=False)
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_no_peers(self):
+        """It should not send anything when there are no peers"""
+        app.config["PEER_NODES"] = []
+        with patch("service.common.peers.requests.Session.request") as mock_request:
+            futures = send_to_all("DELETE", "/api/orders/1")
+        self.assertEqual(futures, [])
+        mock_request.assert_not_called()
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_forward_to_all_peers(self, mock_request):
+        """It should send a request to every peer"""
+        mock_request.return_value = MagicMock(status_code=201)
+        futures = send_to_all("POST", "/api/orders", {"id": 1})
+        self.assertEqual([future.result() for future in futures], [201, 201, 201])
+        urls = sorted(call.args[1] for call in mock_request.call_args_list)
+        self.assertEqual(urls, [f"{peer}/api/orders" for peer in PEERS])
+        for peer in PEERS:
+            session = peers.manager.get(peer).session
+            self.assertEqual(session.headers["X-From-Peer"], "true")
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_forward_is_concurrent(self, mock_request):
+        """It should call slow peers at the same time"""
+
+        def slow_peer(*args, **kwargs):  # pylint: disable=unused-argument
+            time.sleep(0.2)
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = slow_peer
+        app.config["PEER_SYNC_FORWARD"] = True
+        start = time.monotonic()
+        futures = send_to_all("PUT", "/api/orders/1", {"id": 1})
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertTrue(all(future.done() for future in futures))
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_forward_does_not_wait(self, mock_request):
+        """It should return before the peers answer unless sync mode is set"""
+
+        def slow_peer(*args, **kwargs):  # pylint: disable=unused-argument
+            time.sleep(0.2)
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = slow_peer
+        futures = send_to_all("PUT", "/api/orders/1", {"id": 1})
+        self.assertFalse(all(future.done() for future in futures))
+        for future in futures:
+            future.result()
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_forward_deadline(self, mock_request):
+        """It should stop waiting on peers once the deadline passes"""
+
+        def slow_peer(*args, **kwargs):  # pylint: disable=unused-argument
+            time.sleep(0.5)
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = slow_peer
+        app.config["PEER_SYNC_FORWARD"] = True
+        app.config["PEER_DEADLINE"] = 0.1
+        start = time.monotonic()
+        futures = send_to_all("DELETE", "/api/orders/1")
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertFalse(all(future.done() for future in futures))
+        for future in futures:
+            future.result()
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_peer_failure(self, mock_request):
+        """It should return None for a peer that cannot be reached"""
+        mock_request.side_effect = requests.ConnectionError("refused")
+        result = peers.request_peer(PEERS[0], "DELETE", "/api/orders/1")
+        self.assertIsNone(result)
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_peer_past_deadline(self, mock_request):
+        """It should skip a peer when the deadline has already passed"""
+        result = peers.request_peer(
+            PEERS[0], "DELETE", "/api/orders/1", deadline=time.monotonic() - 1
+        )
+        self.assertIsNone(result)
+        mock_request.assert_not_called()
+
+
+class TestCircuitBreaker(TestCase):
+    """Peer Circuit Breaker Tests"""
+
+    def setUp(self):
+        self.client = peers.PeerClient(PEERS[0], threshold=2, cooldown=60)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_opens_after_failures(self):
+        """It should open the circuit after too many failures in a row"""
+        self.assertTrue(self.client.allow())
+        self.client.record_failure("refused")
+        self.assertEqual(self.client.state, peers.CLOSED)
+        self.assertFalse(self.client.is_open())
+        self.client.record_failure("refused")
+        self.assertEqual(self.client.state, peers.OPEN)
+        self.assertTrue(self.client.is_open())
+        self.assertFalse(self.client.allow())
+
+    def test_session_per_thread(self):
+        """It should give every thread its own session over one connection pool"""
+        sessions = []
+        worker = threading.Thread(target=lambda: sessions.append(self.client.session))
+        worker.start()
+        worker.join()
+        self.assertIs(self.client.session, self.client.session)
+        self.assertIsNot(sessions[0], self.client.session)
+        self.assertIs(sessions[0].get_adapter("http://peer-1"), self.client.adapter)
+        self.assertIs(self.client.session.get_adapter("https://peer-1"), self.client.adapter)
+        self.assertEqual(sessions[0].headers["X-From-Peer"], "true")
+
+    def test_half_open_after_cooldown(self):
+        """It should let one request through once the cooldown passes"""
+        self.client.record_failure("refused")
+        self.client.record_failure("refused")
+        self.client.opened_at -= 61
+        self.assertTrue(self.client.allow())
+        self.assertEqual(self.client.state, peers.HALF_OPEN)
+        self.assertFalse(self.client.allow())
+        # a failed trial opens the circuit again
+        self.client.record_failure("refused")
+        self.assertEqual(self.client.state, peers.OPEN)
+
+    def test_closes_after_success(self):
+        """It should close the circuit when a trial request succeeds"""
+        self.client.record_failure("refused")
+        self.client.record_failure("refused")
+        self.client.opened_at -= 61
+        self.assertTrue(self.client.allow())
+        self.client.record_success(12.5)
+        self.assertEqual(self.client.state, peers.CLOSED)
+        health = self.client.health()
+        self.assertEqual(health["consecutive_failures"], 0)
+        self.assertEqual(health["total_failures"], 2)
+        self.assertEqual(health["total_successes"], 1)
+        self.assertEqual(health["last_latency_ms"], 12.5)
+        self.assertIsNotNone(health["last_success_at"])
+
+    def test_metrics(self):
+        """It should report latency percentiles and the error rate of recent requests"""
+        client = peers.PeerClient(PEERS[0], window=100)
+        self.assertIsNone(client.metrics()["latency_p99_ms"])
+        self.assertEqual(client.metrics()["error_rate"], 0.0)
+        for latency in range(1, 201):
+            client.started()
+            client.record_success(float(latency))
+        client.started()
+        client.record_failure("refused", 500.0)
+        client.started()
+        metrics = client.metrics()
+        # only the last 100 requests count
+        self.assertEqual(metrics["requests"], 100)
+        self.assertEqual(metrics["in_flight"], 1)
+        self.assertEqual(metrics["error_rate"], 0.01)
+        self.assertEqual(metrics["latency_p50_ms"], 151.0)
+        self.assertEqual(metrics["latency_p99_ms"], 200.0)
+        client.close()
+
+    def test_percentile(self):
+        """It should pick the nearest-rank percentile"""
+        self.assertEqual(peers.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(peers.percentile([1, 2, 3, 4], 99), 4)
+        self.assertEqual(peers.percentile([7], 1), 7)
+        self.assertIsNone(peers.percentile([], 50))
+
+
+class TestPeerHealth(TestBase):
+    """Peer Health API Tests"""
+
+    def setUp(self):
+        super().setUp()
+        use_peers(self, PEERS)
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_stops_calling_dead_peer(self, mock_request):
+        """It should stop calling a peer once its circuit is open"""
+        mock_request.side_effect = requests.ConnectionError("refused")
+        for _ in range(5):
+            peers.request_peer(PEERS[0], "POST", "/api/replication/batch", json={})
+        self.assertEqual(mock_request.call_count, app.config["PEER_BREAKER_THRESHOLD"])
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_server_errors_count_as_failures(self, mock_request):
+        """It should count 5xx answers against a peer"""
+        mock_request.return_value = MagicMock(status_code=500)
+        response = peers.request_peer(PEERS[0], "POST", "/api/replication/batch", json={})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(peers.manager.get(PEERS[0]).failures, 1)
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_list_peer_health(self, mock_request):
+        """It should report the health of every peer"""
+        mock_request.side_effect = [
+            MagicMock(status_code=200),
+            requests.ConnectionError("refused"),
+        ]
+        peers.request_peer(PEERS[0], "POST", "/api/replication/batch", json={})
+        peers.request_peer(PEERS[1], "POST", "/api/replication/batch", json={})
+        resp = self.client.get("/api/peers")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([peer["peer"] for peer in data], PEERS)
+        self.assertEqual(data[0]["state"], "closed")
+        self.assertEqual(data[0]["total_successes"], 1)
+        self.assertEqual(data[1]["consecutive_failures"], 1)
+        self.assertIn("refused", data[1]["last_error"])
+        self.assertIsNone(data[2]["last_latency_ms"])
+
+    @patch("service.common.peers.requests.Session.request")
+    def test_list_peer_metrics(self, mock_request):
+        """It should report the lag and throughput of every peer"""
+        app.config["PEER_SYNC_FORWARD"] = False
+        self._create_orders(2)
+        mock_request.return_value = MagicMock(status_code=200)
+        peers.request_peer(PEERS[0], "POST", "/api/replication/batch", json={})
+        OutboxDelivery.query.filter_by(peer=PEERS[0]).delete()
+        db.session.commit()
+
+        resp = self.client.get("/api/peers/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([peer["peer"] for peer in data], PEERS)
+        self.assertEqual(data[0]["queue_depth"], 0)
+        self.assertEqual(data[0]["lag_seconds"], 0.0)
+        self.assertEqual(data[0]["requests"], 1)
+        self.assertIsNotNone(data[0]["latency_p50_ms"])
+        self.assertEqual(data[1]["queue_depth"], 2)
+        self.assertGreater(data[1]["lag_seconds"], 0.0)
+        self.assertEqual(data[1]["in_flight"], 0)
@@ -161,12 +161,7 @@ class TestOrderService(TestBase):
         order = self._create_orders(1)[0]
 
         # POST request to create the order
-        resp = self.client.post(
-            BASE_URL, json=order.serialize(), content_type="application/json"
-        )
-        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
-
-        new_order = resp.get_json()
+        new_order = self._post_order(order)
         new_order_id = new_order["id"]
 
         # Send a PUT request to update the order
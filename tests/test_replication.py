@@ -0,0 +1,319 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Replication Batch API Test Suite
+"""
+
+from datetime import datetime
+from unittest.mock import patch
+
+from service.common import status
+from service.common.replication import apply_mutation
+from service.models import Change, Order, OrderStatus, OutboxEvent, Tombstone, db
+from tests.factories import OrderFactory
+from tests.test_base import TestBase
+
+BATCH_URL = "/api/replication/batch"
+
+
+def order_data(order, **changes):
+    """Returns the replicated body of an order with some fields changed"""
+    data = order.serialize()
+    data["items"] = [
+        {"product_name": "widget", "quantity": 2, "price": "9.99"},
+    ]
+    data.update(changes)
+    return data
+
+
+class TestReplicationBatch(TestBase):
+    """Replication Batch API Tests"""
+
+    def test_apply_batch(self):
+        """It should apply a batch of mutations in order"""
+        first, second = OrderFactory(), OrderFactory()
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": first.id, "data": order_data(first)},
+            {"seq": 2, "op": "create", "entity": "order", "id": second.id, "data": order_data(second)},
+            {
+                "seq": 3,
+                "op": "update",
+                "entity": "order",
+                "id": first.id,
+                "data": order_data(first, customer_name="Jane Doe"),
+            },
+            {"seq": 4, "op": "delete", "entity": "order", "id": second.id},
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"applied": 4, "rejected": []})
+
+        order = Order.find(first.id)
+        self.assertEqual(order.customer_name, "Jane Doe")
+        # the update replaces the items instead of adding to them
+        self.assertEqual(len(order.items), 1)
+        self.assertIsNone(Order.find(second.id))
+        # replicated changes are not sent on again
+        self.assertEqual(OutboxEvent.query.all(), [])
+
+    def test_apply_batch_is_idempotent(self):
+        """It should apply a redelivered batch without errors"""
+        order = OrderFactory()
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": order_data(order)},
+        ]
+        for _ in range(2):
+            resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["applied"], 1)
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_update_missing_order(self):
+        """It should create an order when an update arrives first"""
+        order = OrderFactory()
+        mutations = [
+            {"seq": 7, "op": "update", "entity": "order", "id": order.id, "data": order_data(order)},
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(Order.find(order.id))
+
+    def test_keep_origin_timestamps(self):
+        """It should keep the update and delete times of the node that made them"""
+        order = OrderFactory()
+        data = order_data(order, updated_at="2001-02-03T04:05:06")
+        mutations = [
+            {"seq": 1, "op": "update", "entity": "order", "id": order.id, "data": data},
+        ]
+        self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(Order.find(order.id).updated_at, datetime(2001, 2, 3, 4, 5, 6))
+
+        mutations = [
+            {
+                "seq": 2,
+                "op": "delete",
+                "entity": "order",
+                "id": order.id,
+                "data": {"deleted_at": "2002-01-01T00:00:00"},
+            },
+        ]
+        self.client.post(BATCH_URL, json={"mutations": mutations})
+        tombstone = db.session.get(Tombstone, ("order", order.id))
+        self.assertEqual(tombstone.deleted_at, datetime(2002, 1, 1))
+
+    def test_apply_deltas(self):
+        """It should apply field and item deltas"""
+        order = OrderFactory()
+        data = order_data(order)
+        data["items"][0]["uid"] = "a" * 32
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": data},
+            {
+                "seq": 2,
+                "op": "patch",
+                "entity": "order",
+                "id": order.id,
+                "data": {"fields": {"status": "SHIPPED"}, "updated_at": "2001-02-03T04:05:06"},
+            },
+            {
+                "seq": 3,
+                "op": "create",
+                "entity": "item",
+                "id": order.id,
+                "data": {"uid": "b" * 32, "product_name": "gadget", "quantity": 1, "price": "2.50"},
+            },
+            {
+                "seq": 4,
+                "op": "patch",
+                "entity": "item",
+                "id": order.id,
+                "data": {"uid": "b" * 32, "fields": {"quantity": 4}},
+            },
+            {
+                "seq": 5,
+                "op": "delete",
+                "entity": "item",
+                "id": order.id,
+                "data": {"uid": "a" * 32, "order_updated_at": "2001-02-03T04:05:07"},
+            },
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.get_json(), {"applied": 5, "rejected": []})
+
+        order = Order.find(order.id)
+        self.assertEqual(order.status, OrderStatus.SHIPPED)
+        self.assertEqual(order.updated_at, datetime(2001, 2, 3, 4, 5, 7))
+        self.assertEqual([(item.uid, item.quantity) for item in order.items], [("b" * 32, 4)])
+
+    def test_reject_bad_deltas(self):
+        """It should reject deltas for records that are not here"""
+        order = OrderFactory()
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": order_data(order)},
+            {"seq": 2, "op": "patch", "entity": "order", "id": order.id, "data": {"fields": {"id": 1}}},
+            {"seq": 3, "op": "patch", "entity": "order", "id": 0, "data": {"fields": {}}},
+            {"seq": 4, "op": "patch", "entity": "item", "id": order.id, "data": {"uid": "x", "fields": {}}},
+            {"seq": 5, "op": "delete", "entity": "item", "id": order.id, "data": {"uid": "x"}},
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.get_json(), {"applied": 2, "rejected": [2, 3, 4]})
+
+    def test_concurrent_writes(self):
+        """It should keep the change with the higher version on every node"""
+        order = OrderFactory()
+        data = order_data(order, version=100)
+        data["items"][0]["uid"] = "a" * 32
+        data["items"][0]["version"] = 100
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": data},
+            {
+                "seq": 2,
+                "op": "patch",
+                "entity": "order",
+                "id": order.id,
+                "data": {"fields": {"customer_name": "Newer"}, "version": 300},
+            },
+            # made at the same time on another node but with a lower version
+            {
+                "seq": 3,
+                "op": "patch",
+                "entity": "order",
+                "id": order.id,
+                "data": {"fields": {"customer_name": "Older"}, "version": 200},
+            },
+            {
+                "seq": 4,
+                "op": "update",
+                "entity": "order",
+                "id": order.id,
+                "data": order_data(order, customer_name="Oldest", version=150),
+            },
+            {
+                "seq": 5,
+                "op": "patch",
+                "entity": "item",
+                "id": order.id,
+                "data": {"uid": "a" * 32, "fields": {"quantity": 9}, "version": 50},
+            },
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.get_json(), {"applied": 5, "rejected": []})
+
+        order = Order.find(order.id)
+        self.assertEqual(order.customer_name, "Newer")
+        self.assertEqual(order.version, 300)
+        self.assertEqual(order.items[0].quantity, 2)
+        self.assertEqual(order.items[0].version, 100)
+
+        # the next change made here wins over everything seen so far
+        order.customer_name = "Local"
+        order.update()
+        self.assertGreater(order.version, 300)
+
+    def test_concurrent_field_changes(self):
+        """It should keep both changes when two nodes change different fields at once"""
+        for later in ("here", "there"):
+            with self.subTest(later=later):
+                # the same order on this node and, under another id, on a peer
+                here, there = OrderFactory(status=OrderStatus.CREATED), OrderFactory()
+                for order in (here, there):
+                    data = order_data(order, customer_name="Ann", status="CREATED", version=100)
+                    resp = self.client.post(BATCH_URL, json={"mutations": [
+                        {"seq": 1, "op": "create", "entity": "order", "id": order.id, "data": data},
+                    ]})
+                    self.assertEqual(resp.get_json()["applied"], 1)
+
+                # this node renames the customer while the peer ships the order
+                order = Order.find(here.id)
+                order.customer_name = "Bob"
+                order.update()
+                local = Change.query.filter_by(entity_id=here.id, op="patch").one().payload
+                version = local["version"] + 1 if later == "there" else 200
+                remote = {
+                    "fields": {"status": "SHIPPED"},
+                    "field_versions": {"status": version},
+                    "version": version,
+                    "updated_at": "2001-02-03T04:05:06",
+                }
+                self.client.post(BATCH_URL, json={"mutations": [
+                    {"seq": 2, "op": "patch", "entity": "order", "id": there.id, "data": remote},
+                ]})
+
+                # each side applies the other's change
+                for order_id, data in ((here.id, remote), (there.id, local)):
+                    resp = self.client.post(BATCH_URL, json={"mutations": [
+                        {"seq": 3, "op": "patch", "entity": "order", "id": order_id, "data": data},
+                    ]})
+                    self.assertEqual(resp.get_json(), {"applied": 1, "rejected": []})
+
+                db.session.expire_all()
+                copies = [Order.find(order_id) for order_id in (here.id, there.id)]
+                for order in copies:
+                    self.assertEqual((order.customer_name, order.status), ("Bob", OrderStatus.SHIPPED))
+                self.assertEqual(copies[0].version, max(local["version"], version))
+                self.assertEqual(
+                    [(order.version, order.updated_at, order.field_versions) for order in copies[1:]],
+                    [(copies[0].version, copies[0].updated_at, copies[0].field_versions)],
+                )
+
+    def test_reject_bad_mutations(self):
+        """It should skip bad mutations and apply the rest"""
+        order = OrderFactory()
+        mutations = [
+            {"seq": 1, "op": "explode", "entity": "order", "id": 1},
+            {"seq": 2, "op": "create", "entity": "order", "id": order.id, "data": {"id": order.id}},
+            {"seq": 3, "op": "create", "entity": "order", "id": "abc", "data": {}},
+            "not a mutation",
+            {"seq": 5, "op": "create", "entity": "order", "id": order.id, "data": order_data(order)},
+        ]
+        resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"applied": 1, "rejected": [1, 2, 3, None]})
+        self.assertIsNotNone(Order.find(order.id))
+
+    def test_bad_batch(self):
+        """It should not accept a batch without a list of mutations"""
+        resp = self.client.post(BATCH_URL, json={"mutations": "nope"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(BATCH_URL, json=[])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_commit_fails(self):
+        """It should ask for the batch again when it cannot be committed"""
+        with patch.object(
+            db.session, "commit", side_effect=db.exc.SQLAlchemyError("boom")
+        ):
+            resp = self.client.post(BATCH_URL, json={"mutations": []})
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_batch_database_error(self):
+        """It should apply nothing when the database fails part way"""
+        first, second = OrderFactory(), OrderFactory()
+        mutations = [
+            {"seq": 1, "op": "create", "entity": "order", "id": first.id, "data": order_data(first)},
+            {"seq": 2, "op": "create", "entity": "order", "id": second.id, "data": order_data(second)},
+        ]
+
+        def lose_connection(mutation):
+            if mutation["seq"] == 2:
+                raise db.exc.OperationalError("INSERT", {}, Exception("gone"))
+            apply_mutation(mutation)
+
+        with patch("service.common.replication.apply_mutation", lose_connection):
+            resp = self.client.post(BATCH_URL, json={"mutations": mutations})
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(Order.query.all(), [])
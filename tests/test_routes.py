@@ -18,11 +18,18 @@
 TestOrder API Service Test Suite
 """
 
+import json
+from unittest.mock import patch
+
 from factory import Faker
 
 from service.common import status
+from service.common.order_cache import order_cache
+from service.models import db
+from service.models.indexes import TRIGRAM, has_extension
 from tests.factories import OrderFactory
 from tests.test_base import TestBase
+from wsgi import app
 
 BASE_URL = "/api/orders"
 
@@ -94,12 +101,7 @@ class TestOrderService(TestBase):
         order = self._create_orders(1)[0]
 
         # POST request to create the order
-        resp = self.client.post(
-            BASE_URL, json=order.serialize(), content_type="application/json"
-        )
-        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
-
-        new_order = resp.get_json()
+        new_order = self._post_order(order)
         new_order["customer_name"] = "John Doe"
         new_order_id = new_order["id"]
 
@@ -197,3 +199,388 @@ class TestOrderService(TestBase):
             f"{BASE_URL}/{test_order.id}", json={"bad_key": "bad_value"}
         )
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestOrderQueries(TestBase):
+    """Order Listing and Search Tests"""
+
+    ######################################################################
+    #  L I S T   A N D   S E A R C H   T E S T   C A S E S
+    ######################################################################
+
+    def test_get_order_pages(self):
+        """It should list Orders one page at a time"""
+        orders = self._create_orders(5)
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            page = resp.get_json()
+            self.assertLessEqual(len(page), 2)
+            seen.extend(order["id"] for order in page)
+            link = resp.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+            if url:
+                self.assertIn("limit=2", url)
+                self.assertIn('rel="next"', link)
+        # oldest first, every order exactly once
+        self.assertEqual(seen, [order.id for order in orders])
+
+    def test_get_order_pages_with_filter(self):
+        """It should keep the filters on the next page"""
+        for order in OrderFactory.create_batch(3, customer_name="Pat"):
+            self.client.post(BASE_URL, json=order.serialize())
+        self._create_orders(2)
+        resp = self.client.get(BASE_URL, query_string={"name": "Pat", "limit": 2})
+        self.assertEqual(len(resp.get_json()), 2)
+        link = resp.headers["Link"]
+        resp = self.client.get(link[1:link.index(">")])
+        self.assertEqual([order["customer_name"] for order in resp.get_json()], ["Pat"])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_order_bad_page(self):
+        """It should refuse a bad limit or cursor"""
+        resp = self.client.get(BASE_URL, query_string={"limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL, query_string={"limit": 100000})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(BASE_URL, query_string={"cursor": "not-a-cursor"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _pages(self, **query):
+        """Returns the ids of every Order, following the next links"""
+        seen = []
+        resp = self.client.get(BASE_URL, query_string=query)
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(order["id"] for order in resp.get_json())
+            link = resp.headers.get("Link")
+            if not link:
+                return seen
+            resp = self.client.get(link[1:link.index(">")])
+
+    def test_sort_orders(self):
+        """It should list Orders in the order asked for, one page at a time"""
+        names = ["Cy", "Al", "Bo", "Al", "Cy"]
+        for order_id, name in enumerate(names, start=1):
+            self.client.post(BASE_URL, json={"id": order_id, "customer_name": name})
+        # change one so the update order differs from the create order
+        self.client.put(f"{BASE_URL}/2", json={"id": 2, "customer_name": "Al", "status": "SHIPPED"})
+
+        self.assertEqual(self._pages(sort="-created_at", limit=2), [5, 4, 3, 2, 1])
+        self.assertEqual(self._pages(sort="updated_at", limit=2), [1, 3, 4, 5, 2])
+        self.assertEqual(self._pages(sort="-updated_at", limit=3), [2, 5, 4, 3, 1])
+        self.assertEqual(self._pages(sort="customer_name", limit=2), [2, 4, 3, 1, 5])
+        self.assertEqual(self._pages(sort="-customer_name", limit=2, fields="id"), [5, 1, 3, 4, 2])
+        resp = self.client.get(
+            BASE_URL, query_string={"sort": "-customer_name"}, headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(
+            [json.loads(line)["id"] for line in resp.get_data(as_text=True).splitlines()], [5, 1, 3, 4, 2]
+        )
+
+    def test_bad_sort(self):
+        """It should refuse a sort without an index or a cursor of another sort"""
+        resp = self.client.get(BASE_URL, query_string={"sort": "created_at,-updated_at"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("customer_name", resp.get_json()["message"])
+        self._create_orders(3)
+        link = self.client.get(BASE_URL, query_string={"limit": 1}).headers["Link"]
+        resp = self.client.get(link[1:link.index(">")] + "&sort=customer_name")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _create_orders_with_items(self, count, items=3):
+        """Creates orders that each have some items"""
+        for order in OrderFactory.create_batch(count):
+            data = order.serialize()
+            data["items"] = [
+                {"product_name": f"part-{i}", "quantity": 1, "price": 2.5} for i in range(items)
+            ]
+            resp = self.client.post(BASE_URL, json=data)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_list_query_count(self):
+        """It should list Orders with the same number of queries however many there are"""
+        self._create_orders_with_items(2)
+        db.session.expunge_all()
+        with self.count_queries() as few:
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 2)
+
+        self._create_orders_with_items(8)
+        db.session.expunge_all()
+        with self.count_queries() as many:
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 10)
+        self.assertTrue(all(len(order["items"]) == 3 for order in resp.get_json()))
+        self.assertEqual(len(many), len(few))
+        self.assertLessEqual(len(many), 2)
+
+    def test_stream_orders(self):
+        """It should stream every Order as NDJSON"""
+        self._create_orders_with_items(3)
+        ids = [order["id"] for order in self.client.get(BASE_URL).get_json()]
+        resp = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([order["id"] for order in lines], ids)
+        self.assertTrue(all(len(order["items"]) == 3 for order in lines))
+
+        cursor = self.client.get(BASE_URL, query_string={"limit": 1}).headers["Link"]
+        resp = self.client.get(cursor[1:cursor.index(">")], headers={"Accept": "application/x-ndjson"})
+        self.assertEqual([json.loads(line)["id"] for line in resp.get_data(as_text=True).splitlines()], ids[1:])
+
+    def test_stream_query_count(self):
+        """It should stream Orders in batches with a few queries per batch"""
+        self._create_orders_with_items(6, items=1)
+        db.session.expunge_all()
+        with patch.dict(app.config, {"ORDERS_STREAM_BATCH_SIZE": 2}), self.count_queries() as statements:
+            resp = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+            self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 6)
+        # the orders, then the items of each batch of 2
+        self.assertLessEqual(len(statements), 1 + 3)
+
+    def test_get_order_fields(self):
+        """It should return only the fields asked for"""
+        self._create_orders_with_items(1)
+        order_id = self.client.get(BASE_URL).get_json()[0]["id"]
+        db.session.expunge_all()
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/{order_id}", query_string={"fields": "id,status"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(resp.get_json()), {"id", "status"})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("customer_name", statements[0])
+        self.assertNotIn("item", statements[0])
+
+        resp = self.client.get(
+            f"{BASE_URL}/{order_id}", query_string={"fields": "id", "include": "items"}
+        )
+        data = resp.get_json()
+        self.assertEqual(set(data), {"id", "items"})
+        self.assertEqual(len(data["items"]), 3)
+
+    def test_list_order_fields(self):
+        """It should list only the fields asked for without reading the items"""
+        self._create_orders_with_items(3)
+        db.session.expunge_all()
+        with self.count_queries() as statements:
+            resp = self.client.get(BASE_URL, query_string={"fields": "id,status", "limit": 2})
+        self.assertEqual([set(order) for order in resp.get_json()], [{"id", "status"}] * 2)
+        self.assertEqual(len(statements), 1)
+        self.assertIn("Link", resp.headers)
+
+        resp = self.client.get(
+            BASE_URL,
+            query_string={"fields": "customer_name"},
+            headers={"Accept": "application/x-ndjson"},
+        )
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([set(order) for order in lines], [{"customer_name"}] * 3)
+
+    def test_bad_order_fields(self):
+        """It should refuse unknown fields"""
+        resp = self.client.get(BASE_URL, query_string={"fields": "id,secret"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("secret", resp.get_json()["message"])
+        resp = self.client.get(f"{BASE_URL}/1", query_string={"include": "everything"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _search(self, q, match=None):
+        """Returns the customer names of the Orders a search finds"""
+        query = {"q": q}
+        if match:
+            query["match"] = match
+        resp = self.client.get(BASE_URL, query_string=query)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return sorted(order["customer_name"] for order in resp.get_json())
+
+    def _create_named_orders(self):
+        """Creates orders with known customer and product names"""
+        names = [("Jonathan Smith", "Red Widget"), ("Anna Jonas", "Blue Gadget"), ("Bob 100% Real", "red_gadget")]
+        for order_id, (customer_name, product_name) in enumerate(names, start=1):
+            data = {
+                "id": order_id,
+                "customer_name": customer_name,
+                "items": [{"product_name": product_name, "quantity": 1, "price": 1}] * 2,
+            }
+            self.client.post(BASE_URL, json=data)
+
+    def test_search_orders(self):
+        """It should find Orders by a part of the customer or product name"""
+        self._create_named_orders()
+        self.assertEqual(self._search("jon"), ["Anna Jonas", "Jonathan Smith"])
+        self.assertEqual(self._search("jon", "prefix"), ["Jonathan Smith"])
+        self.assertEqual(self._search("GADGET"), ["Anna Jonas", "Bob 100% Real"])
+        self.assertEqual(self._search("red", "prefix"), ["Bob 100% Real", "Jonathan Smith"])
+        # wildcards are matched as they are
+        self.assertEqual(self._search("0%"), ["Bob 100% Real"])
+        self.assertEqual(self._search("d_g"), ["Bob 100% Real"])
+        self.assertEqual(self._search("zzz"), [])
+        # searches combine with the other filters
+        resp = self.client.get(BASE_URL, query_string={"q": "gadget", "name": "Anna Jonas"})
+        self.assertEqual(len(resp.get_json()), 1)
+
+    def test_fuzzy_search_orders(self):
+        """It should find Orders whose names are close to the search"""
+        self._create_named_orders()
+        self.assertEqual(self._search("Jonathan Smith", "fuzzy"), ["Jonathan Smith"])
+        if not has_extension(TRIGRAM):
+            self.skipTest("the database does not have pg_trgm")
+        self.assertEqual(self._search("Jonathon Smit", "fuzzy"), ["Jonathan Smith"])
+
+    def test_bad_search(self):
+        """It should refuse an unknown kind of match"""
+        resp = self.client.get(BASE_URL, query_string={"q": "a", "match": "regex"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_get_orders(self):
+        """It should read many Orders at once and report the missing ones"""
+        self._create_orders_with_items(4)
+        ids = [order["id"] for order in self.client.get(BASE_URL).get_json()]
+        wanted = [ids[2], 99999, ids[0], ids[2], ids[3]]
+        db.session.expunge_all()
+        with self.count_queries() as statements:
+            resp = self.client.post(f"{BASE_URL}:batchGet", json={"ids": wanted})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([order["id"] for order in data["orders"]], [ids[2], ids[0], ids[3]])
+        self.assertTrue(all(len(order["items"]) == 3 for order in data["orders"]))
+        self.assertEqual(data["missing"], [99999])
+        self.assertEqual(len(statements), 2)
+
+        resp = self.client.post(
+            f"{BASE_URL}:batchGet", query_string={"fields": "id,status"}, json={"ids": ids[:2]}
+        )
+        self.assertEqual([set(order) for order in resp.get_json()["orders"]], [{"id", "status"}] * 2)
+
+    def test_batch_get_bad_ids(self):
+        """It should refuse a batch get without a list of integer ids"""
+        for body in [{}, {"ids": "1,2"}, {"ids": [1, "2"]}, {"ids": [True]}, {"ids": []}, [1, 2]]:
+            resp = self.client.post(f"{BASE_URL}:batchGet", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        with patch.dict(app.config, {"ORDERS_BATCH_GET_MAX_IDS": 2}):
+            resp = self.client.post(f"{BASE_URL}:batchGet", json={"ids": [1, 2, 3]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_query_count(self):
+        """It should read an Order and its items in a single query"""
+        self._create_orders_with_items(1)
+        order_id = self.client.get(BASE_URL).get_json()[0]["id"]
+        db.session.expunge_all()
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/{order_id}")
+        self.assertEqual(len(resp.get_json()["items"]), 3)
+        self.assertEqual(len(statements), 1)
+
+
+class TestConditionalRequests(TestBase):
+    """Conditional Request Tests"""
+
+    ######################################################################
+    #  C O N D I T I O N A L   R E Q U E S T S
+    ######################################################################
+
+    def _create_order(self):
+        """Creates an order with one item and returns it with its ETag"""
+        data = {
+            "id": 1,
+            "customer_name": "Ann",
+            "status": "CREATED",
+            "items": [{"product_name": "bolt", "quantity": 2, "price": 1.5}],
+        }
+        self.assertEqual(self.client.post(BASE_URL, json=data).status_code, status.HTTP_201_CREATED)
+        resp = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(resp.headers["ETag"], f'"{resp.get_json()["version"]}"')
+        self.assertIn("Last-Modified", resp.headers)
+        return resp.get_json(), resp.headers["ETag"]
+
+    def test_get_order_not_modified(self):
+        """It should answer If-None-Match with 304 from the version alone"""
+        order, etag = self._create_order()
+        for url in (f"{BASE_URL}/1", f"{BASE_URL}/1/items"):
+            order_cache.clear()
+            with self.count_queries() as statements:
+                resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(resp.headers["ETag"], etag)
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn("item", statements[0])
+
+        # an order that is cached is not read at all
+        self.client.get(f"{BASE_URL}/1")
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/1", headers={"If-None-Match": f'"0", {etag}'})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(statements, [])
+
+        # a change to an item makes a new ETag
+        item = order["items"][0]
+        item["quantity"] = 3
+        self.client.put(f"{BASE_URL}/1/items/{item['id']}", json=item)
+        resp = self.client.get(f"{BASE_URL}/1/items", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]["quantity"], 3)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_order_modified_since(self):
+        """It should answer If-Modified-Since with 304 unless the order changed since"""
+        self._create_order()
+        last_modified = self.client.get(f"{BASE_URL}/1").headers["Last-Modified"]
+        order_cache.clear()
+        resp = self.client.get(f"{BASE_URL}/1", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.client.get(
+            f"{BASE_URL}/1", headers={"If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # If-None-Match wins over If-Modified-Since
+        resp = self.client.get(
+            f"{BASE_URL}/1",
+            headers={"If-None-Match": '"0"', "If-Modified-Since": last_modified},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_fields_with_etag(self):
+        """It should give a projected order the ETag of the whole order"""
+        _, etag = self._create_order()
+        order_cache.clear()
+        with self.count_queries() as statements:
+            resp = self.client.get(f"{BASE_URL}/1", query_string={"fields": "status"})
+        self.assertEqual(resp.get_json(), {"status": "CREATED"})
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(statements), 1)
+
+    def test_conditional_get_order_not_found(self):
+        """It should not find an order that does not exist with If-None-Match"""
+        resp = self.client.get(f"{BASE_URL}/0", headers={"If-None-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_order_if_match(self):
+        """It should update an order only if If-Match has its current ETag"""
+        order, etag = self._create_order()
+        order["customer_name"] = "Bob"
+        resp = self.client.put(f"{BASE_URL}/1", json=order, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+
+        # a client that has not seen the change cannot overwrite it
+        order["customer_name"] = "Cy"
+        resp = self.client.put(f"{BASE_URL}/1", json=order, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        for url in (f"{BASE_URL}/1/cancel", f"{BASE_URL}/1/status"):
+            resp = self.client.put(url, json={"status": "SHIPPED"}, headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(f"{BASE_URL}/1").get_json()["customer_name"], "Bob")
+
+        resp = self.client.put(
+            f"{BASE_URL}/1/status", json={"status": "SHIPPED"}, headers={"If-Match": new_etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.put(f"{BASE_URL}/1/cancel", headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["status"], "CANCELLED")
@@ -0,0 +1,186 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Order statistics
+"""
+
+import threading
+import time
+
+from service.common import status
+from service.models import Order, OrderStat, OrderStatus, db
+from tests.test_base import TestBase
+from wsgi import app
+
+BASE_URL = "/api/orders"
+STATS_URL = "/api/orders/stats"
+
+
+######################################################################
+#  O R D E R   S T A T I S T I C S   T E S T   C A S E S
+######################################################################
+class TestOrderStats(TestBase):
+    """Order statistics Tests"""
+
+    def _create_order(self, order_id, customer_name, *items, order_status="CREATED"):
+        """Creates an order with (product_name, quantity, price) items"""
+        data = {
+            "id": order_id,
+            "customer_name": customer_name,
+            "status": order_status,
+            "items": [
+                {"product_name": name, "quantity": quantity, "price": price}
+                for name, quantity, price in items
+            ],
+        }
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
+    def _stats(self, top=10):
+        """Returns the statistics with the rows keyed by name"""
+        resp = self.client.get(STATS_URL, query_string={"top": top})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        data["by_status"] = {row.pop("status"): row for row in data["by_status"]}
+        data["by_product"] = {row.pop("product_name"): row for row in data["by_product"]}
+        data["by_customer"] = {row.pop("customer_name"): row for row in data["by_customer"]}
+        return data
+
+    def _rebuilt(self):
+        """Returns the statistics counted again from scratch"""
+        before = self._stats()
+        OrderStat.rebuild()
+        self.assertEqual(self._stats(), before)
+        return before
+
+    def test_empty_stats(self):
+        """It should report zero for every status when there are no orders"""
+        stats = self._stats()
+        self.assertEqual(stats["orders"], 0)
+        self.assertEqual(stats["revenue"], 0)
+        self.assertEqual(stats["by_status"]["CREATED"], {"orders": 0, "quantity": 0, "revenue": 0})
+        self.assertEqual(stats["by_product"], {})
+
+    def test_count_new_orders(self):
+        """It should count new orders by status, product and customer"""
+        self._create_order(1, "Ann", ("bolt", 2, 1.5), ("nut", 1, 10), ("bolt", 1, 1.5))
+        self._create_order(2, "Ann", ("nut", 4, 10), order_status="SHIPPED")
+        self._create_order(3, "Bob")
+        stats = self._rebuilt()
+        self.assertEqual(stats["orders"], 3)
+        self.assertEqual(stats["revenue"], 54.5)
+        self.assertEqual(stats["by_status"]["CREATED"], {"orders": 2, "quantity": 4, "revenue": 14.5})
+        self.assertEqual(stats["by_product"]["bolt"], {"orders": 1, "quantity": 3, "revenue": 4.5})
+        self.assertEqual(stats["by_product"]["nut"], {"orders": 2, "quantity": 5, "revenue": 50})
+        self.assertEqual(stats["by_customer"]["Ann"], {"orders": 2, "quantity": 8, "revenue": 54.5})
+        self.assertEqual(stats["by_customer"]["Bob"], {"orders": 1, "quantity": 0, "revenue": 0})
+        # top products and customers come by revenue
+        self.assertEqual(list(self._stats(top=1)["by_product"]), ["nut"])
+
+    def test_cancel_order(self):
+        """It should move a cancelled order and drop its revenue"""
+        self._create_order(1, "Ann", ("bolt", 2, 5))
+        self._create_order(2, "Ann", ("bolt", 1, 5))
+        resp = self.client.put(f"{BASE_URL}/1/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = self._rebuilt()
+        self.assertEqual(stats["revenue"], 5)
+        self.assertEqual(stats["by_status"]["CREATED"]["orders"], 1)
+        self.assertEqual(stats["by_status"]["CANCELLED"], {"orders": 1, "quantity": 2, "revenue": 10})
+        self.assertEqual(stats["by_product"]["bolt"], {"orders": 1, "quantity": 1, "revenue": 5})
+        self.assertEqual(stats["by_customer"]["Ann"], {"orders": 2, "quantity": 1, "revenue": 5})
+
+    def test_change_items(self):
+        """It should follow items that are added, changed and removed"""
+        order = self._create_order(1, "Ann", ("bolt", 2, 5))
+        item_id = order["items"][0]["id"]
+        resp = self.client.post(
+            f"{BASE_URL}/1/items", json={"product_name": "nut", "quantity": 3, "price": 1}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._stats()["revenue"], 13)
+
+        resp = self.client.put(
+            f"{BASE_URL}/1/items/{item_id}",
+            json={"product_name": "washer", "quantity": 1, "price": 5},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = self._rebuilt()
+        self.assertEqual(stats["revenue"], 8)
+        self.assertNotIn("bolt", stats["by_product"])
+        self.assertEqual(stats["by_product"]["washer"]["revenue"], 5)
+
+        resp = self.client.delete(f"{BASE_URL}/1/items/{item_id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        stats = self._rebuilt()
+        self.assertEqual(stats["revenue"], 3)
+        self.assertNotIn("washer", stats["by_product"])
+
+    def test_delete_order(self):
+        """It should take a deleted order and its items out of the totals"""
+        self._create_order(1, "Ann", ("bolt", 2, 5))
+        self._create_order(2, "Bob", ("nut", 1, 1))
+        # the items are in the session when the order is deleted
+        order = Order.find(1, with_items=True)
+        order.delete()
+        stats = self._rebuilt()
+        self.assertEqual(stats["orders"], 1)
+        self.assertEqual(stats["revenue"], 1)
+        self.assertNotIn("Ann", stats["by_customer"])
+        self.assertNotIn("bolt", stats["by_product"])
+
+    def test_rolled_back_change(self):
+        """It should not count a change that was rolled back"""
+        self._create_order(1, "Ann", ("bolt", 2, 5))
+        order = Order.find(1)
+        order.customer_name = "Zed"
+        db.session.flush()
+        db.session.rollback()
+        stats = self._stats()
+        self.assertIn("Ann", stats["by_customer"])
+        self.assertNotIn("Zed", stats["by_customer"])
+
+    def test_concurrent_changes(self):
+        """It should count two transactions that change the same order at once"""
+        self._create_order(1, "Ann", ("bolt", 2, 5))
+        order = Order.find(1)
+        order.status = OrderStatus.SHIPPED
+        db.session.flush()
+
+        def cancel():
+            with app.app_context():
+                other = Order.find(1)
+                other.status = OrderStatus.CANCELLED
+                db.session.commit()
+                db.session.remove()
+
+        # the second change waits for the first one to commit
+        writer = threading.Thread(target=cancel)
+        writer.start()
+        time.sleep(0.3)
+        db.session.commit()
+        writer.join()
+        stats = self._rebuilt()
+        self.assertEqual(stats["by_status"]["CANCELLED"]["orders"], 1)
+        self.assertEqual(stats["by_status"]["SHIPPED"]["orders"], 0)
+        self.assertEqual(stats["by_status"]["CREATED"]["orders"], 0)
+
+    def test_bad_top(self):
+        """It should refuse a bad number of top rows"""
+        resp = self.client.get(STATS_URL, query_string={"top": -1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)